@@ -1,13 +1,39 @@
 import datetime
+import numpy as np
 import pika
 import json
+import struct
 import uuid
 import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+PUBLISH_ATTEMPTS = 5  # publish attempts (each on a fresh connection) before giving up
+RECONNECT_BACKOFF_SECONDS = 0.5  # first wait before reconnecting, doubled after every failure
+RECONNECT_BACKOFF_MAX_SECONDS = 8
+EEGDATA_QUEUE_SIZE = 100  # pending eegdata frames before the oldest ones get dropped (10 seconds at 10hz)
+EEGDATA_COALESCE_AFTER = 10  # when more frames than this are pending, only the newest one is published
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_FLOAT32 = 'application/x-mindmurmur-float32'
+
+# python 2 has no monotonic clock, wall time is the closest we get there
+monotonic = getattr(time, 'monotonic', time.time)
 
 
 class RabbitController(object):
 
-    def __init__(self, host, port, user, password, virtualhost):
+    def __init__(self, host, port, user, password, virtualhost, wire_format='json'):
+        """
+        :param wire_format: 'json' or 'float32'. Heart rate and eegdata commands are published in this format,
+                            every other command is always json. Keep 'json' while the C# lights app consumes
+                            heart rate or eegdata, it does not understand the float32 format.
+        """
 
         self.EXCHANGE_STATE = 'MindMurmur.Domain.Messages.MeditationStateCommand, MindMurmur.Domain'
         self.EXCHANGE_COLOR = 'MindMurmur.Domain.Messages.ColorControlCommand, MindMurmur.Domain'
@@ -16,10 +42,29 @@ class RabbitController(object):
 
         self.credentials = pika.PlainCredentials(user, password)
         self.parameters = pika.ConnectionParameters(host, port, virtualhost, self.credentials)
-        self.color_props = pika.BasicProperties(type=self.EXCHANGE_COLOR, delivery_mode=2)
-        self.heart_props = pika.BasicProperties(type=self.EXCHANGE_HEART, delivery_mode=2)
-        self.state_props = pika.BasicProperties(type=self.EXCHANGE_STATE, delivery_mode=2)
-        self.eegdata_props = pika.BasicProperties(type=self.EXCHANGE_EEGDATA, delivery_mode=2)
+        self.values_codec = WIRE_FORMATS[wire_format]
+        self.color_props = pika.BasicProperties(type=self.EXCHANGE_COLOR, delivery_mode=2,
+                                                content_type=CONTENT_TYPE_JSON)
+        self.heart_props = pika.BasicProperties(type=self.EXCHANGE_HEART, delivery_mode=2,
+                                                content_type=self.values_codec.content_type)
+        self.state_props = pika.BasicProperties(type=self.EXCHANGE_STATE, delivery_mode=2,
+                                                content_type=CONTENT_TYPE_JSON)
+        self.eegdata_props = pika.BasicProperties(type=self.EXCHANGE_EEGDATA, delivery_mode=2,
+                                                  content_type=self.values_codec.content_type)
+
+        # publisher connections are long-lived and pooled per publishing thread,
+        # as pika's BlockingConnection must not be shared between threads
+        self._publisher_local = threading.local()
+        self._publisher_connections = []
+        self._publisher_lock = threading.Lock()
+
+        # non-blocking eegdata pipeline, the sender thread is started on first use.
+        # the lock guards the sender start and the drop count, producers are OSC handler threads
+        self._eegdata_queue = queue.Queue(maxsize=EEGDATA_QUEUE_SIZE)
+        self._eegdata_lock = threading.Lock()
+        self._eegdata_sender = None
+        self.eegdata_dropped = 0  # frames evicted because the queue was full
+        self.eegdata_coalesced = 0  # frames skipped because the sender was lagging
 
         return
 
@@ -50,19 +95,80 @@ class RabbitController(object):
                 self.open_connection.close()
 
     def _base_publish(self, exchange, properties, command):
+        body = CODECS[properties.content_type].encode(command)
+        backoff = RECONNECT_BACKOFF_SECONDS
+        for attempt in range(1, PUBLISH_ATTEMPTS + 1):
+            try:
+                channel = self._publisher_channel()
+                declared_exchanges = self._publisher_local.declared_exchanges
+                if exchange not in declared_exchanges:
+                    channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
+                    declared_exchanges.add(exchange)
+                channel.basic_publish(exchange=exchange,
+                                      properties=properties,
+                                      routing_key='',
+                                      body=body)
+                return
+            except pika.exceptions.AMQPError as e:
+                logging.warning("publish to {exchange} failed (attempt {attempt}/{attempts}): {error}".format(
+                    exchange=exchange, attempt=attempt, attempts=PUBLISH_ATTEMPTS, error=repr(e)))
+                self._drop_publisher_connection()
+                if attempt == PUBLISH_ATTEMPTS:
+                    raise
+                time.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_SECONDS)
+
+    def _publisher_channel(self):
+        """ Returns the calling thread's publisher channel, connecting on first use or after a drop """
+        local = self._publisher_local
+        connection = getattr(local, 'connection', None)
+        if connection is None or connection.is_closed:
+            connection = pika.BlockingConnection(self.parameters)
+            local.connection = connection
+            local.channel = None
+            with self._publisher_lock:
+                self._publisher_connections.append(connection)
+        if local.channel is None or local.channel.is_closed:
+            local.channel = connection.channel()
+            # exchanges are declared once per channel
+            local.declared_exchanges = set()
+        return local.channel
+
+    def _drop_publisher_connection(self):
+        local = self._publisher_local
+        connection = getattr(local, 'connection', None)
+        local.connection = None
+        local.channel = None
+        if connection is None:
+            return
+        with self._publisher_lock:
+            if connection in self._publisher_connections:
+                self._publisher_connections.remove(connection)
         try:
-            self.open_channel()
-            self.active_channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
-            self.active_channel.basic_publish(exchange=exchange,
-                                              properties=properties,
-                                              routing_key='',
-                                              body=command.to_json())
-        except Exception as e:
-            print(repr(e))
-            raise e
-        finally:
-            if self.open_connection:
-                self.open_connection.close()
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass  # the connection is already broken, nothing left to release
+
+    def close(self):
+        """ Stops the eegdata sender and closes every pooled publisher connection """
+        with self._eegdata_lock:
+            sender, self._eegdata_sender = self._eegdata_sender, None
+        if sender is not None:
+            self._enqueue_eegdata_frame(None)  # sentinel, stops the sender after the pending frames
+            sender.join(timeout=5)
+            if sender.is_alive():
+                # still publishing, its connection is left open rather than closed under it
+                logging.warning("eegdata sender still running, rabbitMQ publisher connections left open")
+                return
+        with self._publisher_lock:
+            connections, self._publisher_connections = self._publisher_connections, []
+        for connection in connections:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception as e:
+                logging.warning("error closing rabbitMQ publisher connection: " + repr(e))
 
     def open_channel(self):
         try:
@@ -112,6 +218,59 @@ class RabbitController(object):
 
         logging.info("sent eegdata message {eegdata_values}".format(eegdata_values=eegdata_values))
 
+    def enqueue_eegdata(self, eegdata_values):
+        """ Queues eegdata for the background sender and returns immediately.
+
+        The queue is bounded: when the bus cannot keep up the oldest frames are
+        dropped, so callers on the EEG ingest path never block on rabbitMQ.
+        """
+        with self._eegdata_lock:
+            if self._eegdata_sender is None:
+                self._eegdata_sender = threading.Thread(target=self._send_eegdata, name='eegdata-sender')
+                self._eegdata_sender.daemon = True
+                self._eegdata_sender.start()
+        # copy, callers keep mutating their buffer while the frame waits in the queue
+        self._enqueue_eegdata_frame(list(eegdata_values))
+
+    def _enqueue_eegdata_frame(self, frame):
+        while True:
+            try:
+                self._eegdata_queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self._eegdata_queue.get_nowait()
+                    with self._eegdata_lock:
+                        self.eegdata_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _send_eegdata(self):
+        while True:
+            # block for the first frame, then drain whatever piled up meanwhile
+            batch = [self._eegdata_queue.get()]
+            try:
+                while True:
+                    batch.append(self._eegdata_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = None in batch
+            if stop:
+                batch = batch[:batch.index(None)]
+            if len(batch) > EEGDATA_COALESCE_AFTER:
+                # consumers only care about the latest band powers, skip the stale backlog
+                self.eegdata_coalesced += len(batch) - 1
+                batch = batch[-1:]
+
+            for eegdata_values in batch:
+                try:
+                    self.publish_eegdata(eegdata_values)
+                except Exception as e:
+                    logging.error("dropping eegdata frame, publish failed: " + repr(e))
+            if stop:
+                return
+
 
 class ColorControlCommand(object):
     """An instance of a color control command
@@ -166,6 +325,13 @@ class HeartRateCommand(BaseCommand):
     def from_string(command_string):
         return HeartRateCommand(json.loads(command_string)["HeartRate"])
 
+    @staticmethod
+    def from_values(values):
+        return HeartRateCommand(int(values[0]))
+
+    def get_values(self):
+        return [self.HeartRate]
+
     def to_string(self):
         return "({0}, {1})".format(self.CommandId, self.HeartRate)
 
@@ -209,6 +375,14 @@ class EEGDataCommand(BaseCommand):
         super(EEGDataCommand, self).__init__()
         self.Values = eegdata_values
 
+    @staticmethod
+    def from_string(command_string):
+        return EEGDataCommand(json.loads(command_string)["Values"])
+
+    @staticmethod
+    def from_values(values):
+        return EEGDataCommand(values)
+
     def get_values(self):
         return self.Values
 
@@ -242,3 +416,53 @@ class SoundCommand(object):
 
     def to_string(self):
         return "({0}, {1})".format(self.CommandId, self.DesiredStage)
+
+
+class JsonCodec(object):
+    """Encodes commands as json, the format every consumer (including the C# lights app) understands"""
+
+    content_type = CONTENT_TYPE_JSON
+
+    def encode(self, command):
+        return command.to_json()
+
+    def decode(self, body, command_class):
+        return command_class.from_string(body)
+
+
+class Float32Codec(object):
+    """Compact binary encoding for commands carrying numeric values (heart rate, eegdata)
+
+    A message is a little-endian header of a monotonic timestamp (float64) and the value
+    count (uint32), followed by the values as float32. Decoding does not copy, the
+    command values are a numpy view over the message body.
+    """
+
+    content_type = CONTENT_TYPE_FLOAT32
+    header = struct.Struct('<dI')
+
+    def encode(self, command):
+        values = np.asarray(command.get_values(), dtype='<f4')
+        return self.header.pack(monotonic(), len(values)) + values.tobytes()
+
+    def decode(self, body, command_class):
+        timestamp, count = self.header.unpack_from(body)
+        values = np.frombuffer(body, dtype='<f4', count=count, offset=self.header.size)
+        command = command_class.from_values(values)
+        command.Timestamp = timestamp
+        return command
+
+
+WIRE_FORMATS = {'json': JsonCodec(),
+                'float32': Float32Codec()}
+
+CODECS = dict((codec.content_type, codec) for codec in WIRE_FORMATS.values())
+
+
+def decode_command(body, properties, command_class):
+    """Decodes a received message body into a command, using the codec matching its content type.
+
+    Messages without a known content type (older publishers, the C# apps) are assumed to be json.
+    """
+    codec = CODECS.get(getattr(properties, 'content_type', None), WIRE_FORMATS['json'])
+    return codec.decode(body, command_class)
@@ -0,0 +1,66 @@
+import numpy as np
+
+from eegstore import BANDS, SENSORS, RingBuffer
+
+EEG_RATE = 256  # raw eeg samples per second
+SEGMENT_SAMPLES = 256  # 1 second FFT segments, 1hz frequency resolution
+SEGMENT_STEP = 128  # segments overlap by half
+WINDOW_SAMPLES = 512  # band powers are averaged over the last 2 seconds (3 segments)
+MIN_POWER = 1e-10  # floor of the summed power density, keeps log10 finite on flat signals
+
+# frequency ranges in hz, the same ones Muse uses for its band elements
+BAND_RANGES = {
+    'delta': (1, 4),
+    'theta': (4, 8),
+    'alpha': (7.5, 13),
+    'beta': (13, 30),
+    'gamma': (30, 44),
+}
+
+
+class BandPowerEstimator(object):
+    """ Computes absolute band powers from the raw eeg stream, like the Muse band elements.
+
+    Samples go into a sliding window. Every `rate / band_rate` samples the window is split in
+    overlapping Hann tapered segments (Welch's method), transformed together in one FFT call,
+    and the power spectral density of each band is summed. Powers are log10 of that sum, in
+    BANDS order with one column per sensor.
+    """
+
+    def __init__(self, band_rate=10, rate=EEG_RATE, segment=SEGMENT_SAMPLES, step=SEGMENT_STEP,
+                 window=WINDOW_SAMPLES):
+        self.update_every = max(1, int(round(rate / float(band_rate))))
+        self.segment = segment
+        self.step = step
+        self.window = window
+        self.samples = RingBuffer(window, SENSORS)
+        self.taper = np.hanning(segment)[:, np.newaxis]
+        # one-sided power spectral density scaling
+        self.scale = 2. / (rate * np.sum(self.taper ** 2))
+        frequencies = np.fft.rfftfreq(segment, 1. / rate)
+        # (bands, frequency bins) selection matrix, summing the bins of each band in one product
+        self.band_matrix = np.array([(frequencies >= BAND_RANGES[band][0]) & (frequencies < BAND_RANGES[band][1])
+                                     for band in BANDS], dtype=np.float64)
+        self._since_update = 0
+
+    def append(self, sample):
+        """ Adds a raw sample, returns True when enough new samples arrived to compute band powers """
+        self.samples.append(sample[:SENSORS])
+        self._since_update += 1
+        if self._since_update >= self.update_every and len(self.samples) >= self.window:
+            self._since_update = 0
+            return True
+        return False
+
+    def compute(self):
+        data = self.samples.window(self.window)
+        data = data - data.mean(axis=0)  # remove the electrode DC offset
+        segments = (self.window - self.segment) // self.step + 1
+        row_stride, column_stride = data.strides
+        # (segments, samples, sensors) view over the window, no copy
+        stacked = np.lib.stride_tricks.as_strided(data, shape=(segments, self.segment, SENSORS),
+                                                  strides=(self.step * row_stride, row_stride, column_stride))
+        spectrum = np.fft.rfft(stacked * self.taper, axis=1)
+        density = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=0) * self.scale
+        powers = self.band_matrix.dot(density)
+        return np.log10(np.maximum(powers, MIN_POWER))
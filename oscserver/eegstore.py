@@ -0,0 +1,91 @@
+import numpy as np
+
+BANDS = ('alpha', 'beta', 'gamma', 'delta', 'theta')
+SENSORS = 4  # TP9, AF7, AF8, TP10
+BAND_RATE = 10  # band powers are calculated at 10hz
+ACC_RATE = 50  # accelerometer samples per second
+HISTORY_SECONDS = 300  # keeping 5 minutes of history
+
+# layout of the eegdata frame published on the bus: 5 bands x 4 sensors, blink count, meditation state
+BLINK_INDEX = len(BANDS) * SENSORS
+STATE_INDEX = BLINK_INDEX + 1
+FRAME_SIZE = STATE_INDEX + 1
+
+
+class RingBuffer(object):
+    """ Preallocated ring buffer of fixed width rows, for a single writer.
+
+    Every row is written twice, at its slot and one capacity further, so the latest n rows are
+    always contiguous and `window` returns them as a view without copying. The row count is
+    bumped only after the row is written, so readers never see a partial row. A window stays
+    valid until `capacity - n` more rows are appended, copy it if it has to live longer.
+    """
+
+    def __init__(self, capacity, width=1, dtype=np.float64):
+        self.capacity = capacity
+        self.width = width
+        self._data = np.zeros((2 * capacity, width), dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, row):
+        slot = self.count % self.capacity
+        self._data[slot] = row
+        self._data[slot + self.capacity] = row
+        self.count += 1
+
+    def window(self, n=None):
+        """ Returns a read-only view of the latest n rows (all stored rows by default), oldest first """
+        count = self.count
+        n = min(len(self) if n is None else n, count, self.capacity)
+        end = (count - 1) % self.capacity + self.capacity + 1 if count else self.capacity
+        view = self._data[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def latest(self):
+        return self.window(1)[0] if self.count else None
+
+
+class EEGStore(object):
+    """ Muse history: a ring buffer per band holding one column per sensor, plus blink and accelerometer.
+
+    `frame` is the latest value of every band and sensor in the layout published on the bus.
+    """
+
+    def __init__(self, history_seconds=HISTORY_SECONDS):
+        self.bands = dict((band, RingBuffer(history_seconds * BAND_RATE, SENSORS)) for band in BANDS)
+        self.blink = RingBuffer(history_seconds * BAND_RATE)
+        self.acc = RingBuffer(history_seconds * ACC_RATE, 3)
+        self.blink_events = 0  # blinks since the last reset
+        self.frame = np.zeros(FRAME_SIZE)
+
+    def append_band(self, band, values):
+        self.bands[band].append(values)
+        offset = BANDS.index(band) * SENSORS
+        self.frame[offset:offset + SENSORS] = values
+
+    def append_blink(self, value):
+        self.blink.append(value)
+        if value:
+            self.blink_events += 1
+            self.frame[BLINK_INDEX] = self.blink_events
+
+    def append_acc(self, values):
+        self.acc.append(values)
+
+    def movement(self, seconds=1):
+        """ Mean change of acceleration between consecutive samples over the last seconds, 0 when still """
+        acc = self.acc.window(seconds * ACC_RATE + 1)
+        if len(acc) < 2:
+            return 0.
+        return float(np.linalg.norm(np.diff(acc, axis=0), axis=1).mean())
+
+    def reset_blinks(self):
+        self.blink_events = 0
+
+    def headset_worn(self):
+        # headset is worn if any band carries nonzero values
+        return bool(np.any(self.frame[:BLINK_INDEX] > 0))
@@ -0,0 +1,138 @@
+import numpy as np
+
+from statsmodels.tsa import arima_model
+
+QUEUE_SIZE = 300  # band powers are calculated at 10hz, predicting from 30 seconds worth of data
+ARIMA_PARAMS = (4, 0, 1)
+
+AR_ORDER = 4  # autoregressive order of the streaming model, same as the ARIMA one
+FORECAST_STEPS = 20  # samples forecasted when comparing with the history, same as the ARIMA one
+FORGETTING_FACTOR = 1 - 1. / QUEUE_SIZE  # the streaming model remembers roughly QUEUE_SIZE samples
+WARMUP_SAMPLES = 100  # samples needed before the streaming model makes decisions (10 seconds)
+QUANTILE_STEP = 0.1  # quantile estimates move by this fraction of the running spread per sample
+
+
+def forecast_mean_diff(data):
+    """ Fits the ARIMA model on the alpha history and returns how much the forecast differs
+    from the history mean, ignoring the 5% outliers on each side. Raises ValueError when
+    there is not enough data to fit the model.
+    """
+    model = arima_model.ARIMA(data, order=ARIMA_PARAMS)
+    model = model.fit(disp=0)
+    forecast = model.predict(start=1, end=FORECAST_STEPS)
+    data_filtered = data[np.where(np.logical_and(np.greater_equal(data, np.percentile(data, 5)),
+                                                 np.less_equal(data, np.percentile(data, 95))))]
+    return np.mean(forecast) - np.mean(data_filtered)
+
+
+class ArimaPredictor(object):
+    """ Refits an ARIMA model on the last 30 seconds of alpha at every evaluation.
+
+    Fitting takes seconds, so this predictor is only evaluated periodically, off the event loop.
+    The alpha history is read straight from the store's ring buffer.
+    """
+
+    evaluate_every_sample = False
+
+    def __init__(self, store):
+        self.alpha = store.bands['alpha']
+
+    def add_sample(self, value):
+        pass  # already in the store
+
+    def history(self):
+        # mean value of abs_alpha in channels 2 and 3, computed over a view of the ring buffer
+        return self.alpha.window(QUEUE_SIZE)[:, 1:3].mean(axis=1)
+
+    def mean_diff(self):
+        return forecast_mean_diff(self.history())
+
+
+class RunningQuantile(object):
+    """ Tracks a quantile of a drifting signal in O(1) per sample (stochastic approximation).
+
+    The estimate moves up by `quantile` steps on samples above it and down by `1 - quantile` steps
+    on samples below it, which settles where that fraction of the recent samples lies below.
+    Steps are proportional to the running mean absolute deviation, so the tracker is scale free.
+    """
+
+    def __init__(self, quantile, rate=1. / QUEUE_SIZE):
+        self.quantile = quantile
+        self.rate = rate
+        self.value = None
+        self.spread = 0.
+
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+            return self.value
+        self.spread += self.rate * (abs(x - self.value) - self.spread)
+        step = QUANTILE_STEP * self.spread
+        if x < self.value:
+            self.value -= step * (1 - self.quantile)
+        else:
+            self.value += step * self.quantile
+        return self.value
+
+
+class RLSPredictor(object):
+    """ Autoregressive model of alpha fitted online with recursive least squares.
+
+    Every sample updates the AR coefficients, the 5th/95th percentile trackers and the mean
+    of the samples between them in O(1), so a decision can be taken as soon as a sample
+    arrives. The decision value mirrors the ARIMA one: forecast mean minus filtered history mean.
+    """
+
+    evaluate_every_sample = True
+
+    def __init__(self, store=None, order=AR_ORDER, forgetting_factor=FORGETTING_FACTOR):
+        self.order = order
+        self.forgetting_factor = forgetting_factor
+        # regressors are an intercept followed by the last `order` samples, newest first
+        self.weights = np.zeros(order + 1)
+        self.covariance = np.eye(order + 1) * 1000.
+        self.regressors = np.zeros(order + 1)
+        self.regressors[0] = 1.
+        self.low = RunningQuantile(0.05)
+        self.high = RunningQuantile(0.95)
+        self.filtered_mean = None
+        self.samples = 0
+
+    def add_sample(self, value):
+        # recursive least squares update of the AR coefficients with the new sample
+        phi = self.regressors
+        p_phi = self.covariance.dot(phi)
+        gain = p_phi / (self.forgetting_factor + phi.dot(p_phi))
+        self.weights += gain * (value - self.weights.dot(phi))
+        self.covariance -= np.outer(gain, p_phi)
+        self.covariance /= self.forgetting_factor
+
+        # shift the sample into the regressors
+        phi[2:] = phi[1:-1]
+        phi[1] = value
+
+        low = self.low.update(value)
+        high = self.high.update(value)
+        if self.filtered_mean is None:
+            self.filtered_mean = value
+        elif low <= value <= high:
+            self.filtered_mean += (1 - self.forgetting_factor) * (value - self.filtered_mean)
+        self.samples += 1
+
+    def forecast(self, steps=FORECAST_STEPS):
+        phi = self.regressors.copy()
+        forecast = np.empty(steps)
+        for i in range(steps):
+            forecast[i] = self.weights.dot(phi)
+            phi[2:] = phi[1:-1]
+            phi[1] = forecast[i]
+        return forecast
+
+    def mean_diff(self):
+        if self.samples < WARMUP_SAMPLES:
+            raise ValueError("%d samples collected, %d needed" % (self.samples, WARMUP_SAMPLES))
+        return np.mean(self.forecast()) - self.filtered_mean
+
+
+PREDICTORS = {'rls': RLSPredictor,
+              'arima': ArimaPredictor}
@@ -0,0 +1,94 @@
+""" Records the OSC datagrams received by the server and replays them over UDP.
+
+A recording is an append-only binary log: a magic header, then one entry per datagram made of
+a little-endian header (wall clock receive time as float64, datagram length as uint32) followed
+by the datagram bytes. Replay it against a running server, in real time or as fast as possible:
+
+python recording.py session.osclog --port 7000
+python recording.py session.osclog --port 7000 --max_speed
+"""
+import argparse
+import os
+import socket
+import struct
+import time
+
+MAGIC = b'MMOSCLOG1\n'
+ENTRY_HEADER = struct.Struct('<dI')
+
+
+class OscRecorder(object):
+    """ Appends received datagrams to a recording, buffered so recording stays off the hot path """
+
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(MAGIC)
+        self.datagrams = 0
+
+    def record(self, dgram, timestamp=None):
+        self.file.write(ENTRY_HEADER.pack(time.time() if timestamp is None else timestamp, len(dgram)))
+        self.file.write(dgram)
+        self.datagrams += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    """ Yields the (timestamp, datagram) entries of a recording, reading it incrementally """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{path} is not an OSC recording".format(path=path))
+        while True:
+            header = f.read(ENTRY_HEADER.size)
+            if len(header) < ENTRY_HEADER.size:
+                return  # end of the log, or an entry cut short by a crash while recording
+            timestamp, length = ENTRY_HEADER.unpack(header)
+            dgram = f.read(length)
+            if len(dgram) < length:
+                return
+            yield timestamp, dgram
+
+
+def replay(path, server_address, speed=1.0):
+    """ Sends the datagrams of a recording to the server, returns (datagrams sent, seconds taken).
+
+    :param speed: playback speed relative to the recording, None sends as fast as possible
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+    first_timestamp = None
+    started = time.time()
+    try:
+        for timestamp, dgram in read_recording(path):
+            if speed is not None:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = started + (timestamp - first_timestamp) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sock.sendto(dgram, server_address)
+            sent += 1
+    finally:
+        sock.close()
+    return sent, time.time() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays a recorded OSC session to the OSC server")
+    parser.add_argument("recording", help="Recording written by server.py --record")
+    parser.add_argument("--ip",
+                        default="127.0.0.1", help="The ip the server listens on")
+    parser.add_argument("--port",
+                        type=int, default=7000, help="The port the server listens on")
+    parser.add_argument("--speed",
+                        type=float, default=1.0, help="Playback speed, 1 replays in real time")
+    parser.add_argument("--max_speed",
+                        action="store_true", help="Send the datagrams as fast as possible")
+    args = parser.parse_args()
+
+    sent, seconds = replay(args.recording, (args.ip, args.port), speed=None if args.max_speed else args.speed)
+    print("[ ] REPLAYED %d DATAGRAMS IN %.2f SECONDS (%.0f/s)" % (sent, seconds, sent / max(seconds, 1e-9)))
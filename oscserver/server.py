@@ -1,185 +1,270 @@
 import argparse
+import asyncio
 import datetime
 import logging
-import msvcrt
 import numpy as np
-import socketserver
-import sys
+import select
 import signal
+import sys
 
-from pythonosc.osc_bundle import OscBundle
-from pythonosc.osc_message import OscMessage
-from collections import deque
-from statsmodels.tsa import arima_model
-from threading import Thread, Lock, Event
+try:
+    import msvcrt
+except ImportError:  # not on windows, keys are read from stdin
+    msvcrt = None
 
-from common.rabbit_controller import RabbitController
+from pythonosc import osc_packet
+from pythonosc.dispatcher import Dispatcher
 
-QUEUE_SIZE = 300  # band powers are calculated at 10hz, storing a 30 seconds worth of data in dequeue
-
-EMIT_STAGE_PERIOD_SECONDS = 60  # evaluating stages every minute
-EMIT_EEGDATA_PERIOD_SECONDS = 1  # evaluating eegdata every second
+from common.rabbit_controller import RabbitController
+from bandpower import BandPowerEstimator
+from eegstore import BANDS, EEGStore, STATE_INDEX
+from predictors import PREDICTORS, forecast_mean_diff
+from recording import OscRecorder
+
+EMIT_STAGE_PERIOD_SECONDS = 60  # evaluating stages every minute, streaming predictors change stage at most once a minute
+EMIT_EEGDATA_PERIOD_SECONDS = 0.1  # streaming eegdata at the muse band power rate (10hz)
+PRINT_EEGDATA_EVERY = 10  # print every 10th emitted eegdata frame, once a second
 AUTO_ADVANCE_LEVEL_PERIOD_SECONDS = 1 # check for auto advance level every second
 AUTO_ADVANCE_AFTER_SECONDS_WHILE_HEADSET_WORN = 120 # auto advance levels every 2 minutes while meditator in session
 AUTO_ADVANCE_AFTER_SECONDS_WHILE_HEADSET_OFF = 600 # auto advance levels every 10 minutes while no one is meditating
 LISTEN_FOR_KEY_SECONDS = 0.05 # listening to keys 20 times per second
-ARIMA_PARAMS = (4, 0, 1)
 LOWER_THRESHOLD = -0.03
 UPPER_THRESHOLD = 0.01
 
-logger = logging.getLogger(__name__)
-
-
-class suppress_stdout:
-    def __enter__(self):
-        self.stdout = sys.stdout
-        sys.stdout = None
-
-    def __exit__(self, type, value, traceback):
-        sys.stdout = self.stdout
-
-
-class OscUDPHandler(socketserver.BaseRequestHandler):
-
-    def handle(self):
-        dgram = self.request[0]
-        with suppress_stdout():
-            message = OscBundle(dgram).content(0) \
-                if OscBundle.dgram_is_bundle(dgram) \
-                else OscMessage(dgram)
-        logger.info('{address} {params}'.format(address=message.address,
-                                                params=message.params))
-        if message.address == '/muse/elements/alpha_absolute':
-            # print('got alpha ' + str(message.params))
-            self.server.queue.append(np.mean(message.params[1:3]))  # storing mean value of abs_alpha in
-            #  channels 2 and 3
-            self.server.raw_values[0:4] = message.params # set alpha
-        elif message.address == '/muse/elements/beta_absolute':
-            # print('got beta ' + str(message.params))
-            self.server.raw_values[4:8] = message.params # set beta
-        elif message.address == '/muse/elements/gamma_absolute':
-            # print('got gamma ' + str(message.params))
-            self.server.raw_values[8:12] = message.params # set gamma
-        elif message.address == '/muse/elements/delta_absolute':
-            # print('got delta ' + str(message.params))
-            self.server.raw_values[12:16] = message.params # set delta
-        elif message.address == '/muse/elements/theta_absolute':
-            # print('got theta ' + str(message.params))
-            self.server.raw_values[16:20] = message.params # set theta
-        elif message.address == '/muse/elements/blink':
-            self.server.increment_blink()
-            self.server.raw_values[20] = self.server.blink_events # set blink
-        elif message.address == '/muse/acc':
-            pass
-            # think how to store accelerometer data, we'll need it to detect if person moved too much
-
-
-class OscUDPServer(socketserver.UDPServer):
-    def __init__(self, server_address):
-        super().__init__(server_address, OscUDPHandler)
+BAND_ADDRESSES = {
+    '/muse/elements/alpha_absolute': 'alpha',
+    '/muse/elements/beta_absolute': 'beta',
+    '/muse/elements/gamma_absolute': 'gamma',
+    '/muse/elements/delta_absolute': 'delta',
+    '/muse/elements/theta_absolute': 'theta',
+}
 
+logger = logging.getLogger(__name__)
 
-class ThreadingOscUDPServer(socketserver.ThreadingMixIn, OscUDPServer):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        signal.signal(signal.SIGINT, self._signal_handler)
-        self.rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
-        self.queue = deque(maxlen=QUEUE_SIZE)  # we only use append, therefore no need in queue.Queue
-        self.blink_events = 0  # counter of blink events
+def read_key():
+    """ The key pressed since the last call, None if there is none. Without msvcrt the console is line
+    buffered, keys are read once followed by enter """
+    if msvcrt is not None:
+        ch = msvcrt.getch() if msvcrt.kbhit() else None
+        return ch.decode() if ch else None
+    if select.select([sys.stdin], [], [], 0)[0]:
+        return sys.stdin.readline().strip() or None
+    return None
+
+
+class OscProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        if self.server.recorder is not None:
+            self.server.recorder.record(data)
+        self.server.handle_datagram(data)
+
+
+class AsyncOscUDPServer(object):
+    """ Receives the Muse Monitor OSC stream on a single asyncio datagram endpoint.
+
+    Datagrams are dispatched on the event loop thread, and the periodic publish, predict and
+    auto advance loops run as tasks of the same loop, so there is no per-packet thread and
+    no locking around the EEG state.
+    """
+
+    def __init__(self, server_address, wire_format='json', predictor='rls', ingest='elements', band_rate=10,
+                 record=None):
+        """
+        :param ingest: 'elements' uses the band powers computed by the phone, 'raw' computes them here
+                       from the 256hz /muse/eeg stream
+        :param band_rate: band power updates per second in 'raw' ingest mode
+        :param record: path of a recording to append the received datagrams to, replay it with recording.py
+        """
+        self.server_address = server_address
+        self.rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/', wire_format=wire_format)
+        self.store = EEGStore()
+        self.predictor = PREDICTORS[predictor](self.store)
         self.state = None
         self.state_last_published = None
         self.levels_advance_upwards = True # auto advance is moving upwards
-        self.raw_values = [0] * 22
-        self.lock = Lock()
-        self._stop = Event()
-        self._timer_thread = None
-        self.start_emitting_messages()
-
-    def increment_blink(self):
-        with self.lock:
-            self.blink_events += 1
-
-    def _signal_handler(self, _, unused_frame):
+        self._stop = None  # asyncio.Event, created on the serving loop
+        self.recorder = OscRecorder(record) if record else None
+
+        self.dispatcher = Dispatcher()
+        if ingest == 'raw':
+            self.band_powers = BandPowerEstimator(band_rate=band_rate)
+            self.dispatcher.map('/muse/eeg', self.on_eeg)
+        else:
+            for address, band in BAND_ADDRESSES.items():
+                self.dispatcher.map(address, self.on_band, band)
+            self.dispatcher.map('/muse/elements/alpha_absolute', self.on_alpha)
+        self.dispatcher.map('/muse/elements/blink', self.on_blink)
+        self.dispatcher.map('/muse/acc', self.on_acc)
+        # the dispatcher compiles a pattern per lookup: the addresses mapped, which muse sends as they are,
+        # are resolved once. Others, patterns included, are looked up per message and never cached, senders
+        # choose the addresses
+        self._handlers = dict((address, list(self.dispatcher.handlers_for_address(address)))
+                              for address in list(self.dispatcher._map))
+
+    def handle_datagram(self, dgram):
+        try:
+            packet = osc_packet.OscPacket(dgram)
+        except osc_packet.ParseError:
+            logger.warning('dropping malformed datagram')
+            return
+        # bundle timetags are ignored, the phone clock is not synced with ours and we want the data now
+        for timed_msg in packet.messages:
+            message = timed_msg.message
+            logger.info('%s %s', message.address, message.params)
+            for handler in self.handlers_for_address(message.address):
+                if handler.args:
+                    handler.callback(message.address, handler.args, *message)
+                else:
+                    handler.callback(message.address, *message)
+
+    def handlers_for_address(self, address):
+        handlers = self._handlers.get(address)
+        if handlers is None:
+            handlers = self.dispatcher.handlers_for_address(address)
+        return handlers
+
+    def on_band(self, address, args, *params):
+        self.store.append_band(args[0], params)
+
+    def on_eeg(self, address, *params):
+        if self.band_powers.append(params):
+            powers = self.band_powers.compute()
+            for band, values in zip(BANDS, powers):
+                self.store.append_band(band, values)
+            self.add_alpha_sample(powers[BANDS.index('alpha')])
+
+    def on_alpha(self, address, *params):
+        self.add_alpha_sample(params)
+
+    def add_alpha_sample(self, alpha):
+        # predicting from the mean value of abs_alpha in channels 2 and 3
+        self.predictor.add_sample(np.mean(alpha[1:3]))
+        if self.predictor.evaluate_every_sample and self.state_last_published is not None:
+            seconds_since_state_publish = (datetime.datetime.now() - self.state_last_published).total_seconds()
+            if seconds_since_state_publish >= EMIT_STAGE_PERIOD_SECONDS:
+                try:
+                    mean_diff = self.predictor.mean_diff()
+                except ValueError:
+                    return  # still warming up
+                if self.apply_mean_diff(mean_diff):
+                    asyncio.get_running_loop().create_task(self.publish_state())
+
+    def on_blink(self, address, *params):
+        self.store.append_blink(params[0])
+
+    def on_acc(self, address, *params):
+        # stored to detect if person moved too much
+        self.store.append_acc(params)
+
+    def stop(self):
         self._stop.set()
 
-    def start_emitting_messages(self):
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        signal.signal(signal.SIGINT, lambda *_: loop.call_soon_threadsafe(self.stop))
+
+        transport, _ = await loop.create_datagram_endpoint(lambda: OscProtocol(self),
+                                                           local_addr=self.server_address)
         self.state = 1
-        self.rabbit.publish_state(self.state)
-        self.state_last_published = datetime.datetime.now()
-        Thread(target=self.predict_next_level, daemon=True).start()
-        Thread(target=self.update_rawvalues, daemon=True).start()
-        Thread(target=self.listen_for_keys, daemon=True).start()
-        Thread(target=self.auto_advance_level, daemon=True).start()
+        await self.publish_state()
+        tasks = [loop.create_task(self.predict_next_level()),
+                 loop.create_task(self.update_rawvalues()),
+                 loop.create_task(self.listen_for_keys()),
+                 loop.create_task(self.auto_advance_level())]
+        try:
+            await self._stop.wait()
+        finally:
+            transport.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.rabbit.close()
+            if self.recorder is not None:
+                print("[ ] RECORDED %d DATAGRAMS TO %s" % (self.recorder.datagrams, self.recorder.path))
+                self.recorder.close()
+
+    async def wait(self, seconds):
+        """ Sleeps for the given period, or less if the server is stopped meanwhile """
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
 
-    def predict_next_level(self):
-        rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
+    async def publish_state(self):
+        # stamped before publishing, so the predictor does not decide again while the publish is in flight
+        self.state_last_published = datetime.datetime.now()
+        # publishing blocks on the bus, keep it off the loop so datagrams keep flowing
+        await asyncio.get_running_loop().run_in_executor(None, self.rabbit.publish_state, self.state)
+
+    def apply_mean_diff(self, mean_diff):
+        """ Moves the state one level towards the predicted trend, returns True when the state changed """
+        prior_state = self.state
+        # add more logic there considering movement and blinks
+        if mean_diff > UPPER_THRESHOLD:
+            self.state = min(self.state + 1, 5)
+            self.levels_advance_upwards = True # auto advance up after upward transition
+        elif mean_diff < LOWER_THRESHOLD:
+            self.state = max(self.state - 1, 1)
+            self.levels_advance_upwards = False # auto advance down after downward transition
+
+        if self.state != prior_state:
+            print("[ ] EMITTING STATE: %s" %(self.state))
+            return True
+        return False
+
+    async def predict_next_level(self):
+        loop = asyncio.get_running_loop()
         while not self._stop.is_set():
-            self._stop.wait(EMIT_STAGE_PERIOD_SECONDS)
-            prior_state = self.state
-            try:
-                data = np.array(self.queue, dtype=np.float64)
-                model = arima_model.ARIMA(data, order=ARIMA_PARAMS)
-                model = model.fit(disp=0)
-                forecast = model.predict(start=1, end=20)
-            except ValueError:
-                print("Skipping state evaluation due to insufficient amount of data collected.")
-                return
-            data_filtered = data[np.where(np.logical_and(np.greater_equal(data, np.percentile(data, 5)),
-                                                         np.less_equal(data, np.percentile(data, 95))))]
-            mean_diff = np.mean(forecast) - np.mean(data_filtered)
-            # add more logic there considering movement and blinks
-            if mean_diff > UPPER_THRESHOLD:
-                self.state = min(self.state + 1, 5)
-                self.levels_advance_upwards = True # auto advance up after upward transition
-            elif mean_diff < LOWER_THRESHOLD:
-                self.state = max(self.state - 1, 1)
-                self.levels_advance_upwards = False # auto advance down after downward transition
-
-            # send to the bus
-            if self.state != prior_state:
-                print("[ ] EMITTING STATE: %s" %(self.state))
-                rabbit.publish_state(self.state)
-                self.state_last_published = datetime.datetime.now()
-
-            with self.lock:
-                self.blink_events = 0
-
-    def update_rawvalues(self):
-        rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
+            await self.wait(EMIT_STAGE_PERIOD_SECONDS)
+            if not self.predictor.evaluate_every_sample:
+                # snapshot the history on the loop, fitting takes a while so it runs on the executor
+                data = self.predictor.history()
+                try:
+                    mean_diff = await loop.run_in_executor(None, forecast_mean_diff, data)
+                except ValueError:
+                    print("Skipping state evaluation due to insufficient amount of data collected.")
+                    mean_diff = None
+                # send to the bus
+                if mean_diff is not None and self.apply_mean_diff(mean_diff):
+                    await self.publish_state()
+
+            self.store.reset_blinks()
+
+    async def update_rawvalues(self):
+        emitted = 0
         while not self._stop.is_set():
-            self._stop.wait(EMIT_EEGDATA_PERIOD_SECONDS)
-            # set state in raw_valceiceilues
-            self.raw_values[21] = int(self.state)
-            # send to the bus
-            print("[ ] EMITTING EEGDATA: %s" %(self.raw_values))
-            rabbit.publish_eegdata(self.raw_values)
-
-    def listen_for_keys(self):
-        rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
+            await self.wait(EMIT_EEGDATA_PERIOD_SECONDS)
+            # set state in the eegdata frame
+            self.store.frame[STATE_INDEX] = self.state
+            raw_values = self.store.frame.tolist()
+            # queue for the bus, sent from the rabbit controller's sender thread
+            if emitted % PRINT_EEGDATA_EVERY == 0:
+                print("[ ] EMITTING EEGDATA: %s MOVEMENT: %.3f" %(raw_values, self.store.movement()))
+            self.rabbit.enqueue_eegdata(raw_values)
+            emitted += 1
+
+    async def listen_for_keys(self):
+        if msvcrt is None and not sys.stdin.isatty():
+            return  # no console to read keys from, e.g. replaying in the background
         while not self._stop.is_set():
-            self._stop.wait(LISTEN_FOR_KEY_SECONDS)
-            if msvcrt.kbhit():
-                ch = msvcrt.getch()
-                if ch:
-                    key = ch.decode()
-                    if key in ['1', '2', '3', '4', '5']:
-                        self.state = int(key)
-                        print("[ ] PRESSED KEY '%s', EMITTING STATE: %s" %(key, self.state))
-                        rabbit.publish_state(self.state)
-                        self.state_last_published = datetime.datetime.now()
-
-    def auto_advance_level(self):
-        rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
+            await self.wait(LISTEN_FOR_KEY_SECONDS)
+            key = read_key()
+            if key in ['1', '2', '3', '4', '5']:
+                self.state = int(key)
+                print("[ ] PRESSED KEY '%s', EMITTING STATE: %s" %(key, self.state))
+                await self.publish_state()
+
+    async def auto_advance_level(self):
         while not self._stop.is_set():
-            self._stop.wait(AUTO_ADVANCE_LEVEL_PERIOD_SECONDS)
+            await self.wait(AUTO_ADVANCE_LEVEL_PERIOD_SECONDS)
 
-            # headset is worn if nonzero values exist in the queue
-            headset_worn = False
-            for value in self.raw_values[0:20]:
-                if value > 0:
-                    headset_worn = True
-                    break
+            headset_worn = self.store.headset_worn()
 
             seconds_since_state_publish = (datetime.datetime.now() - self.state_last_published).total_seconds()
 
@@ -199,8 +284,7 @@ class ThreadingOscUDPServer(socketserver.ThreadingMixIn, OscUDPServer):
 
                 advancing_direction = "UPWARDS" if self.levels_advance_upwards else "DOWNWARDS"
                 print("[ ] AUTOMATICALLY ADVANCING %s, EMITTING STATE: %s" %(advancing_direction, self.state))
-                rabbit.publish_state(self.state)
-                self.state_last_published = datetime.datetime.now()
+                await self.publish_state()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -208,13 +292,27 @@ if __name__ == '__main__':
                         default="0.0.0.0", help="The ip to listen on")
     parser.add_argument("--port",
                         type=int, default=7000, help="The port to listen on")
+    parser.add_argument("--wire_format",
+                        choices=["json", "float32"], default="json",
+                        help="Bus encoding of eegdata messages, float32 is only understood by the python consumers")
+    parser.add_argument("--predictor",
+                        choices=sorted(PREDICTORS), default="rls",
+                        help="Meditation level predictor, rls updates on every sample, arima refits once a minute")
+    parser.add_argument("--ingest",
+                        choices=["elements", "raw"], default="elements",
+                        help="Use the phone's band power elements, or compute band powers from the raw eeg stream")
+    parser.add_argument("--band_rate",
+                        type=float, default=10, help="Band power updates per second with --ingest raw")
+    parser.add_argument("--record",
+                        help="Append the received datagrams to this file, replay it with recording.py")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.WARNING,
                         format='%(asctime)s %(levelname)-8s %(message)s')
 
-    server = ThreadingOscUDPServer((args.ip, args.port))
+    server = AsyncOscUDPServer((args.ip, args.port), wire_format=args.wire_format,
+                               predictor=args.predictor, ingest=args.ingest, band_rate=args.band_rate,
+                               record=args.record)
     print("Serving on {}".format(server.server_address))
 
-    server.serve_forever()
-    self._stop.set()
+    asyncio.run(server.serve())
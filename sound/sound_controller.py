@@ -6,7 +6,7 @@ import argparse
 
 from threading import Thread
 from collections import defaultdict
-from common.rabbit_controller import RabbitController, MeditationStateCommand, HeartRateCommand
+from common.rabbit_controller import RabbitController, MeditationStateCommand, HeartRateCommand, decode_command
 
 
 class MindMurmurSoundScapeController(object):
@@ -88,7 +88,7 @@ class MindMurmurSoundScapeController(object):
 	def process_heart_rate_command(self, channel, method, properties, body):
 		logging.info(("received heart rate command with body \"{body}\"").format(body=body))
 
-		command = HeartRateCommand.from_string(body)
+		command = decode_command(body, properties, HeartRateCommand)
 
 		logging.info("parsing request to play heartbeat for current stage ({current_stage})".format(
 			current_stage=self.current_stage))
@@ -1,25 +1,26 @@
 import logging
 import time
-import math
 import numpy
 import os
-import re
+import random
+import argparse
 import threading
 import traceback
-import wx
 
-from fr0stlib import Flame
-from fr0stlib.render import save_image
-from fr0stlib.render import to_string as flame_to_string
-from fr0stlib.pyflam3 import Genome, byref, flam3_interpolate
+from fr0stlib import load_flames
 
 from eegsources import *
+from frame_timing import clock, frame_timings
 from common.rabbit_controller import RabbitController
-from input_controller import InputController
-from renderer import Renderer, RenderFrame
+from interpolation import FlameInterpolator, TransitionCache, easing_cubic
+from loops import LoopPlayer
+from palette_modulation import PaletteModulator, ColorPublisher
+from renderer import Renderer, render_funcs
 
 class MMEngine():
-    def __init__(self, eeg_source, gui):
+    # gui is a RenderFrame, or a HeadlessFrame to render without a display
+    # publish_colors sends the flame colour to the lights
+    def __init__(self, eeg_source, gui, publish_colors = True):
         print("[>] _INIT")
         self.eeg_source = eeg_source
         self.frame_index = 0
@@ -30,14 +31,14 @@ class MMEngine():
         self.maxfps = 60
         self.states_flames = []
         self.user_connected = False
+        # frames of the transitions between state flames, at the frame rate of the longest transition
+        self.transition_cache = TransitionCache(steps = 60 * self.maxfps)
 
         # init rabbitMQ connection
         self.rabbit = RabbitController('localhost', 5672, 'guest', 'guest', '/')
-
-        self.input_controller = InputController(self)
-
-        # attach keyboard events.
-        self.input_controller.bind_keyboardevents(self.gui)
+        self.color_publisher = ColorPublisher(self.rabbit) if publish_colors else None
+        # eeg driven colours of the displayed flame
+        self.palette_modulator = PaletteModulator()
 
         # reference to global or defined herebefore
         self.retreive_params()
@@ -46,6 +47,8 @@ class MMEngine():
         self.transition_pct = None
         self.transition_from = None
         self.transition_to = None
+        # holds the keyframes of the running transition
+        self.interpolator = None
         # sets the frame at which the user disconnected
         self.disconnected_at = None
 
@@ -56,22 +59,14 @@ class MMEngine():
         # Listen to meditation state events
         self.eeg_source.set_meditation_state_handler(self.set_meditation_state)
 
-    def run(self):
+    # frames stops the engine after that many frames, it runs until stopped when None
+    def run(self, frames = None):
         print("[>] RUNNING")
         self.keeprendering = True
-        current_second = math.floor(time.clock())
-        frames_this_second = 0
-        while self.keeprendering:
+        frames_run = 0
+        while self.keeprendering and (frames is None or frames_run < frames):
             # fps timer
-            t0 = time.clock()
-
-            # fps counting
-            latest_second = math.floor(time.clock())
-            if current_second != latest_second:
-                # rolled over into a new second, print FPS
-                #print("FPS: %d" % frames_this_second)
-                current_second = latest_second
-                frames_this_second = 0
+            t0 = clock()
 
             try:
                 if(self.user_connected):
@@ -91,32 +86,40 @@ class MMEngine():
                 traceback.print_exc()
                 self.keeprendering = False
             finally:
+                t1 = clock()
+                frame_timings.record('frame', t1 - t0, t1)
                 # sleep to keep a decent fps
-                delay = t0 + 1./self.maxfps - time.clock()
+                delay = t0 + 1./self.maxfps - t1
                 if delay > 0.:
                     time.sleep(delay)
-                frames_this_second += 1
+                frames_run += 1
         self.stop()
 
 
     def idle_frame(self):
         # read data
-        eegdata = self.eeg_source.read_data()
+        with frame_timings.stage('eeg_read'):
+            eegdata = self.eeg_source.read_data()
 
         # apply transition
-        self.apply_transition(duration_sec = 60)
+        with frame_timings.stage('transition'):
+            self.apply_transition(duration_sec = 60)
+
+        # the flame's own colours while idling
+        with frame_timings.stage('palette'):
+            self.modulate_palette(None)
 
         # no data
         if(eegdata is None or eegdata.is_empty() == True):
             # do nothing during 1 minute.
-            if(time.clock() > self.last_sincestate_reset + 60):
+            if(clock() > self.last_sincestate_reset + 60):
             # or transition to next state:
                 self.set_meditation_state(set_next=True)
 
         # data received
         else:
             # if inactive for more than 30 seconds
-            if(time.clock() > self.last_sincestate_reset + 30):
+            if(clock() > self.last_sincestate_reset + 30):
                 print("[ ] NEW SESSION")
                 self.retreive_params()
                 # back to state 1
@@ -129,10 +132,12 @@ class MMEngine():
     def user_connected_frame(self):
         # if flames were designed for transition,
         # update the running flame
-        self.apply_transition(duration_sec = 10 if self.meditation_state == 1 else 30)
+        with frame_timings.stage('transition'):
+            self.apply_transition(duration_sec = 10 if self.meditation_state == 1 else 30)
 
         # read data
-        eegdata = self.eeg_source.read_data()
+        with frame_timings.stage('eeg_read'):
+            eegdata = self.eeg_source.read_data()
 
         # data found
         if(eegdata is not None and eegdata.is_empty() == False):
@@ -140,12 +145,17 @@ class MMEngine():
             # [!] new meditation state reached
             if(self.meditation_state != eegdata.meditation_state \
                 # and if transitionned more than a minute ago
-                and time.clock() > self.last_sincestate_reset + 60):
+                and clock() > self.last_sincestate_reset + 60):
                 # [>] set new state
                 self.set_meditation_state(eegdata.meditation_state)
 
             # transform fractal with new values from data
-            self.animate(eegdata)
+            with frame_timings.stage('animate'):
+                self.animate(eegdata)
+
+            # and its colours
+            with frame_timings.stage('palette'):
+                self.modulate_palette(eegdata)
 
         # no data is found
         else:
@@ -153,14 +163,16 @@ class MMEngine():
             # go to idling.
             self.frame_index = 0
             self.frame_index_sincestate = 0
-            self.last_sincestate_reset = time.clock()
+            self.last_sincestate_reset = clock()
             self.user_connected = False
 
 
     def stop(self):
         print("[>] STOP")
         self.keeprendering = False
-        self.gui.image.renderer.keeprendering = False
+        if self.color_publisher is not None:
+            self.color_publisher.stop()
+        frame_timings.stop()
         self.gui.stop()
 
     def zoom(self, zoomamount = 1):
@@ -175,7 +187,7 @@ class MMEngine():
         # save state
         self.meditation_state = newstate
         self.frame_index_sincestate = 0
-        self.last_sincestate_reset = time.clock()
+        self.last_sincestate_reset = clock()
 
         # find appropriate flame
         flame_per_state = int(len(self.states_flames) / 5)
@@ -222,6 +234,7 @@ class MMEngine():
 
     # retreive the global fractal color from the current flame's xforms
     def get_flamecolor_rgb(self):
+        flame = self.palette_modulator.shown(self.flame)
         r,g,b, = 0,0,0
         weight = 0
         # read colors for each xform
@@ -248,8 +261,26 @@ class MMEngine():
 
         for flame in self.states_flames:
             flame.size = 960, 540
+
+        # precompute the transitions between state flames in the background
+        self.transition_cache.precompute(self.transition_pairs())
         return
 
+    # pairs of state flames, transitions between adjacent states first
+    def transition_pairs(self):
+        flame_per_state = int(len(self.states_flames) / 5)
+        state_flames = list(enumerate(self.states_flames[:flame_per_state * 5]))
+        pairs = []
+        for origin_index, origin in state_flames:
+            for target_index, target in state_flames:
+                if origin is target:
+                    continue
+                # states wrap around from 5 to 1
+                distance = abs(origin_index // flame_per_state - target_index // flame_per_state)
+                distance = min(distance, 5 - distance)
+                pairs.append((distance != 1, distance, origin_index, target_index, origin, target))
+        return [(origin, target) for (_, _, _, _, origin, target) in sorted(pairs)]
+
     def apply_transition(self, duration_sec = 10):
         if(self.transition_pct is not None and self.transition_from is not None and self.transition_to is not None):
             # do the transition
@@ -279,15 +310,10 @@ class MMEngine():
             elif(lerp >= 1.0 or flame_origin is None):
                 loaded_flame = flame_target
             else:
-                # interpolation:
-                flame_origin.time = 0
-                flame_target.time = 1
-                flames_lerp = [flame_origin, flame_target]
-                flames_str = "<flames>%s</flames>" % "".join(map(flame_to_string, flames_lerp))
-                genomes, ngenomes = Genome.from_string(flames_str)
-                targetflame = Genome()
-                flam3_interpolate(genomes, ngenomes, lerp, 0, byref(targetflame))
-                loaded_flame = Flame(targetflame.to_string())
+                # interpolation, keyframes are read once per transition
+                if(self.interpolator is None or not self.interpolator.interpolates(flame_origin, flame_target)):
+                    self.interpolator = FlameInterpolator(flame_origin, flame_target, self.transition_cache)
+                loaded_flame = self.interpolator.interpolate(lerp)
 
         except Exception as ex:
             print('[!] error during interpolation at %s: %s' %(lerp, str(ex)))
@@ -342,8 +368,17 @@ class MMEngine():
             # SHOW preview on Fr0st
             return False
 
+    # modulate the palette of the displayed flame with the eeg data,
+    # and send its colour to the lights now and then
+    def modulate_palette(self, eegdata):
+        self.palette_modulator.modulate(self.flame, eegdata)
+        now = clock()
+        if self.color_publisher is not None and self.color_publisher.due(now):
+            self.color_publisher.update(self.get_flamecolor_rgb(), now)
+
     def render(self):
-        self.gui.render(self.flame)
+        # the flame with its modulated palette, the flame and the keyframes keep theirs
+        self.gui.render(self.palette_modulator.shown(self.flame))
 
 
 def get_flames():
@@ -352,37 +387,52 @@ def get_flames():
 
 def open_flame(path):
     if os.path.exists(path):
-        return [Flame(s) for s in load_flamestrings(path)]
+        return load_flames(path)
     else:
         raise FileNotFoundError(path)
 
 
-def split_flamestrings(string):
-    return re.findall(r'<flame .*?</flame>', string, re.DOTALL)
-
-
-def load_flamestrings(filename):
-    """Reads a flame file and returns a list of flame strings."""
-    return split_flamestrings(open(filename).read())
-
-
-def easing_sine(percent, minvalue = 0, maxvalue = 1):
-	return -(maxvalue - minvalue)/2 * (math.cos(math.pi*percent) - 1) + minvalue
-
-
-def easing_cubic(percent, minvalue = 0, maxvalue = 1):
-    percent *= 2.
-    if(percent < 1) : return ((maxvalue - minvalue) / 2.) * percent * percent * percent + minvalue
-    percent -= 2
-    return ((maxvalue - minvalue) / 2.) * (percent * percent * percent + 2) + minvalue
-
-
 # RUN
+parser = argparse.ArgumentParser(description="Mind Murmur visuals")
+parser.add_argument("--headless",
+                    action="store_true", help="Render without a display, to --output")
+parser.add_argument("--backend",
+                    choices=sorted(render_funcs), help="Renderer, flam4 (cuda) by default, flam3 (cpu) when headless")
+parser.add_argument("--size",
+                    default="640x360", help="Headless frame size, WIDTHxHEIGHT")
+parser.add_argument("--output",
+                    help="Headless frames: a directory of pngs, a .rgba file or - for raw rgba on stdout, kept in memory if unset")
+parser.add_argument("--drop_frames",
+                    action="store_true", help="Headless: drop frames rendered slower than the frame rate, as on display")
+parser.add_argument("--frames",
+                    type=int, help="Stop after that many frames")
+parser.add_argument("--eeg",
+                    default="rabbitmq", help="EEG source: rabbitmq, dummy, or a Muse JSON or NumPy recording")
+parser.add_argument("--seed",
+                    type=int, help="Random seed, for reproducible runs")
+parser.add_argument("--timings_csv",
+                    help="Dump every frame timing to this CSV file")
+parser.add_argument("--fixed_quality",
+                    action="store_true", help="Render at full quality instead of adapting it to hold the frame rate, always headless without --drop_frames")
+parser.add_argument("--no_lights",
+                    action="store_true", help="Do not send the flame colour to the lights over rabbitMQ")
+parser.add_argument("--loops",
+                    help="Play the loops pre-rendered to this directory by loops.py instead of rendering flames")
+args = parser.parse_args()
+
+if args.headless:
+    from headless import HeadlessFrame, open_sink
+    # opened first, frames on stdout take it over before anything is printed
+    sink = open_sink(args.output)
+
 print('[$] - BEGIN SCRIPT -')
+if args.seed is not None:
+    numpy.random.seed(args.seed)
+    random.seed(args.seed)
+
 #audio_folder = get_scriptpath() + "/mindmurmur/sounds_controllers/sound_controller_demo_files/soundscape_controller_demo_files"
 # 1 - Dummy DATA
 # eeg = EEGDummy()
-eeg = EEGFromRabbitMQ('localhost', 5672, 'guest', 'guest', '/')
 # audio = get_audio_source(get_scriptpath() + '/mindmurmur/audio/midnightstar_crop.wav')
 # eeg = EEGFromAudio(audio)
 # 2 - DATA from json file
@@ -390,17 +440,56 @@ eeg = EEGFromRabbitMQ('localhost', 5672, 'guest', 'guest', '/')
 # eeg = EEGFromJSONFile(get_scriptpath() + '/mindmurmur/data/Muse-B1C1_2018-06-10--18-35-09_1528670624296.json') # medium
 # eeg = EEGFromJSONFile(get_scriptpath() + '/mindmurmur/data/Muse-B1C1_2018-07-16--07-24-35_1531745297756.json') # large (16 july)
 #eeg = EEGFromJSONFile(get_scriptpath() + '/mindmurmur/data/Muse-B1C1_2018-07-17--07-00-11_1531868655676.json') # large (17 july)
-
-app = wx.App(False)
-
-renderer = Renderer()
-frame = RenderFrame(None, renderer)
-#engine = MMEngine(eeg, frame, audio_folder)
-engine = MMEngine(eeg, frame)
-
-engine_thread = threading.Thread(target=engine.run)
-engine_thread.daemon = True
-engine_thread.start()
-
-app.MainLoop()
-print('[x] - END SCRIPT -')
\ No newline at end of file
+if args.eeg == 'rabbitmq':
+    eeg = EEGFromRabbitMQ('localhost', 5672, 'guest', 'guest', '/')
+elif args.eeg == 'dummy':
+    eeg = EEGDummy()
+elif args.eeg.endswith('.npy'):
+    eeg = EEGFromNumpyFile(args.eeg)
+else:
+    eeg = EEGFromJSONFile(args.eeg)
+
+# per stage frame timings, served as JSON on http://localhost:8090/
+frame_timings.serve_http()
+if args.timings_csv:
+    frame_timings.dump_csv(args.timings_csv)
+
+if args.headless and args.loops:
+    # the loops are played at the size they were rendered at
+    engine = LoopPlayer(eeg, args.loops)
+    frame = HeadlessFrame(engine, engine.size, sink)
+    engine.run(frame.render_complete, args.frames)
+    frame.stop()
+elif args.headless:
+    width, height = map(int, args.size.split('x'))
+    # frames waited for are all rendered at full quality, comparable whatever the render speed
+    renderer = Renderer(args.backend or 'flam3', adaptive_quality = args.drop_frames and not args.fixed_quality)
+    frame = HeadlessFrame(renderer, (width, height), sink, wait = not args.drop_frames)
+    engine = MMEngine(eeg, frame, publish_colors = not args.no_lights)
+    engine.run(args.frames)
+else:
+    import wx
+    from input_controller import InputController
+    from render_frame import RenderFrame
+
+    app = wx.App(False)
+
+    if args.loops:
+        engine = LoopPlayer(eeg, args.loops)
+        frame = RenderFrame(None, engine)
+        engine_args = (frame.image.render_complete, args.frames)
+    else:
+        renderer = Renderer(args.backend or 'flam4', adaptive_quality = not args.fixed_quality)
+        frame = RenderFrame(None, renderer)
+        #engine = MMEngine(eeg, frame, audio_folder)
+        engine = MMEngine(eeg, frame, publish_colors = not args.no_lights)
+        engine_args = (args.frames,)
+    # attach keyboard events.
+    engine.input_controller = InputController(engine)
+    engine.input_controller.bind_keyboardevents(frame)
+
+    engine_thread = threading.Thread(target=engine.run, args=engine_args)
+    engine_thread.daemon = True
+    engine_thread.start()
+
+    app.MainLoop()
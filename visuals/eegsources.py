@@ -1,48 +1,106 @@
 import random
 import numpy as np
 import json
+import os
 import threading
 
-from common.rabbit_controller import RabbitController
+from common.rabbit_controller import RabbitController, EEGDataCommand, decode_command
+
+SMOOTHING_WINDOW = 10  # samples averaged by the smoothers
+
+
+class EEGData(object):
+    """An eegdata frame: 5 waves * n channels + blink + meditation state, held in one array."""
+    __slots__ = ('values', 'channels', 'waves', 'blink', 'meditation_state')
 
-class EEGData():
     # inline values
     def __init__(self, values):
 
         if(values is None):
             values = [0,0,0,0,0,0,0]
-        self.values = values
+        self.values = np.array(values, dtype=np.float64)
         # 5 waves * n channels + blink + med_state
-        self.channels = (len(values)-2) / 5
-        # each waves is average of 4 channels
-        self.alpha = np.mean(values[self.channels * 0 : self.channels * 1])
-        self.beta  = np.mean(values[self.channels * 1 : self.channels * 2])
-        self.gamma = np.mean(values[self.channels * 2 : self.channels * 3])
-        self.delta = np.mean(values[self.channels * 3 : self.channels * 4])
-        self.theta = np.mean(values[self.channels * 4 : self.channels * 5])
-        self.raw_waves = values[0 : self.channels * 5]
+        self.channels = (len(self.values) - 2) // 5
+        # each wave is the average of its channels
+        self.waves = self.values[:self.channels * 5].reshape(5, self.channels).mean(axis=1)
 
         # blink is 0 or 1
-        self.blink = values[-2]
+        self.blink = self.values[-2]
         # meditation_state is a value between 0 and 1
-        self.meditation_state = int(values[-1])
+        self.meditation_state = int(self.values[-1])
+
+    @property
+    def alpha(self):
+        return self.waves[0]
+
+    @property
+    def beta(self):
+        return self.waves[1]
+
+    @property
+    def gamma(self):
+        return self.waves[2]
+
+    @property
+    def delta(self):
+        return self.waves[3]
+
+    @property
+    def theta(self):
+        return self.waves[4]
 
-        # sum of the 5 waves
-        self.waves = [self.alpha, self.beta, self.gamma, self.delta, self.theta]
+    @property
+    def raw_waves(self):
+        return self.values[:self.channels * 5]
 
     def is_empty(self):
-        any_value = False
-        for freq in self.waves:
-            if(freq != 0.0):
-                any_value = True
-                break
-        # print("[?] EEG %s EMPTY: %s" %("NOT" if any_value else "IS", self.console_string()))
-        return not any_value
+        return not self.waves.any()
 
     def console_string(self):
         return "".join(format(int(wav*10)) for wav in self.waves) + " - " + format(round(self.meditation_state,1))
 
 
+class BoxcarSmoother(object):
+    """Mean of the last `window` samples, kept as a running sum so each sample costs O(channels)."""
+    def __init__(self, window=SMOOTHING_WINDOW):
+        self.window = window
+        self.samples = None
+        self.sum = None
+        self.count = 0
+
+    def update(self, values):
+        if self.samples is None or self.samples.shape[1] != len(values):
+            self.samples = np.zeros((self.window, len(values)))
+            self.sum = np.zeros(len(values))
+            self.count = 0
+        slot = self.count % self.window
+        self.sum += values - self.samples[slot]
+        self.samples[slot] = values
+        self.count += 1
+        if slot == self.window - 1:
+            # resync once per window, so rounding errors of the running sum do not accumulate
+            self.sum = self.samples.sum(axis=0)
+        return self.sum / min(self.count, self.window)
+
+
+class EMASmoother(object):
+    """Exponential moving average, with the same mean sample age as a boxcar of `window` samples."""
+    def __init__(self, window=SMOOTHING_WINDOW):
+        self.rate = 2.0 / (window + 1)
+        self.mean = None
+
+    def update(self, values):
+        if self.mean is None or len(self.mean) != len(values):
+            self.mean = np.array(values, dtype=np.float64)
+        else:
+            self.mean += self.rate * (values - self.mean)
+        return self.mean
+
+
+SMOOTHERS = {'boxcar': BoxcarSmoother,
+             'ema': EMASmoother}
+
+
 class EEGSource(object):
     def __init__(self):
         self.channels = 4
@@ -50,18 +108,21 @@ class EEGSource(object):
         # 4 channels x 5 waves
         # + blink = 21
         self.raw_data = [0.0] * 21
-        self.data_history = []
+        self.latest_sample = None
+        self.smooth_data = None
+        self.set_smoothing('boxcar', SMOOTHING_WINDOW)
+
+    # smoothing is 'boxcar' (mean of the last window samples) or 'ema'
+    def set_smoothing(self, smoothing, window):
+        self.smoother = SMOOTHERS[smoothing](window)
 
     def read_data(self):
-        # add new EEGdata to history
+        # add new EEGdata to the smoother
         data = self.read_new_data()
         if (data is not None):
-            # append data to history
-            self.data_history.append(data)
-        # pop data to save memory
-        if(len(self.data_history) > 10):
-            self.data_history.pop(0)
-        # and return it
+            self.latest_sample = data
+            self.smooth_data = EEGData(self.smoother.update(data.values))
+        # and return the smoothed data
         return self.get_smooth_data()
 
     # read_new_data is an abstract method to implement
@@ -70,26 +131,13 @@ class EEGSource(object):
     def read_new_data(self):
         return EEGData(self.raw_data)
 
-    # returns the latest data from source history
+    # returns the latest data read from source
     def get_data(self):
-        if(self.data_history is None or len(self.data_history) == 0):
-            return None
-        return self.data_history[-1]
+        return self.latest_sample
 
-    # returns an average data from 10 last bitd in history
+    # returns the data smoothed over the last samples, None until a sample is read
     def get_smooth_data(self):
-        if(self.data_history is None or len(self.data_history) == 0):
-            return None
-        last_elements = len(self.data_history)
-        if last_elements > 10 : last_elements = 10
-        lastvalues = []
-
-        for data in self.data_history[-last_elements:]:
-            lastvalues.append(data.values)
-        avgvalues = []
-        for i in range(len(lastvalues[0])):
-            avgvalues.append(sum(values[i] for values in lastvalues) / len(lastvalues))
-        return EEGData(avgvalues)
+        return self.smooth_data
 
     # let meditation state handler be set, by default does nothing
     def set_meditation_state_handler(self, handler):
@@ -123,49 +171,83 @@ class EEGDummy(EEGSource):
         return EEGData(self.raw_data)
 
 
-class EEGFromJSONFile(EEGSource):
+# muse recording series making up an eeg sample, in the bus eegdata layout
+MUSE_JSON_SERIES = ['alpha_absolute', 'beta_absolute', 'gamma_absolute', 'delta_absolute', 'theta_absolute', 'blink']
+
+
+def convert_muse_json(json_path, npy_path=None):
+    """Converts a Muse JSON recording to a NumPy file of one row per sample.
+
+    Rows hold the band powers, the blink and a zero meditation state, like the
+    eegdata frames of the bus. Returns the path of the NumPy file.
+    """
+    if npy_path is None:
+        npy_path = os.path.splitext(json_path)[0] + '.npy'
+    with open(json_path) as f:
+        timeseries = json.load(f)['timeseries']
+    series = [np.asarray(timeseries[name]['samples'], dtype=np.float64) for name in MUSE_JSON_SERIES]
+    # the series of a recording may end a few samples apart: like the replay did before conversion,
+    # keep the samples every series has, up to the alpha_relative timestamps when recorded
+    lengths = [len(values) for values in series]
+    if 'alpha_relative' in timeseries:
+        lengths.append(len(timeseries['alpha_relative']['timestamps']))
+    sample_length = min(lengths)
+    samples = np.column_stack([values[:sample_length] for values in series])
+    samples = np.column_stack([samples, np.zeros(len(samples))])
+    # written aside and moved in place, an interrupted conversion leaves no truncated file behind
+    tmp_path = npy_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, samples)
+    if os.path.exists(npy_path):
+        os.remove(npy_path)
+    os.rename(tmp_path, npy_path)
+    return npy_path
+
+
+class EEGFromNumpyFile(EEGSource):
+    """Replays a recording converted by convert_muse_json.
+
+    The file is memory mapped and EEGData built one sample at a time, so
+    opening is instant and memory use does not grow with the recording length.
+    """
     def __init__(self, filepath):
-        super(EEGFromJSONFile, self).__init__()
-        print('EEGFromJSONFile Started: ' + filepath)
-        # open json file
-        self.sample_length = 0
+        super(EEGFromNumpyFile, self).__init__()
+        print('EEGFromNumpyFile Started: ' + filepath)
+        self.samples = np.load(filepath, mmap_mode='r')
+        self.sample_length = len(self.samples)
         self.sample_index = 0
-
-        try:
-            with open(filepath) as f:
-                json_data = json.load(f)
-                print('file loaded')
-
-                self.sample_length = len(json_data['timeseries']['alpha_relative']['timestamps'])
-                print(str(self.sample_length) + ' samples found')
-
-                self.channels = json_data['meta_data']['config'][0]['eeg_channel_count']
-                print(str(self.channels) + ' channels found')
-
-                self.raw_data = []
-
-                for i in range(self.sample_length):
-                    eeg_sample_data = (json_data['timeseries']['alpha_absolute']['samples'][i] +
-                                       json_data['timeseries']['beta_absolute' ]['samples'][i] +
-                                       json_data['timeseries']['gamma_absolute']['samples'][i] +
-                                       json_data['timeseries']['delta_absolute']['samples'][i] +
-                                       json_data['timeseries']['theta_absolute']['samples'][i] +
-                                       json_data['timeseries']['blink']['samples'][i])
-                    self.raw_data.append(EEGData(eeg_sample_data))
-        except Exception as jsonex:
-            print('error during loading JSON: ' + str(jsonex))
+        print(str(self.sample_length) + ' samples found')
+        self.channels = (self.samples.shape[1] - 2) // 5
+        print(str(self.channels) + ' channels found')
 
     # iterate samples
     def read_new_data(self):
+        if(self.sample_length == 0):
+            return None
         if(self.sample_index >= self.sample_length):
-            print("SAMPLE JSON file is over. Restart")
+            print("SAMPLE file is over. Restart")
             self.sample_index = 0
 
-        sample_data = self.raw_data[self.sample_index]
+        sample_data = EEGData(self.samples[self.sample_index].tolist())
         self.sample_index += 1
 
         return sample_data
 
+
+class EEGFromJSONFile(EEGFromNumpyFile):
+    """Replays a Muse JSON recording.
+
+    The first run converts it to a NumPy file next to it (see convert_muse_json),
+    later runs map that file directly, as long as it is newer than the recording.
+    """
+    def __init__(self, filepath):
+        print('EEGFromJSONFile Started: ' + filepath)
+        npy_path = os.path.splitext(filepath)[0] + '.npy'
+        if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(filepath):
+            print('converting JSON file to ' + npy_path)
+            convert_muse_json(filepath, npy_path)
+        super(EEGFromJSONFile, self).__init__(npy_path)
+
 class EEGFromRabbitMQ(EEGSource):
     def __init__(self, host, port, user, password, virtualhost):
         super(EEGFromRabbitMQ, self).__init__()
@@ -193,8 +275,8 @@ class EEGFromRabbitMQ(EEGSource):
     def rabbitcallback(self, ch, method, properties, body):
         if(body is None or body == ''):
             return
-        command = json.loads(body)
-        self.latest_data = EEGData(command['Values'])
+        command = decode_command(body, properties, EEGDataCommand)
+        self.latest_data = EEGData(command.get_values())
         # print("received latest EEG Data: %s" %(repr(command['Values'])))
     # iterate samples
     def read_new_data(self):
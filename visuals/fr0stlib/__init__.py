@@ -20,7 +20,7 @@
 #  Boston, MA 02111-1307, USA.
 ##############################################################################
 import os, sys, shutil, random, itertools, ctypes, collections, re, numpy, \
-       colorsys
+       colorsys, binascii
 import xml.etree.cElementTree as etree
 from math import *
 from functools import partial
@@ -291,8 +291,6 @@ class Flame(object):
 
 
 class Palette(object):
-    _template = "%c%c%c" * 256
-    
     def __init__(self, element=None):
         self.data = numpy.zeros((256, 3), dtype=numpy.uint8)
         if element is not None:
@@ -320,7 +318,8 @@ class Palette(object):
 
 
     def to_buffer(self):
-        return self._template % tuple(int(i) for i in itertools.chain(*self))
+        """The 256 rgb entries as a string of 768 bytes."""
+        return numpy.ascontiguousarray(self.data, dtype=numpy.uint8).tostring()
 
 
     def from_flame_element(self, flame):
@@ -335,68 +334,71 @@ class Palette(object):
                 raise ParsingError('Only rgb palettes are currently supported')
 
             lst = re.findall('[a-f0-9]{2}', palette_element.text, re.I)
-            data = zip(*[(int(i, 16) for i in lst)]*3)            
+            data = numpy.fromstring(binascii.unhexlify(''.join(lst)),
+                                    dtype=numpy.uint8)
         else:
-            # parse flam3-style palette (list of <color> elements)
-            data = [map(float, color.get('rgb').split())
-                    for color in flame.findall('color')]
-            
-        if len(data) != 256:
+            # parse flam3-style palette (list of <color> elements), all the
+            # rgb triplets are converted in one go.
+            data = numpy.fromstring(' '.join(color.get('rgb') for color in
+                                             flame.findall('color')), sep=' ')
+
+        if len(data) != 256 * 3:
             raise ParsingError('Wrong number of palette entries specified: '
-                               '%s != %s' % (256, len(lst)))
-        self.data[:] = data
+                               '%s != %s' % (256, len(data) // 3))
+        self.data[:] = data.reshape(256, 3)
 
 
+    # The transforms work on the whole palette as arrays and change data in
+    # place, so palettes can be animated every frame.
     def reverse(self):
-        self.data = numpy.array(self.data[::-1], dtype=numpy.uint8)
+        self.data[:] = self.data[::-1]
 
 
     def rotate(self, index):
-        self.data = numpy.array(list(self.data[-index:]) +
-                                list(self.data[:-index]), dtype=numpy.uint8)
+        self.data[:] = numpy.roll(self.data, index, axis=0)
 
 
     def hue(self, value):
-        value = value/360.0
-        for i in xrange(256):
-            h,l,s = rgb2hls(self.data[i])
-            h = (h + value) % 1
-            rgb = hls2rgb((h,l,s))
-            self.data[i] = hls2rgb((h,l,s))
+        hls = rgb2hls_array(self.data)
+        hls[:, 0] += value/360.0
+        hls[:, 0] %= 1
+        self.data[:] = hls2rgb_array(hls)
 
             
     def saturation(self, value):
-        value = value/100.0
-        for i in xrange(256):
-            h,l,s = rgb2hls(self.data[i])
-            s = max(0, min(1, s + value))
-            self.data[i] = hls2rgb((h,l,s))
+        hls = rgb2hls_array(self.data)
+        numpy.clip(hls[:, 2] + value/100.0, 0, 1, out=hls[:, 2])
+        self.data[:] = hls2rgb_array(hls)
 
             
     def brightness(self, value):
-        value = value/100.0
-        for i in xrange(256):
-            h,l,s = rgb2hls(self.data[i])
-            l = max(0, min(1, l + value))
-            self.data[i] = hls2rgb((h,l,s))
+        hls = rgb2hls_array(self.data)
+        numpy.clip(hls[:, 1] + value/100.0, 0, 1, out=hls[:, 1])
+        self.data[:] = hls2rgb_array(hls)
 
             
     def invert(self):
-        self.data = 255 - self.data
+        numpy.subtract(255, self.data, out=self.data)
 
 
     def from_seeds(self, seeds, curve='cos'):
-        ns = len(seeds)
-        d = 256/ns
-        r = 256%ns
-        gen = []
-        for i in xrange(ns):
-            ds = d + (i < r)
-            start, end = seeds[i-1], seeds[i]
-            for j in xrange(ds):
-                hsv = pblend_color(start, end, j/float(ds), curve)
-                gen.append(hsv2rgb(hsv))
-        self.data = numpy.array(gen, dtype=numpy.uint8)
+        """Blends the hsv seeds into a gradient, like pblend_color from each
+        seed to the next, with 256/len(seeds) entries per blend."""
+        ends = numpy.array(seeds, dtype=numpy.float64).reshape(-1, 3)
+        starts = numpy.roll(ends, 1, axis=0)
+        # wrap hue around 1.0 if necessary
+        h1, h2 = starts[:, 0], ends[:, 0]
+        h1 += h1 < h2 - .5
+        h2 += h2 < h1 - .5
+        ns = len(ends)
+        d, r = divmod(256, ns)
+        counts = d + (numpy.arange(ns) < r)
+        blend = numpy.repeat(numpy.arange(ns), counts)
+        first = numpy.cumsum(counts) - counts
+        t = (numpy.arange(256) - first[blend]) / counts[blend].astype(numpy.float64)
+        t = pblend_curve(t, curve)[:, numpy.newaxis]
+        start = starts[blend]
+        self.data[:] = hsv2rgb_array(start + (ends[blend] - start) * t)
 
 
     def random(self, hue=(0,1), saturation=(0,1), value=(0,1),  nodes=(5,5),
@@ -519,8 +521,9 @@ class Xform(object):
                 self.post = PostXform(self,
                                       screen_coefs=map(float, post.split()))
 
-        # Convert from screen to complex plane orientation
-        self.coefs = self.screen_coefs
+        # Convert from screen to complex plane orientation. Same as
+        # self.coefs = self.screen_coefs, without the property arrays.
+        self.b, self.d, self.f = -self.b, -self.d, -self.f
 
 
     def to_string(self):
@@ -721,11 +724,14 @@ class Xform(object):
         self.e *= v
 
         
+    # The rotations and move are done on the coefficients directly. Going
+    # through xp, yp and op builds several property arrays per call, which
+    # adds up when xforms are animated every frame.
     def rotate_x(self, deg):
-        self.xp += (0, deg)
+        self.a, self.d = rotated((self.a, self.d), deg)
         
     def rotate_y(self, deg):
-        self.yp += (0, deg)
+        self.b, self.e = rotated((self.b, self.e), deg)
 
     def rotate(self, deg, pivot=None):
         self.rotate_x(deg)
@@ -736,8 +742,13 @@ class Xform(object):
         
     # TODO: this function looks useless and unused
     def move(self, v):
-        self.op = (self.op[0] + v, self.op[1])
-        #self.op += (v, 0)
+        """Moves the offset away from the origin by v, like
+        self.op = (self.op[0] + v, self.op[1])."""
+        l = hypot(self.c, self.f)
+        if l:
+            self.c, self.f = self.c * (l + v) / l, self.f * (l + v) / l
+        else:
+            self.c, self.f = v, 0.0
 
 
     def orbit(self, deg, pivot=(0, 0)):
@@ -883,19 +894,117 @@ def save_flames(path, *flames):
         f.write("""</flames>""")
 
 
+def flame_offsets(string):
+    """Returns the (start, end) offsets of the flame elements in a string,
+    found with plain substring searches instead of parsing the xml."""
+    offsets = []
+    start = string.find('<flame ')
+    while start != -1:
+        end = string.find('</flame>', start)
+        if end == -1:
+            break
+        end += len('</flame>')
+        offsets.append((start, end))
+        start = string.find('<flame ', end)
+    return offsets
+
+
 def split_flamestrings(string):
-    return re.findall(r'<flame .*?</flame>', string, re.DOTALL)
+    return [string[start:end] for start, end in flame_offsets(string)]
 
 
 def load_flamestrings(filename):
     """Reads a flame file and returns a list of flame strings."""
-    return split_flamestrings(open(filename).read())
+    return FlameLibrary(filename).flamestrings()
+
+
+def iter_flames(filename):
+    """Parses a flame file incrementally, yielding one flame object at a
+    time. Elements are freed once converted, so memory does not grow with
+    the size of the file."""
+    for event, element in etree.iterparse(filename):
+        if element.tag == 'flame':
+            yield Flame().from_element(element)
+            element.clear()
 
 
 def load_flames(filename):
-    """Reads a flame file and returns a list of flame objects."""
-    tree = etree.parse(open(filename))
-    return [Flame().from_element(e) for e in tree.findall('flame')]
+    """Reads a flame file and returns a list of flame objects. The parsed
+    flames are cached next to the file, see flamecache."""
+    from fr0stlib.flamecache import open_cache, write_cache
+    cache = open_cache(filename)
+    if cache is not None:
+        return [cache.flame(i) for i in xrange(len(cache))]
+    flames = list(iter_flames(filename))
+    write_cache(filename, flames)
+    return flames
+
+
+class FlameLibrary(object):
+    """The flames of a file, parsed on access.
+
+    Opening the file only indexes the byte offsets of its flames. A flame
+    object is built the first time it's accessed and kept from then on, so
+    libraries with thousands of flames can be browsed without parsing all
+    of them up front. When the file has a valid cache (see flamecache),
+    flames are built from it and the file itself is only read for its
+    flame strings."""
+    _re_name = re.compile(r'\sname="([^"]*)"')
+
+    def __init__(self, filename):
+        from fr0stlib.flamecache import open_cache
+        self.filename = filename
+        self.cache = open_cache(filename)
+        self._data = self._offsets = None
+        self._flames = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.filename, 'rb') as f:
+                self._data = f.read()
+        return self._data
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = flame_offsets(self.data)
+        return self._offsets
+
+    def __len__(self):
+        if self.cache is not None:
+            return len(self.cache)
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        flame = self._flames.get(index)
+        if flame is None:
+            if self.cache is not None:
+                flame = self.cache.flame(index)
+            else:
+                flame = Flame(self.flamestring(index))
+            self._flames[index] = flame
+        return flame
+
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+
+    def flamestring(self, index):
+        start, end = self.offsets[index]
+        return self.data[start:end]
+
+    def flamestrings(self):
+        return [self.data[start:end] for start, end in self.offsets]
+
+    def name(self, index):
+        """Reads the name of a flame from its header, without parsing it."""
+        start = self.offsets[index][0]
+        match = self._re_name.search(self.data, start, self.data.find('>', start))
+        return match.group(1) if match else "Untitled"
 
 
 def show_status(s):
@@ -925,6 +1034,14 @@ def rect(coord):
     return real, imag
 
 
+def rotated(coord, deg):
+    """Rotates a vector by deg, same as rect of its polar form turned by deg."""
+    x, y = coord
+    theta = deg*pi/180.0
+    c, s = cos(theta), sin(theta)
+    return x*c - y*s, x*s + y*c
+
+
 def rgb2hls(color):
     """Takes an rgb tuple (0-255) and returns hls tuple (hls is scalar)"""
     return colorsys.rgb_to_hls(*(x/255. for x in color))
@@ -943,6 +1060,78 @@ def hsv2rgb((h, s, v)):
     return tuple(int(x*255) for x in colorsys.hsv_to_rgb(h,s,v))
 
 
+def rgb2hls_array(rgb):
+    """Takes an (n, 3) array of rgb colors (0-255) and returns an (n, 3)
+    array of hls, like rgb2hls on each color."""
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.
+    r, g, b = rgb.T
+    maxc, minc = rgb.max(axis=1), rgb.min(axis=1)
+    l = (minc + maxc) / 2.0
+    delta = maxc - minc
+    gray = delta == 0
+    delta_safe = numpy.where(gray, 1.0, delta)
+    s = numpy.where(l <= 0.5,
+                    delta / numpy.where(gray, 1.0, maxc + minc),
+                    delta / numpy.where(gray, 1.0, 2.0 - maxc - minc))
+    rc, gc, bc = (maxc - rgb.T) / delta_safe
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    return numpy.column_stack((numpy.where(gray, 0.0, (h / 6.0) % 1.0), l,
+                               numpy.where(gray, 0.0, s)))
+
+
+def _hls_value(m1, m2, hue):
+    hue = hue % 1.0
+    return numpy.select((hue < 1/6.0, hue < 0.5, hue < 2/3.0),
+                        (m1 + (m2 - m1) * hue * 6.0, m2,
+                         m1 + (m2 - m1) * (2/3.0 - hue) * 6.0), m1)
+
+
+def hls2rgb_array(hls):
+    """Takes an (n, 3) array of hls colors and returns an (n, 3) uint8 array
+    of rgb, like hls2rgb on each color."""
+    h, l, s = numpy.asarray(hls, dtype=numpy.float64).T
+    m2 = numpy.where(l <= 0.5, l * (1.0 + s), l + s - (l * s))
+    m1 = 2.0 * l - m2
+    rgb = numpy.column_stack((_hls_value(m1, m2, h + 1/3.0),
+                              _hls_value(m1, m2, h),
+                              _hls_value(m1, m2, h - 1/3.0)))
+    rgb = numpy.where((s == 0.0)[:, numpy.newaxis], l[:, numpy.newaxis], rgb)
+    return numpy.clip(rgb * 255, 0, 255).astype(numpy.uint8)
+
+
+def rgb2hsv_array(rgb):
+    """Takes an (n, 3) array of rgb colors (0-255) and returns an (n, 3)
+    array of hsv, like rgb2hsv on each color."""
+    rgb = numpy.asarray(rgb, dtype=numpy.float64) / 255.
+    r, g, b = rgb.T
+    maxc = rgb.max(axis=1)
+    delta = maxc - rgb.min(axis=1)
+    safe_max = numpy.where(maxc > 0, maxc, 1)
+    safe_delta = numpy.where(delta > 0, delta, 1)
+    rc, gc, bc = (maxc - rgb.T) / safe_delta
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = numpy.where(delta > 0, (h / 6.0) % 1.0, 0.0)
+    return numpy.column_stack((h, delta / safe_max, maxc))
+
+
+def hsv2rgb_array(hsv):
+    """Takes an (n, 3) array of hsv colors and returns an (n, 3) uint8 array
+    of rgb, like hsv2rgb on each color."""
+    h, s, v = numpy.asarray(hsv, dtype=numpy.float64).T
+    i = numpy.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.astype(int) % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    rgb = numpy.column_stack((numpy.choose(i, (v, q, p, p, t, v)),
+                              numpy.choose(i, (t, v, v, q, p, p)),
+                              numpy.choose(i, (p, p, t, v, v, q))))
+    return numpy.clip(rgb * 255, 0, 255).astype(numpy.uint8)
+
+
 def pblend(s, e, i, curve='linear'):
     """
     s = starting value
@@ -966,6 +1155,18 @@ def pblend(s, e, i, curve='linear'):
         raise ValueError('invalid curve')
 
 
+def pblend_curve(i, curve='linear'):
+    """The blend factors of pblend for an array of i."""
+    if curve == 'linear':
+        return i
+    elif curve == 'cos':
+        return 0.5 * (numpy.cos((i+1)*pi)+1)
+    elif curve == 'cubic':
+        return 3*i*i - 2*i*i*i
+    else:
+        raise ValueError('invalid curve')
+
+
 def pblend_vector(start, end, i, curve='linear'):
     if i == 0:
         return start
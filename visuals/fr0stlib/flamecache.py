@@ -0,0 +1,254 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+"""Binary sidecar cache of parsed flame files.
+
+A flame file parsed once is saved next to it, in <file>.cache, as numpy
+arrays: the affine and post coefficients, the numeric xform attributes
+(variation weights and parameters) as name index / value pairs, with a flag
+for the integer ones, chaos
+values and the 256x3 palettes. The remaining flame and xform attributes,
+mostly strings, are kept as a small json blob per flame.
+
+Loading memory-maps the cache and builds flames from the arrays on access,
+without any xml. The cache records the path, size and mtime of the flame
+file, and is ignored as soon as they don't match anymore."""
+import os, json, struct, tempfile, numpy
+
+import fr0stlib
+from fr0stlib import Flame, Xform, Chaos
+
+MAGIC = "FR0STIDX"
+CACHE_VERSION = 2
+_COEFS = ('a', 'd', 'b', 'e', 'c', 'f')
+# Xform attributes that are not stored as values.
+_XFORM_SKIP = set(('_parent', 'chaos', 'post') + _COEFS)
+_ALIGN = 16
+
+
+def cache_path(filename):
+    return filename + ".cache"
+
+
+def _source_key(filename):
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime
+
+
+def _is_number(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+
+def _to_str(obj):
+    """json returns unicode, attributes parsed from xml are str."""
+    if type(obj) is float:
+        return obj
+    if isinstance(obj, unicode):
+        try:
+            return str(obj)
+        except UnicodeEncodeError:
+            return obj
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.iteritems())
+    return obj
+
+
+def write_cache(filename, flames):
+    """Saves the parsed flames of filename to its sidecar cache. Returns
+    False when the cache can't be written, e.g. in a read-only directory."""
+    names, name_index = [], {}
+    xform_start, has_final, coefs, post = [0], [], [], []
+    attr_start, attr_names, attr_values, attr_ints = [0], [], [], []
+    chaos_start, chaos = [0], []
+    info_start, info = [0], []
+
+    for flame in flames:
+        xforms = list(flame.iter_xforms())
+        xform_start.append(xform_start[-1] + len(xforms))
+        has_final.append(flame.final is not None)
+        extras = {}
+        for i, xf in enumerate(xforms):
+            coefs.append([getattr(xf, k) for k in _COEFS])
+            post.append([getattr(xf.post, k) for k in _COEFS])
+            for k, v in xf.__dict__.iteritems():
+                if k in _XFORM_SKIP:
+                    continue
+                if _is_number(v):
+                    if k not in name_index:
+                        name_index[k] = len(names)
+                        names.append(k)
+                    attr_names.append(name_index[k])
+                    attr_values.append(v)
+                    attr_ints.append(not isinstance(v, float))
+                else:
+                    extras.setdefault(str(i), {})[k] = v
+            attr_start.append(len(attr_values))
+            values = list(xf.chaos)
+            if any(v != 1 for v in values):
+                chaos.extend(values) # all ones is the default
+            chaos_start.append(len(chaos))
+        header = dict((k, v) for k, v in flame.__dict__.iteritems()
+                      if k not in ('xform', 'final', 'gradient'))
+        info.append(json.dumps({'flame': header, 'xforms': extras}))
+        info_start.append(info_start[-1] + len(info[-1]))
+
+    arrays = [
+        ('palettes', numpy.array([f.gradient.data for f in flames],
+                                 dtype=numpy.uint8).reshape(-1, 256, 3)),
+        ('xform_start', numpy.array(xform_start, dtype=numpy.int64)),
+        ('has_final', numpy.array(has_final, dtype=numpy.bool_)),
+        ('coefs', numpy.array(coefs, dtype=numpy.float64).reshape(-1, 6)),
+        ('post', numpy.array(post, dtype=numpy.float64).reshape(-1, 6)),
+        ('attr_start', numpy.array(attr_start, dtype=numpy.int64)),
+        ('attr_names', numpy.array(attr_names, dtype=numpy.int32)),
+        ('attr_values', numpy.array(attr_values, dtype=numpy.float64)),
+        ('attr_ints', numpy.array(attr_ints, dtype=numpy.bool_)),
+        ('chaos_start', numpy.array(chaos_start, dtype=numpy.int64)),
+        ('chaos', numpy.array(chaos, dtype=numpy.float64)),
+        ('info_start', numpy.array(info_start, dtype=numpy.int64)),
+        ('info', numpy.fromstring(''.join(info), dtype=numpy.uint8)),
+        ]
+
+    path, size, mtime = _source_key(filename)
+    layout, offset = {}, 0
+    for name, array in arrays:
+        layout[name] = (array.dtype.str, array.shape, offset)
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({'version': CACHE_VERSION, 'fr0st': fr0stlib.VERSION,
+                         'path': path, 'size': size, 'mtime': mtime,
+                         'count': len(flames), 'names': names,
+                         'arrays': layout})
+    start = -(-(len(MAGIC) + 4 + len(header)) // _ALIGN) * _ALIGN
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', len(header)) + header)
+            for name, array in arrays:
+                f.seek(start + layout[name][2])
+                f.write(array.tostring())
+        # mkstemp creates the file readable by its owner only
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0666 & ~umask)
+        target = cache_path(filename)
+        if os.path.exists(target):
+            os.remove(target) # rename doesn't replace files on windows
+        os.rename(tmp, target)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+class FlameCache(object):
+    """A memory-mapped view of the parsed flames of a file. Use open_cache,
+    which only returns caches that are still valid."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("%s is not a flame cache" % path)
+            length, = struct.unpack('<I', f.read(4))
+            self.header = header = json.loads(f.read(length))
+        start = -(-(len(MAGIC) + 4 + length) // _ALIGN) * _ALIGN
+        self.count = header['count']
+        self.names = map(str, header['names'])
+        size = os.path.getsize(path)
+        self._map = numpy.memmap(path, dtype=numpy.uint8, mode='r') \
+                    if size > start else None
+        # plain arrays over the map, indexing a memmap is several times slower
+        mm = self._map.view(numpy.ndarray) if self._map is not None else None
+        for name, (dtype, shape, offset) in header['arrays'].iteritems():
+            nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+            if nbytes:
+                array = mm[start + offset:start + offset + nbytes]
+                array = array.view(dtype).reshape(shape)
+            else:
+                array = numpy.zeros(shape, dtype=dtype)
+            setattr(self, name, array)
+
+    def matches(self, filename):
+        header = self.header
+        return (header['version'] == CACHE_VERSION
+                and header['fr0st'] == fr0stlib.VERSION
+                and (header['path'], header['size'], header['mtime'])
+                    == _source_key(filename))
+
+    def __len__(self):
+        return self.count
+
+    def flame(self, index):
+        """Builds the flame at index from the arrays."""
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("flame index out of range")
+        start, end = self.info_start[index:index + 2]
+        info = _to_str(json.loads(self.info[start:end].tostring()))
+        flame = Flame()
+        flame.__dict__.update(info['flame'])
+        flame.gradient.data[:] = self.palettes[index]
+
+        first, last = self.xform_start[index:index + 2]
+        xforms = [Xform(flame) for i in xrange(first, last)]
+        if self.has_final[index]:
+            flame.xform, flame.final = xforms[:-1], xforms[-1]
+        else:
+            flame.xform = xforms
+
+        coefs = self.coefs[first:last].tolist()
+        post = self.post[first:last].tolist()
+        extras = info['xforms']
+        for i, xf in enumerate(xforms):
+            row = first + i
+            a, b = self.attr_start[row:row + 2]
+            ints = self.attr_ints[a:b].tolist()
+            values = [int(v) if is_int else v for v, is_int in
+                      zip(self.attr_values[a:b].tolist(), ints)]
+            xf.__dict__.update(zip([self.names[n] for n in self.attr_names[a:b]],
+                                   values))
+            xf.__dict__.update(zip(_COEFS, coefs[i]))
+            xf.post.__dict__.update(zip(_COEFS, post[i]))
+            xf.__dict__.update(extras.get(str(i), ()))
+            a, b = self.chaos_start[row:row + 2]
+            if b > a:
+                xf.chaos = Chaos(xf, self.chaos[a:b].tolist())
+        return flame
+
+
+def open_cache(filename):
+    """Returns the cache of filename when it's valid, None otherwise."""
+    path = cache_path(filename)
+    try:
+        cache = FlameCache(path)
+        if cache.matches(filename):
+            return cache
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
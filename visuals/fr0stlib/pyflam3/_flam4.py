@@ -1,4 +1,6 @@
 import sys
+import operator
+import numpy
 from ctypes import *
 from fr0stlib.pyflam3.find_dll import find_dll
 
@@ -236,11 +238,131 @@ def setTransAff(transAff, xform):
     transAff.d = xform.d
     transAff.e = xform.e
 
+XFORM_FIELDS = dict((name, i) for i, (name, ctype) in enumerate(xForm._fields_))
+NUM_XFORM_FIELDS = len(xForm._fields_)
+# flam3 and flam4 disagree on the orientation of these coefficients
+FLIPPED_FIELDS = [XFORM_FIELDS[name] for name in ('b', 'd', 'f')]
+POST_FIELDS = [XFORM_FIELDS[name] for name in ('pa', 'pb', 'pc', 'pd', 'pe', 'pf')]
+POST_SIGNS = numpy.array((1, -1, 1, -1, 1, -1), dtype=numpy.float32)
+AFF_FIELDS = [XFORM_FIELDS[name] for name in ('a', 'b', 'd', 'e')]
+SYMMETRY_FIELD = XFORM_FIELDS['symmetry']
+WEIGHT_FIELD = XFORM_FIELDS['weight']
+readPostCoefs = operator.attrgetter('a', 'b', 'c', 'd', 'e', 'f')
+
+
+class XformSlot(object):
+    """Remembers what was last written for one xform, so unchanged xforms are skipped.
+
+    The xform's attributes are read in one call through an itemgetter over the fields it
+    sets, which is rebuilt only when the set of attributes changes.
+    """
+    def __init__(self):
+        self.keys = None
+        self.values = None
+
+    def load(self, inxform, row):
+        """Writes the xform into its row of floats, returns False if nothing changed."""
+        attrs = inxform.__dict__
+        if self.keys is None or attrs.viewkeys() != self.keys:
+            self.keys = set(attrs)
+            names = [name for name in attrs if name in XFORM_FIELDS]
+            self.indices = [XFORM_FIELDS[name] for name in names]
+            self.getter = operator.itemgetter(*names) if names else lambda attrs: ()
+            if len(names) == 1:
+                getter = self.getter
+                self.getter = lambda attrs: (getter(attrs),)
+            self.values = None
+        post = inxform.post
+        values = (self.getter(attrs), readPostCoefs(post), inxform.color_speed)
+        if values == self.values:
+            return False
+        self.values = values
+        fields, postCoefs, colorSpeed = values
+        row[:] = 0
+        row[self.indices] = fields
+        row[FLIPPED_FIELDS] *= -1
+        row[POST_FIELDS] = postCoefs
+        row[POST_FIELDS] *= POST_SIGNS
+        # Convert from flam3 color_speed back to symmetry, so flam4 will interpret
+        # the color correctly.
+        row[SYMMETRY_FIELD] = 1. - colorSpeed * 2
+        return True
+
+
+class Flam4Loader(object):
+    """Converts flames to flam4 structs like loadFlam4, reusing the buffers between frames.
+
+    The xforms, their affine parts and the palette live in NumPy arrays the struct points
+    into. They are reallocated only when the number of xforms changes, and each frame
+    only rewrites the xforms whose attributes changed and the palette if it changed.
+    The returned struct is reused by the next call.
+    """
+    def __init__(self):
+        self.flam4Flame = Flame()
+        finalAddress = addressof(self.flam4Flame) + Flame.finalXform.offset
+        self.finalRow = numpy.ctypeslib.as_array((c_float*NUM_XFORM_FIELDS).from_address(finalAddress))
+        self.finalSlot = XformSlot()
+        self.colors = numpy.zeros((256, 4), dtype=numpy.float32)
+        self.colors[:, 3] = 1
+        self.palette = None
+        self.flam4Flame.numColors = len(self.colors)
+        self.flam4Flame.colorIndex = self.colors.ctypes.data_as(POINTER(rgba))
+        self.allocate(0)
+
+    def allocate(self, numTrans):
+        self.numTrans = numTrans
+        self.trans = numpy.zeros((numTrans, NUM_XFORM_FIELDS), dtype=numpy.float32)
+        self.transAff = numpy.zeros((numTrans, 4), dtype=numpy.float32)
+        self.weights = numpy.zeros(numTrans, dtype=numpy.float32)
+        self.slots = [XformSlot() for x in range(numTrans)]
+        self.flam4Flame.numTrans = numTrans
+        self.flam4Flame.trans = self.trans.ctypes.data_as(POINTER(xForm))
+        self.flam4Flame.transAff = self.transAff.ctypes.data_as(POINTER(unAnimatedxForm))
+
+    def load(self, flame):
+        flam4Flame = self.flam4Flame
+        flam4Flame.center[0] = flame.x_offset
+        flam4Flame.center[1] = flame.y_offset
+        flam4Flame.size[0] = 100./flame.scale
+        flam4Flame.size[1] = -100.*(flame.height/float(flame.width))/flame.scale        # flip the image right side up!
+        flam4Flame.hue = 0                              #LINKME
+        flam4Flame.rotation = flame.angle # flam4 uses radians for rotate!
+        flam4Flame.background = rgba(flame.background[0]/255.,flame.background[1]/255.,flame.background[2]/255.,0)
+        flam4Flame.brightness = flame.brightness
+        flam4Flame.gamma = flame.gamma
+        flam4Flame.vibrancy = 1                         #LINKME
+
+        palette = flame.gradient.data
+        if self.palette is None or not numpy.array_equal(palette, self.palette):
+            self.palette = palette.copy()
+            numpy.multiply(palette, 1/255., out=self.colors[:, :3], casting='unsafe')
+
+        if len(flame.xform) != self.numTrans:
+            self.allocate(len(flame.xform))
+        changed = False
+        for x, (inxform, slot) in enumerate(zip(flame.xform, self.slots)):
+            if slot.load(inxform, self.trans[x]):
+                self.weights[x] = self.trans[x, WEIGHT_FIELD]
+                changed = True
+        if changed:
+            self.transAff[:] = self.trans[:, AFF_FIELDS]
+            # weights are handed to flam4 as cumulative probabilities
+            self.trans[:, WEIGHT_FIELD] = numpy.cumsum(self.weights / self.weights.sum())
+
+        flam4Flame.isFinalXform = bool(flame.final)
+        if flame.final:
+            self.finalSlot.load(flame.final, self.finalRow)
+        return flam4Flame
+
 def renderFlam4(flame, size, quality, progress_func, transparent=False,
-                **kwds):
+                output_buffer=None, **kwds):
+    """Renders into output_buffer when it has the right size, or into a new buffer."""
     global LastRenderSize, cudaRunning
     w,h = size
-    outputBuffer = (c_ubyte*(w*h*4))()
+    if output_buffer is not None and len(output_buffer) == w*h*4:
+        outputBuffer = output_buffer
+    else:
+        outputBuffer = (c_ubyte*(w*h*4))()
     if LastRenderSize != size:
         if cudaRunning:
             libflam4.cuStopCuda()
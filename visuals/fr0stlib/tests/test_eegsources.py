@@ -0,0 +1,74 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+from unittest import TestCase
+import json, os, shutil, tempfile
+import numpy as np
+from eegsources import MUSE_JSON_SERIES, EEGFromJSONFile, convert_muse_json
+
+
+def recording(lengths, timestamps):
+    timeseries = {}
+    for i, name in enumerate(MUSE_JSON_SERIES):
+        channels = 1 if name == 'blink' else 4
+        timeseries[name] = {'samples': [[i + n * 0.01] * channels
+                                        for n in range(lengths.get(name, 5))]}
+    timeseries['alpha_relative'] = {'timestamps': list(range(timestamps))}
+    return {'timeseries': timeseries}
+
+
+class TestConvertMuseJSON(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.json_path = os.path.join(self.dir, 'session.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, data):
+        with open(self.json_path, 'w') as f:
+            json.dump(data, f)
+        return np.load(convert_muse_json(self.json_path))
+
+    def test_convert(self):
+        samples = self.convert(recording({}, 5))
+        self.assertEqual(samples.shape, (5, 22))
+        self.assertEqual(samples[2, 0], 0.02)
+        self.assertEqual(samples[2, 4], 1.02)
+        self.assertEqual(samples[2, 20], 5.02)
+        self.assertTrue((samples[:, 21] == 0).all())
+
+    def test_truncated_series(self):
+        samples = self.convert(recording({'gamma_absolute': 3}, 5))
+        self.assertEqual(samples.shape, (3, 22))
+        self.assertEqual(samples[-1, 8], 2.02)
+
+    def test_truncated_timestamps(self):
+        samples = self.convert(recording({}, 4))
+        self.assertEqual(len(samples), 4)
+
+    def test_replay(self):
+        with open(self.json_path, 'w') as f:
+            json.dump(recording({'blink': 2}, 5), f)
+        source = EEGFromJSONFile(self.json_path)
+        self.assertEqual(source.sample_length, 2)
+        self.assertEqual(source.channels, 4)
+        self.assertEqual(source.read_new_data().blink, 5.)
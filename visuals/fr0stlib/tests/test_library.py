@@ -0,0 +1,163 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+from unittest import TestCase, skipIf
+import os, re, tempfile
+from fr0stlib import Flame, FlameLibrary, split_flamestrings, \
+     load_flamestrings, load_flames, iter_flames
+from fr0stlib.flamecache import cache_path, open_cache, write_cache
+
+
+colors = "".join('   <color index="%s" rgb="%s %s %s"/>\n' % (i, i, 255 - i, i // 2)
+                 for i in range(256))
+hexcolors = "\n".join("".join("%02X%02X%02X" % (i, 255 - i, i // 2)
+                              for i in range(j, j + 8))
+                      for j in range(0, 256, 8))
+
+flame_str = """<flame name="%s" size="512 384" center="0 0" scale="128.0" rotate="0" brightness="4" version="fr0st 1.5" >
+   <xform linear="1.0" weight="1.0" color="0.0" coefs="1.0 0.5 -0.25 1.0 0.1 0.2" post="1.0 0.0 0.3 1.0 0.0 0.0" />
+%s</flame>"""
+
+file_str = """<flames version="fr0st 1.5">
+%s
+%s
+<flame name="hex" size="512 384" center="0 0" scale="128.0" version="fr0st 1.5" >
+   <xform linear="1.0" weight="1.0" color="0.0" coefs="1.0 0.0 0.0 1.0 0.0 0.0" />
+   <palette count="256" format="RGB">
+%s
+   </palette>
+</flame>
+</flames>""" % (flame_str % ("first", colors), flame_str % ("second", colors),
+                hexcolors)
+
+
+class TestLibrary(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".flame")
+        with os.fdopen(fd, "w") as f:
+            f.write(file_str)
+
+    def tearDown(self):
+        os.remove(self.path)
+        if os.path.exists(cache_path(self.path)):
+            os.remove(cache_path(self.path))
+
+    def test_split(self):
+        regex = re.findall(r'<flame .*?</flame>', file_str, re.DOTALL)
+        self.assertEquals(split_flamestrings(file_str), regex)
+        self.assertEquals(load_flamestrings(self.path), regex)
+        self.assertEquals(split_flamestrings("<flames></flames>"), [])
+
+    def test_index(self):
+        lib = FlameLibrary(self.path)
+        self.assertEquals(len(lib), 3)
+        self.assertEquals([lib.name(i) for i in range(3)],
+                          ["first", "second", "hex"])
+        self.assertEquals(lib.flamestring(1), split_flamestrings(file_str)[1])
+
+    def test_lazy(self):
+        lib = FlameLibrary(self.path)
+        self.assertEquals(lib._flames, {})
+        flame = lib[1]
+        self.assertEquals(flame.name, "second")
+        self.assert_(lib[1] is flame)
+        self.assert_(lib[-2] is flame)
+        self.assertEquals(sorted(lib._flames), [1])
+        self.assertEquals([f.name for f in lib[::2]], ["first", "hex"])
+
+    def test_flames(self):
+        expected = [Flame(s).to_string() for s in split_flamestrings(file_str)]
+        self.assertEquals([f.to_string() for f in FlameLibrary(self.path)],
+                          expected)
+        self.assertEquals([f.to_string() for f in load_flames(self.path)],
+                          expected)
+        self.assertEquals([f.to_string() for f in iter_flames(self.path)],
+                          expected)
+
+    def test_palettes(self):
+        lib = FlameLibrary(self.path)
+        for flame in (lib[0], lib[2]):
+            for i in (0, 100, 255):
+                self.assertEquals(tuple(flame.gradient[i]),
+                                  (i, 255 - i, i // 2))
+
+    def test_coefs(self):
+        xform = FlameLibrary(self.path)[0].xform[0]
+        self.assertEquals(list(xform.screen_coefs),
+                          [1.0, 0.5, -0.25, 1.0, 0.1, 0.2])
+        self.assertEquals(list(xform.post.screen_coefs),
+                          [1.0, 0.0, 0.3, 1.0, 0.0, 0.0])
+
+    def test_cache(self):
+        self.assertEquals(open_cache(self.path), None)
+        parsed = load_flames(self.path)
+        cache = open_cache(self.path)
+        self.assertEquals(len(cache), 3)
+        cached = load_flames(self.path)
+        for flame, other in zip(parsed, cached):
+            self.assertEquals(sorted(flame.to_string().split()),
+                              sorted(other.to_string().split()))
+            self.assertEquals(flame.gradient.data.tolist(),
+                              other.gradient.data.tolist())
+        lib = FlameLibrary(self.path)
+        self.assert_(lib.cache is not None)
+        self.assertEquals(lib[2].name, "hex")
+        self.assertEquals(list(lib[0].xform[0].post.screen_coefs),
+                          [1.0, 0.0, 0.3, 1.0, 0.0, 0.0])
+
+    def test_cache_invalidated(self):
+        load_flames(self.path)
+        with open(self.path, "a") as f:
+            f.write("\n")
+        self.assertEquals(open_cache(self.path), None)
+        self.assertEquals(FlameLibrary(self.path).cache, None)
+        self.assertEquals(len(load_flames(self.path)), 3)
+        self.assert_(open_cache(self.path) is not None)
+
+    def test_cache_empty(self):
+        write_cache(self.path, [])
+        self.assertEquals(len(open_cache(self.path)), 0)
+
+    def test_cache_index(self):
+        load_flames(self.path)
+        cache = open_cache(self.path)
+        self.assertEquals(cache.flame(-1).name, "hex")
+        self.assertRaises(IndexError, cache.flame, 3)
+        self.assertRaises(IndexError, cache.flame, -4)
+
+    def test_cache_int_attributes(self):
+        flames = load_flames(self.path)
+        flames[0].xform[0].animate = 1
+        flames[0].xform[0].color = 0.5
+        write_cache(self.path, flames)
+        xform = open_cache(self.path).flame(0).xform[0]
+        self.assertEquals(type(xform.animate), int)
+        self.assertEquals(xform.animate, 1)
+        self.assertEquals(type(xform.color), float)
+
+    @skipIf(os.name != 'posix', "file modes are posix")
+    def test_cache_mode(self):
+        umask = os.umask(022)
+        try:
+            write_cache(self.path, load_flames(self.path))
+        finally:
+            os.umask(umask)
+        self.assertEquals(os.stat(cache_path(self.path)).st_mode & 0777, 0644)
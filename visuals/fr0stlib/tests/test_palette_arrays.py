@@ -0,0 +1,100 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+from unittest import TestCase
+import random, numpy
+from fr0stlib import Palette, rgb2hls, hls2rgb, rgb2hsv, hsv2rgb, \
+     pblend_color, rgb2hls_array, hls2rgb_array, rgb2hsv_array, hsv2rgb_array
+
+
+class TestPaletteArrays(TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.palette = Palette()
+        self.palette.data[:] = [[random.randrange(256) for i in range(3)]
+                                for j in range(256)]
+        # a few grays, which have no hue
+        self.palette.data[::16] = self.palette.data[::16, :1]
+        self.colors = [tuple(int(c) for c in color) for color in self.palette]
+
+    def assertPalette(self, palette, colors):
+        self.assertEqual(palette.data.tolist(), [list(c) for c in colors])
+
+    def test_conversions(self):
+        hls = rgb2hls_array(self.palette.data)
+        hsv = rgb2hsv_array(self.palette.data)
+        for i, color in enumerate(self.colors):
+            self.assertEqual(tuple(hls[i]), rgb2hls(color))
+            self.assertEqual(tuple(hsv[i]), rgb2hsv(color))
+        self.assertEqual(hls2rgb_array(hls).tolist(),
+                         [list(hls2rgb(c)) for c in hls])
+        self.assertEqual(hsv2rgb_array(hsv).tolist(),
+                         [list(hsv2rgb(c)) for c in hsv])
+
+    def test_hue(self):
+        self.palette.hue(100)
+        expected = []
+        for color in self.colors:
+            h, l, s = rgb2hls(color)
+            expected.append(hls2rgb(((h + 100/360.0) % 1, l, s)))
+        self.assertPalette(self.palette, expected)
+
+    def test_saturation_brightness(self):
+        data = self.palette.data
+        self.palette.saturation(-30)
+        self.palette.brightness(20)
+        expected = []
+        for color in self.colors:
+            h, l, s = rgb2hls(color)
+            h, l, s = rgb2hls(hls2rgb((h, l, max(0, min(1, s - .3)))))
+            expected.append(hls2rgb((h, max(0, min(1, l + .2)), s)))
+        self.assertPalette(self.palette, expected)
+        self.assertTrue(self.palette.data is data)
+
+    def test_in_place(self):
+        data = self.palette.data
+        self.palette.rotate(10)
+        self.assertPalette(self.palette, self.colors[-10:] + self.colors[:-10])
+        self.palette.rotate(-10)
+        self.palette.reverse()
+        self.assertPalette(self.palette, self.colors[::-1])
+        self.palette.reverse()
+        self.palette.invert()
+        self.assertPalette(self.palette, [tuple(255 - c for c in color)
+                                          for color in self.colors])
+        self.assertTrue(self.palette.data is data)
+
+    def test_from_seeds(self):
+        seeds = [(0.9, 1.0, 1.0), (0.1, 0.5, 0.8), (0.5, 0.2, 0.4)]
+        for curve in ('linear', 'cos', 'cubic'):
+            self.palette.from_seeds(seeds, curve)
+            expected = []
+            for i, count in enumerate((86, 85, 85)):
+                for j in range(count):
+                    hsv = pblend_color(seeds[i-1], seeds[i], j/float(count), curve)
+                    expected.append(hsv2rgb(hsv))
+            self.assertPalette(self.palette, expected)
+        self.assertRaises(ValueError, self.palette.from_seeds, seeds, 'bad')
+
+    def test_to_buffer(self):
+        buff = self.palette.to_buffer()
+        self.assertEqual(len(buff), 768)
+        self.assertEqual(buff, "".join("%c%c%c" % c for c in self.colors))
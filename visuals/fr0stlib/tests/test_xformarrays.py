@@ -0,0 +1,132 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+from unittest import TestCase
+from fr0stlib import Flame
+from fr0stlib.xformarrays import XformArrays
+
+
+colors = "".join('   <color index="%s" rgb="%s %s %s"/>\n' % (i, i, 255 - i, i // 2)
+                 for i in range(256))
+
+flame_str = """<flame name="arrays" size="512 384" center="0 0" scale="128.0" version="fr0st 1.5" >
+   <xform linear="0.5" julian="0.5" julian_power="3" julian_dist="1" weight="1.0" color="0.0" chaos="1 0 1" coefs="1.0 0.5 -0.25 1.0 0.1 0.2" />
+   <xform spherical="1.0" weight="0.5" color="0.5" coefs="0.5 0.0 0.0 0.5 0.0 0.0" post="1.0 0.0 0.3 1.0 0.0 0.0" />
+   <xform swirl="1.0" weight="2.0" color="1.0" coefs="0.8 -0.1 0.2 0.7 -0.4 0.6" />
+   <finalxform linear="1.0" color="0.0" color_speed="0" coefs="1.0 0.0 0.0 1.0 0.0 0.3" />
+%s</flame>""" % colors
+
+
+class TestXformArrays(TestCase):
+    def setUp(self):
+        self.flame = Flame(flame_str)
+        self.arrays = XformArrays(self.flame)
+
+    def assertCoefs(self, xforms):
+        for i, xf in enumerate(xforms):
+            for name in "adbecf":
+                self.assertAlmostEqual(getattr(self.arrays.xform(i), name),
+                                       getattr(xf, name))
+
+    def test_read(self):
+        arrays = self.arrays
+        self.assertEqual(len(arrays), 4)
+        self.assertTrue(arrays.has_final)
+        self.assertTrue(arrays.xform(3).isfinal())
+        self.assertEqual(arrays.coefs.shape, (4, 6))
+        self.assertEqual(arrays.chaos.shape, (3, 3))
+        self.assertEqual(arrays.chaos[0].tolist(), [1, 0, 1])
+        self.assertEqual(arrays.attrs['weight'][:3].tolist(), [1.0, 0.5, 2.0])
+        self.assertEqual(arrays.variations(0), [('linear', 0.5), ('julian', 0.5)])
+        view = arrays.xform(0)
+        self.assertEqual(view.julian_power, 3)
+        self.assertEqual(view.swirl, 0.0)
+        self.assertRaises(AttributeError, getattr, arrays.xform(1), 'julian_power')
+        self.assertCoefs(self.flame.iter_xforms())
+        self.assertEqual(arrays.screen_coefs(0), self.flame.xform[0].screen_coefs)
+        self.assertEqual(arrays.post_screen_coefs(0), None)
+        self.assertEqual(arrays.post_screen_coefs(1),
+                         self.flame.xform[1].post.screen_coefs)
+
+    def test_operations(self):
+        # the vectorized operations match the ones of the xforms
+        expected = Flame(flame_str)
+        degs = [10., -35., 90., 0.]
+        for xf, deg in zip(expected.iter_xforms(), degs):
+            xf.rotate(deg)
+            xf.move(0.25)
+            xf.scale(1.5)
+        self.arrays.rotate(degs)
+        self.arrays.move(0.25)
+        self.arrays.scale(1.5)
+        self.assertCoefs(expected.iter_xforms())
+
+    def test_rows(self):
+        expected = Flame(flame_str)
+        expected.xform[1].rotate(45)
+        expected.xform[1].move(-0.1)
+        expected.final.move(0.5)
+        expected.xform[2].scale(0.5)
+        self.arrays.xform(1).rotate(45)
+        self.arrays.move(-0.1, 1)
+        self.arrays.xform(3).move(0.5)
+        self.arrays.scale(0.5, [2])
+        self.assertCoefs(expected.iter_xforms())
+
+    def test_write(self):
+        view = self.arrays.xform(1)
+        view.a = 2.0
+        view.color = 0.25
+        view.spherical = 0.0
+        view.julia = 0.5
+        view.julian_power = 2
+        self.arrays.chaos[1, 0] = 0.5
+        self.arrays.write()
+        xf = self.flame.xform[1]
+        self.assertEqual(xf.a, 2.0)
+        self.assertEqual(xf.color, 0.25)
+        self.assertEqual(xf.list_variations(), ['julia'])
+        self.assertEqual(xf.julian_power, 2)
+        self.assertEqual(list(xf.chaos), [0.5, 1, 1])
+        self.assertEqual(self.flame.xform[0].julian_power, 3)
+        self.assertEqual(Flame(self.flame.to_string()).xform[1].a, 2.0)
+
+    def test_read_again(self):
+        # the arrays are refreshed in place while the flame keeps its xforms
+        coefs = self.arrays.coefs
+        other = Flame(flame_str)
+        other.xform[0].rotate(30)
+        other.xform[0].julian_power = 5
+        del other.xform[1].spherical
+        self.arrays.read(other)
+        self.assertTrue(self.arrays.coefs is coefs)
+        self.assertCoefs(other.iter_xforms())
+        self.assertEqual(self.arrays.xform(0).julian_power, 5)
+        self.assertEqual(self.arrays.variations(1), [])
+        self.assertRaises(AttributeError, getattr, self.arrays.xform(2), 'julian_power')
+        # fewer xforms, without a final
+        other.final = None
+        del other.xform[2]
+        self.arrays.read(other)
+        self.assertEqual(len(self.arrays), 2)
+        self.assertFalse(self.arrays.has_final)
+        self.assertEqual(self.arrays.chaos.shape, (2, 2))
+        self.assertCoefs(other.iter_xforms())
@@ -0,0 +1,258 @@
+##############################################################################
+#  Fractal Fr0st - fr0st
+#  https://launchpad.net/fr0st
+#
+#  Copyright (C) 2009 by Vitor Bosshard <algorias@gmail.com>
+#
+#  Fractal Fr0st is free software; you can redistribute
+#  it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this library; see the file COPYING.LIB.  If not, write to
+#  the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+#  Boston, MA 02111-1307, USA.
+##############################################################################
+"""Structure of arrays representation of the xforms of a flame.
+
+Xform objects keep every coefficient and variation as an attribute of their
+own. XformArrays reads all the xforms of a flame into arrays instead, one
+row per xform with the final xform last: the coefficients and post
+coefficients as (n, 6) arrays in a, d, b, e, c, f order, the variation
+weights as an (n, number of variations) matrix, one array per variation
+parameter, and the chaos matrix.
+
+Whole flames can then be animated with a few in-place array operations,
+and renderers read the arrays instead of probing attributes. XformView is
+a thin per-xform view that reads and writes the arrays like an Xform.
+
+The arrays are a copy, the xforms stay the storage of the flame: changes
+are written back to it with write, and read refreshes the arrays from a
+flame in place, without allocating while the number of xforms stays the
+same."""
+import operator, numpy
+
+from fr0stlib.pyflam3 import variation_list, variable_list
+
+COEFS = ('a', 'd', 'b', 'e', 'c', 'f')
+COEF_INDEX = dict((name, i) for i, name in enumerate(COEFS))
+# Attributes every xform has, as one array each.
+ATTRIBUTES = ('weight', 'color', 'color_speed', 'opacity', 'animate')
+VARIATION_INDEX = dict((name, i) for i, name in enumerate(variation_list)
+                       if name is not None)
+VARIABLES = set(name for name, lo, hi, ty in variable_list)
+IDENTITY = (1., 0., 0., 1., 0., 0.)
+read_coefs = operator.attrgetter(*COEFS)
+
+
+class XformArrays(object):
+    def __init__(self, flame):
+        self.count = None
+        self.read(flame)
+
+    def read(self, flame):
+        """Reads the xforms of flame into the arrays. They are reused in
+        place while flames have as many xforms, so arrays kept between
+        frames don't allocate."""
+        self.flame = flame
+        xforms = list(flame.iter_xforms())
+        n = len(xforms)
+        if n != self.count or len(flame.xform) != len(self.chaos):
+            self._allocate(n, len(flame.xform))
+        self.has_final = flame.final is not None
+        self.weights.fill(0.0)
+        for present in self.present.itervalues():
+            present.fill(False)
+        for i, xf in enumerate(xforms):
+            self.coefs[i] = read_coefs(xf)
+            self.post[i] = read_coefs(xf.post)
+            for name in ATTRIBUTES:
+                self.attrs[name][i] = getattr(xf, name, 0.0)
+            # variables an xform doesn't have are left out of its row by present
+            for name, value in xf.__dict__.iteritems():
+                if name in VARIATION_INDEX:
+                    self.weights[i, VARIATION_INDEX[name]] = value
+                elif name in VARIABLES:
+                    self.set_param(name, i, value)
+        for i, xf in enumerate(flame.xform):
+            self.chaos[i] = list(xf.chaos)
+        return self
+
+    def _allocate(self, n, regular):
+        self.count = n
+        self.coefs = numpy.empty((n, 6))
+        self.post = numpy.empty((n, 6))
+        self.attrs = dict((name, numpy.empty(n)) for name in ATTRIBUTES)
+        self.weights = numpy.empty((n, len(variation_list)))
+        self.params, self.present = {}, {}
+        self.chaos = numpy.empty((regular, regular))
+
+        # scratch rows of the vectorized operations, they don't allocate
+        self._values = numpy.empty(n)
+        self._cos = numpy.empty(n)
+        self._sin = numpy.empty(n)
+        self._tmp = numpy.empty((3, n))
+        self._mask = numpy.empty(n, dtype=numpy.bool_)
+
+    def __len__(self):
+        return self.count
+
+    def xform(self, index):
+        return XformView(self, index)
+
+    def set_param(self, name, index, value):
+        if name not in self.params:
+            self.params[name] = numpy.zeros(self.count)
+            self.present[name] = numpy.zeros(self.count, dtype=numpy.bool_)
+        self.params[name][index] = value
+        self.present[name][index] = True
+
+    def variations(self, index):
+        """The (name, weight) of the variations an xform uses."""
+        row = self.weights[index]
+        return [(variation_list[i], row[i]) for i in numpy.flatnonzero(row)]
+
+    def screen_coefs(self, index):
+        a, d, b, e, c, f = self.coefs[index].tolist()
+        return a, -d, -b, e, c, -f
+
+    def post_screen_coefs(self, index):
+        """The post coefficients of an xform in screen orientation, None when
+        it has no post transform."""
+        row = self.post[index].tolist()
+        if row == list(IDENTITY):
+            return None
+        a, d, b, e, c, f = row
+        return a, -d, -b, e, c, -f
+
+    def _per_row(self, value, rows, identity):
+        # a scalar or one value per xform, identity where rows leave them out
+        if rows is None:
+            return value
+        self._values.fill(identity)
+        self._values[rows] = value
+        return self._values
+
+    def rotate(self, deg, rows=None):
+        """Rotates the x and y axes of the xforms by deg, like Xform.rotate.
+        deg is a number or one value per xform, rows limits it to some."""
+        deg = self._per_row(deg, rows, 0.0)
+        angle = self._tmp[2]
+        numpy.multiply(deg, numpy.pi / 180.0, out=angle)
+        numpy.cos(angle, out=self._cos)
+        numpy.sin(angle, out=self._sin)
+        x_new, tmp = self._tmp[0], self._tmp[1]
+        for x, y in ((0, 1), (2, 3)):
+            cx, cy = self.coefs[:, x], self.coefs[:, y]
+            numpy.multiply(cx, self._cos, out=x_new)
+            numpy.multiply(cy, self._sin, out=tmp)
+            numpy.subtract(x_new, tmp, out=x_new)
+            numpy.multiply(cx, self._sin, out=tmp)
+            numpy.multiply(cy, self._cos, out=cy)
+            numpy.add(cy, tmp, out=cy)
+            cx[:] = x_new
+
+    def move(self, v, rows=None):
+        """Moves the offsets away from the origin by v, like Xform.move."""
+        v = self._per_row(v, rows, 0.0)
+        c, f = self.coefs[:, 4], self.coefs[:, 5]
+        length, ratio = self._tmp[0], self._tmp[1]
+        numpy.hypot(c, f, out=length)
+        numpy.greater(length, 0.0, out=self._mask)
+        numpy.add(length, v, out=ratio)
+        numpy.divide(ratio, length, out=ratio, where=self._mask)
+        numpy.multiply(c, ratio, out=c, where=self._mask)
+        numpy.multiply(f, ratio, out=f, where=self._mask)
+        # an offset at the origin moves along the x axis
+        numpy.logical_not(self._mask, out=self._mask)
+        numpy.copyto(c, v, where=self._mask)
+
+    def scale(self, v, rows=None):
+        """Scales the x and y axes of the xforms by v, like Xform.scale."""
+        v = self._per_row(v, rows, 1.0)
+        if numpy.ndim(v):
+            v = v[:, numpy.newaxis]
+        numpy.multiply(self.coefs[:, :4], v, out=self.coefs[:, :4])
+
+    def write(self):
+        """Writes the arrays back into the xforms of the flame."""
+        xforms = list(self.flame.iter_xforms())
+        coefs, post = self.coefs.tolist(), self.post.tolist()
+        attrs = dict((name, values.tolist()) for name, values in self.attrs.iteritems())
+        for i, xf in enumerate(xforms):
+            d = xf.__dict__
+            d.update(zip(COEFS, coefs[i]))
+            xf.post.__dict__.update(zip(COEFS, post[i]))
+            for name in ATTRIBUTES:
+                if name in d or attrs[name][i]:
+                    d[name] = attrs[name][i]
+            row = self.weights[i]
+            for name in [k for k in d if k in VARIATION_INDEX]:
+                if not row[VARIATION_INDEX[name]]:
+                    del d[name]
+            d.update(self.variations(i))
+            for name, values in self.params.iteritems():
+                if self.present[name][i]:
+                    d[name] = values[i].item()
+        for xf, row in zip(self.flame.xform, self.chaos.tolist()):
+            xf.chaos[:] = row
+
+
+class XformView(object):
+    """One xform of an XformArrays, its attributes read from and written to
+    the arrays."""
+    __slots__ = ('_arrays', '_index')
+
+    def __init__(self, arrays, index):
+        object.__setattr__(self, '_arrays', arrays)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        arrays, i = self._arrays, self._index
+        if name in COEF_INDEX:
+            return arrays.coefs[i, COEF_INDEX[name]].item()
+        if name in arrays.attrs:
+            return arrays.attrs[name][i].item()
+        if name in VARIATION_INDEX:
+            return arrays.weights[i, VARIATION_INDEX[name]].item()
+        if name in arrays.params and arrays.present[name][i]:
+            return arrays.params[name][i].item()
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        arrays, i = self._arrays, self._index
+        if name in COEF_INDEX:
+            arrays.coefs[i, COEF_INDEX[name]] = value
+        elif name in arrays.attrs:
+            arrays.attrs[name][i] = value
+        elif name in VARIATION_INDEX:
+            arrays.weights[i, VARIATION_INDEX[name]] = value
+        elif name in VARIABLES:
+            arrays.set_param(name, i, value)
+        else:
+            raise AttributeError('Can\'t assign "%s" to an xform view' % name)
+
+    def __repr__(self):
+        return "<xform view %d>" % (self._index + 1)
+
+    @property
+    def screen_coefs(self):
+        return self._arrays.screen_coefs(self._index)
+
+    def isfinal(self):
+        return self._arrays.has_final and self._index == self._arrays.count - 1
+
+    def rotate(self, deg):
+        self._arrays.rotate(deg, self._index)
+
+    def move(self, v):
+        self._arrays.move(v, self._index)
+
+    def scale(self, v):
+        self._arrays.scale(v, self._index)
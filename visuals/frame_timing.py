@@ -0,0 +1,152 @@
+""" Per-stage frame timings of the visuals engine.
+
+Every stage of a frame records how long it took into a rolling window, from whichever thread runs it.
+The percentiles of the windows are served as JSON on a local HTTP port, and every measurement can be
+dumped to a CSV file for offline analysis:
+
+curl http://localhost:8090/
+"""
+import csv
+import json
+import threading
+import timeit
+import numpy as np
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# wall clock with the best resolution of the platform, time.clock measures cpu time on linux
+clock = timeit.default_timer
+
+TIMINGS_WINDOW = 600  # measurements kept per stage, 10 seconds at 60 fps
+TIMINGS_PORT = 8090
+PERCENTILES = (50, 95, 99)
+
+# in frame order, with the thread that measures them
+STAGES = ('eeg_read',    # engine: EEGSource.read_data
+          'transition',  # engine: apply_transition, interpolation of the running flame
+          'animate',     # engine: animate, eeg data applied to the flame
+          'palette',     # engine: modulate_palette, eeg data applied to the flame's colours
+          'frame',       # engine: a whole frame, without the sleep to the frame rate
+          'convert',     # render worker: flame converted for the renderer (flam4 structs)
+          'render',      # render worker: render call, conversion included
+          'upscale',     # render worker: frame rendered below the display size upscaled to it
+          'latency',     # render worker: frame handed over by the engine to frame rendered
+          'bitmap',      # gui: rendered buffer copied to a bitmap
+          'paint',       # gui: bitmap drawn to the window
+          'output',      # headless: frame written to its sink
+          'decode',      # loops decoder: clip frame decoded and hue shifted ahead of its playback
+          'compose',     # loops: clip frames cross-faded, decoded when the decoder is behind
+          'modulate')    # loops: eeg rotation and zoom of the composed frame
+
+
+class RollingTimings(object):
+    """ The last measurements of one stage, as (time measured, seconds taken) in a ring buffer.
+
+    Written by a single thread, read from any: a snapshot may miss the measurement being written.
+    """
+    def __init__(self, window = TIMINGS_WINDOW):
+        self.samples = np.zeros((window, 2))
+        self.count = 0
+
+    def add(self, measured_at, seconds):
+        self.samples[self.count % len(self.samples)] = (measured_at, seconds)
+        self.count += 1
+
+    def summary(self):
+        samples = self.samples[:min(self.count, len(self.samples))].copy()
+        summary = {'count': self.count}
+        if len(samples) == 0:
+            return summary
+        seconds = samples[:, 1] * 1000.
+        summary.update(('p%d_ms' % p, v) for p, v in zip(PERCENTILES, np.percentile(seconds, PERCENTILES)))
+        summary['max_ms'] = seconds.max()
+        summary['mean_ms'] = seconds.mean()
+        span = samples[:, 0].max() - samples[:, 0].min()
+        summary['per_second'] = (len(samples) - 1) / span if span > 0 else 0.
+        return summary
+
+
+class Stopwatch(object):
+    """ Measures the block it wraps as a stage: with frame_timings.stage('render'): ... """
+    __slots__ = ('timings', 'name', 'started')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timings.record(self.name, clock() - self.started)
+
+
+class FrameTimings(object):
+    def __init__(self, window = TIMINGS_WINDOW):
+        self.stages = dict((name, RollingTimings(window)) for name in STAGES)
+        self.csv_file = None
+        self.csv_writer = None
+        self.csv_lock = threading.Lock()
+        self.server = None
+
+    def stage(self, name):
+        return Stopwatch(self, name)
+
+    def record(self, name, seconds, measured_at = None):
+        if measured_at is None:
+            measured_at = clock()
+        self.stages[name].add(measured_at, seconds)
+        if self.csv_writer is not None:
+            with self.csv_lock:
+                if self.csv_writer is not None:
+                    self.csv_writer.writerow((repr(measured_at), name, '%.3f' % (seconds * 1000.)))
+
+    def summary(self):
+        return dict((name, timings.summary()) for name, timings in self.stages.iteritems())
+
+    def dump_csv(self, path):
+        """ Appends every following measurement to path as time,stage,milliseconds rows """
+        with self.csv_lock:
+            self.csv_file = open(path, 'ab')
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(('time', 'stage', 'milliseconds'))
+        print("[ ] DUMPING FRAME TIMINGS TO %s" % path)
+
+    def serve_http(self, port = TIMINGS_PORT, host = 'localhost'):
+        """ Serves the summary as JSON on http://host:port/ from a daemon thread """
+        timings = self
+
+        class TimingsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(timings.summary(), indent=2, sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # keep the console for the engine
+
+        try:
+            self.server = HTTPServer((host, port), TimingsHandler)
+        except Exception as ex:
+            print('[!] frame timings not served on port %s: %s' % (port, str(ex)))
+            return
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        print("[ ] FRAME TIMINGS ON http://%s:%d/" % (host, port))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        with self.csv_lock:
+            if self.csv_file is not None:
+                self.csv_file.close()
+                self.csv_file = self.csv_writer = None
+
+
+# always on, shared by the engine, the render worker and the gui
+frame_timings = FrameTimings()
@@ -0,0 +1,142 @@
+""" Runs the engine without a display: rendered frames go to memory, a raw video pipe or png files.
+
+Used to benchmark and regression test the eeg to flame pipeline on machines without a gpu or a screen,
+with the flam3 cpu renderer. A raw video pipe is read by ffmpeg as:
+
+python default_eeg.py --headless --output - | ffmpeg -f rawvideo -pix_fmt rgba -s 640x360 -r 60 -i - out.mp4
+"""
+import collections
+import os
+import struct
+import sys
+import threading
+import zlib
+import numpy as np
+
+from frame_timing import frame_timings
+
+RENDER_TIMEOUT_SECONDS = 60  # a frame not rendered by then was lost to a render error
+PNG_COMPRESSION = 1  # zlib level, frames are written faster than they are compressed
+
+
+def frame_array(size, output_buffer):
+    """ The rgba pixels of a rendered buffer as a (height, width, 4) array, without copying """
+    w, h = size
+    return np.frombuffer(output_buffer, dtype=np.uint8, count=w * h * 4).reshape(h, w, 4)
+
+
+def write_png(path, pixels):
+    """ Writes a (height, width, 4) uint8 array as an rgba png """
+    h, w = pixels.shape[:2]
+    # every scanline starts with its filter type, 0 leaves it unfiltered
+    scanlines = np.zeros((h, w * 4 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = pixels.reshape(h, w * 4)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(scanlines.tostring(), PNG_COMPRESSION)))
+        f.write(chunk('IEND', ''))
+
+
+class MemorySink(object):
+    """ Keeps copies of the last rendered frames, all of them when keep is None """
+    def __init__(self, keep = None):
+        self.frames = collections.deque(maxlen=keep)
+
+    def write(self, size, output_buffer):
+        self.frames.append(frame_array(size, output_buffer).copy())
+
+    def close(self):
+        pass
+
+
+class RawVideoSink(object):
+    """ Writes the frames back to back as raw rgba to a file, a fifo or stdout ('-') """
+    def __init__(self, path):
+        if path == '-':
+            self.stream = sys.stdout
+            # stdout carries the frames, the engine messages go to stderr until the sink is closed
+            self.stdout = sys.stdout
+            sys.stdout = sys.stderr
+        else:
+            self.stream = open(path, 'wb')
+            self.stdout = None
+
+    def write(self, size, output_buffer):
+        self.stream.write(frame_array(size, output_buffer).data)
+
+    def close(self):
+        self.stream.flush()
+        if self.stdout is not None:
+            sys.stdout = self.stdout
+        else:
+            self.stream.close()
+
+
+class PngSequenceSink(object):
+    """ Writes every frame to directory/frame_000000.png, frame_000001.png... """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.frame_index = 0
+
+    def write(self, size, output_buffer):
+        write_png(os.path.join(self.directory, 'frame_%06d.png' % self.frame_index), frame_array(size, output_buffer))
+        self.frame_index += 1
+
+    def close(self):
+        pass
+
+
+def open_sink(output):
+    """ The sink for an output: None keeps frames in memory, '-' or a .rgba/.raw file is raw video,
+    anything else a directory of pngs """
+    if output is None:
+        return MemorySink()
+    if output == '-' or os.path.splitext(output)[1] in ('.rgba', '.raw'):
+        return RawVideoSink(output)
+    return PngSequenceSink(output)
+
+
+class HeadlessFrame(object):
+    """ Stands in for RenderFrame: renders the engine frames at a fixed size and hands them to a sink.
+
+    With wait, the engine waits for every frame to be rendered so none is dropped, which keeps runs
+    comparable whatever the render speed. Without it frames are dropped as on the display.
+    """
+    def __init__(self, renderer, size, sink, wait = True):
+        self.renderer = renderer
+        self.size = size
+        self.sink = sink
+        self.wait = wait
+        self.rendered = threading.Event()
+        self.frames_written = 0
+
+    def render(self, flame):
+        self.rendered.clear()
+        self.renderer.enqueue_render(flame, self.size, self.render_complete)
+        if self.wait and not self.rendered.wait(RENDER_TIMEOUT_SECONDS):
+            print('[!] frame not rendered after %d seconds' % RENDER_TIMEOUT_SECONDS)
+
+    def render_complete(self, size, output_buffer):
+        # called from the render thread, output_buffer is None when the frame failed to render
+        try:
+            if output_buffer is not None:
+                with frame_timings.stage('output'):
+                    self.sink.write(size, output_buffer)
+                self.frames_written += 1
+        finally:
+            if output_buffer is not None:
+                self.renderer.release_buffer(output_buffer)
+            self.rendered.set()
+
+    def stop(self):
+        self.renderer.stop()
+        # printed before the sink is closed, a raw video sink on stdout hands it back then
+        print("[ ] WROTE %d FRAMES" % self.frames_written)
+        self.sink.close()
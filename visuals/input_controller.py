@@ -51,8 +51,8 @@ class InputController(object):
         if key_code == 342:
             self.engine.set_meditation_state(set_next = True)
             event.Skip()
-        # [F8] - START
-        if key_code == 347:
+        # [F8] - START, for the engines that have one
+        if key_code == 347 and hasattr(self.engine, 'start'):
             self.engine.start()
             event.Skip()
         # ESC OR [F9] OR [F10] - STOP
@@ -106,4 +106,4 @@ class InputController(object):
         else:
             diff = 1.1
         # self.engine.flame.scale /= 1.1
-        self.engine.flame.scale*= diff**((e.GetWheelRotation() > 0)*2 -1)
\ No newline at end of file
+        self.engine.zoom(diff**((e.GetWheelRotation() > 0)*2 -1))
\ No newline at end of file
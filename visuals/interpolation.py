@@ -0,0 +1,364 @@
+import collections
+import math
+import operator
+import threading
+import time
+import numpy as np
+
+from fr0stlib import Flame, Xform, PostXform, Chaos, rgb2hsv_array, hsv2rgb_array
+
+# flame attributes that are kept from the target instead of being interpolated,
+# the sampling settings are integers flam3 refuses to parse from a fraction
+FIXED_FLAME_ATTRIBUTES = set(('width', 'height', 'time', 'oversample', 'supersample', 'passes', 'temporal_samples'))
+# affine coefficients are interpolated on their own, as (a, d, b, e, c, f) rows
+COEFS = ('a', 'd', 'b', 'e', 'c', 'f')
+# reads the coefficients without building the property_array of Xform.coefs, which dominates a frame
+read_coefs = operator.attrgetter(*COEFS)
+IDENTITY_COEFS = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+# padding of a missing xform, like flam3_align: variations with holes are padded with a linear of
+# weight -1 on the identity turned by 180 degrees, some others with themselves at parameters close to
+# the identity, fan and rings with themselves on swapped axes, anything else with a linear identity
+PADDING_NEGATED = ('spherical', 'ngon', 'julian', 'juliascope', 'polar', 'wedge_sph', 'wedge_julia')
+NEGATED_COEFS = (-1.0, 0.0, 0.0, -1.0, 0.0, 0.0)
+PADDING_VARIATIONS = (('rectangles', {'rectangles_x': 0.0, 'rectangles_y': 0.0}),
+                      ('rings2', {'rings2_val': 0.0}),
+                      ('fan2', {'fan2_x': 0.0, 'fan2_y': 0.0}),
+                      ('blob', {'blob_low': 1.0, 'blob_high': 1.0, 'blob_waves': 1.0}),
+                      ('perspective', {'perspective_angle': 0.0}),
+                      ('curl', {'curl_c1': 0.0, 'curl_c2': 0.0}),
+                      ('super_shape', {'super_shape_n1': 2.0, 'super_shape_n2': 2.0, 'super_shape_n3': 2.0,
+                                       'super_shape_rnd': 0.0, 'super_shape_holes': 0.0}))
+PADDING_SWAPPED = ('fan', 'rings')
+SWAPPED_COEFS = (0.0, -1.0, -1.0, 0.0, 0.0, 0.0)  # x and y exchanged, in the complex plane orientation
+MIN_MAGNITUDE = 1e-10  # keeps the log of degenerate affine vectors finite
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # memory cap of the precomputed transitions
+PRECOMPUTE_CHUNK = 256  # frames of palettes converted at once, bounds the temporary arrays
+PRECOMPUTE_PAUSE_SECONDS = 0.05  # pause between precomputed transitions, leaves the GIL to the render loop
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def post_coefs(xf):
+    return read_coefs(xf.post) if xf is not None else IDENTITY_COEFS
+
+
+def padding(other, index, final):
+    """ Numeric attributes and coefficients of the xform flam3 pads a flame with where the other flame
+    has the xform `other`, at `index`. Variables the padding doesn't set are held at the other's values """
+    if final:
+        attrs = {'color': float(index & 1), 'color_speed': 0.0, 'animate': 0.0, 'opacity': 1.0}
+    else:
+        attrs = {'weight': 0.0, 'color': float(index & 1), 'color_speed': 0.5, 'animate': 1.0, 'opacity': 1.0}
+    if any(getattr(other, name) > 0 for name in PADDING_NEGATED):
+        attrs['linear'] = -1.0
+        return attrs, NEGATED_COEFS
+    coefs = IDENTITY_COEFS
+    variations = [(name, params) for name, params in PADDING_VARIATIONS if getattr(other, name) > 0]
+    if not variations:
+        variations = [(name, {}) for name in PADDING_SWAPPED if getattr(other, name) > 0]
+        if variations:
+            coefs = SWAPPED_COEFS
+    for name, params in variations:
+        attrs[name] = 1.0
+        attrs.update(params)
+    if not variations:
+        attrs['linear'] = 1.0
+    return attrs, coefs
+
+
+def polar_coefs(coefs):
+    """Splits (a, d, b, e, c, f) rows into log magnitudes and angles of the x and y vectors."""
+    x, y = coefs[:, 0:4:2], coefs[:, 1:4:2]
+    return np.log(np.maximum(np.hypot(x, y), MIN_MAGNITUDE)), np.arctan2(y, x)
+
+
+class FlameInterpolator(object):
+    """Interpolates between two keyframe flames in memory, into reused Flame objects.
+
+    The keyframes are read once per transition: their numeric flame and xform attributes
+    are laid out in two vectors, and their palettes converted to hsv. Every frame is then a
+    few vectorized operations and a write back into an output flame, no XML and no flam3.
+
+    Like flam3, xforms missing on one side are padded the way flam3_align does, fading in or
+    out through a zero weight, and affine coefficients are interpolated in log-polar form,
+    unless the target's interpolation_type is linear. Palettes are interpolated in hsv, hues turning the short way round like
+    pblend_color, where flam3 would sweep through unrelated hues. The target's coefficients
+    are read again on every frame, since MMEngine.animate keeps moving the target's xforms
+    during a transition.
+
+    Output flames alternate between `buffers` objects, so the renderer can still be
+    reading the previous frame while the next one is written. When `cache` holds a
+    precomputed transition between the same keyframes, the flame attributes and palettes
+    are read from it instead of computed.
+    """
+
+    def __init__(self, origin, target, cache=None, buffers=2):
+        self.origin = origin
+        self.target = target
+        self.log_coefs = getattr(target, 'interpolation_type', 'log') != 'linear'
+
+        # pair the xforms of both flames, the shorter side is padded
+        pairs = map(None, origin.xform, target.xform)
+        final_pair = (origin.final, target.final)
+        has_final = final_pair != (None, None)
+
+        # numeric attributes, as (container, key) slots of the output flames
+        start, end, keys = [], [], []
+        header_start, header_end = origin.__dict__, target.__dict__
+        for name in sorted(set(header_start) | set(header_end)):
+            if name in FIXED_FLAME_ATTRIBUTES:
+                continue
+            s, e = header_start.get(name), header_end.get(name)
+            if is_number(s) and is_number(e):
+                if name == 'rotate':
+                    # the camera turns the short way round, as in flam3
+                    e = s + (e - s + 180.0) % 360.0 - 180.0
+                start.append(s)
+                end.append(e)
+                keys.append(('flame', name))
+        for i, (s, e) in enumerate(zip(origin.background, target.background)):
+            start.append(s)
+            end.append(e)
+            keys.append(('background', i))
+
+        xform_pairs = pairs + ([final_pair] if has_final else [])
+        coefs_start, coefs_end = [], []
+        for index, (o, t) in enumerate(xform_pairs):
+            final = has_final and index == len(pairs)
+            o_attrs, o_coefs = self.xform_values(o, t, index, final)
+            t_attrs, t_coefs = self.xform_values(t, o, index, final)
+            coefs_start.append(o_coefs)
+            coefs_end.append(t_coefs)
+            for name in sorted(set(o_attrs) | set(t_attrs)):
+                # variations missing on a side have no weight there, their variables are held constant
+                default = 0.0 if name in Xform._default else None
+                s = o_attrs.get(name, t_attrs.get(name) if default is None else default)
+                e = t_attrs.get(name, o_attrs.get(name) if default is None else default)
+                start.append(s)
+                end.append(e)
+                keys.append((index, name))
+        self.start = np.array(start, dtype=np.float64)
+        self.delta = np.array(end, dtype=np.float64) - self.start
+
+        # affine rows: the coefficients of every xform, then of every post transform.
+        # a missing post stands for the identity
+        self.coefs_start = np.array(coefs_start + [post_coefs(o) for o, t in xform_pairs])
+        self.coefs_end = np.array(coefs_end + [post_coefs(t) for o, t in xform_pairs])
+        self.live_rows = [(row, xf) for row, xf in
+                          enumerate([t for o, t in xform_pairs] + [t and t.post for o, t in xform_pairs])
+                          if xf is not None]
+        self.coefs_start_polar = polar_coefs(self.coefs_start)
+
+        # palettes in hsv, hues taking the shortest way around the color wheel
+        hsv_start = rgb2hsv_array(origin.gradient.data)
+        hsv_end = rgb2hsv_array(target.gradient.data)
+        hue_delta = hsv_end[:, 0] - hsv_start[:, 0]
+        hsv_end[:, 0] -= np.round(hue_delta)
+        self.hsv_start = hsv_start
+        self.hsv_delta = hsv_end - hsv_start
+
+        self.flames = [self.create_flame(len(pairs), has_final, xform_pairs, keys)
+                       for i in range(buffers)]
+        self.next_flame = 0
+        self.precomputed = cache.get(self) if cache is not None else None
+
+    def interpolates(self, origin, target):
+        return origin is self.origin and target is self.target
+
+    def xform_values(self, xf, other, index, final):
+        # numeric attributes and coefficients of an xform, or of the padding standing in for a missing one
+        if xf is None:
+            return padding(other, index, final)
+        return (dict((k, v) for k, v in xf.__dict__.iteritems() if k not in COEFS and is_number(v)),
+                read_coefs(xf))
+
+    def create_flame(self, count, has_final, xform_pairs, keys):
+        template = self.target
+        flame = Flame()
+        flame.__dict__.update((k, v) for k, v in template.__dict__.iteritems()
+                              if k not in ('xform', 'final', 'gradient'))
+        flame.background = list(template.background)
+        flame.xform = [Xform(flame) for i in range(count)]
+        if has_final:
+            flame.final = Xform(flame)
+        for xf, (o, t) in zip(flame.iter_xforms(), xform_pairs):
+            source = t or o
+            # names and other non numeric attributes, numbers are written by interpolate
+            xf.__dict__.update((k, v) for k, v in source.__dict__.iteritems()
+                               if not is_number(v) and k not in ('_parent', 'chaos', 'post'))
+            if not xf.isfinal():
+                chaos = list(source.chaos)
+                xf.chaos = Chaos(xf, chaos + [1.0] * (count - len(chaos)))
+            xf.post = PostXform(xf)
+
+        xforms = list(flame.iter_xforms())
+        containers = {'flame': flame.__dict__, 'background': flame.background}
+        slots = [(containers[c] if c in containers else xforms[c].__dict__, name) for c, name in keys]
+        coef_slots = [xf.__dict__ for xf in xforms] + [xf.post.__dict__ for xf in xforms]
+        return flame, slots, coef_slots
+
+    def interpolate(self, t):
+        """Returns a flame at t between the origin (0) and the target (1)."""
+        flame, slots, coef_slots = self.flames[self.next_flame]
+        self.next_flame = (self.next_flame + 1) % len(self.flames)
+
+        if self.precomputed is not None:
+            frame = self.precomputed.frame(t)
+            values = self.precomputed.values[frame].tolist()
+        else:
+            values = (self.start + self.delta * t).tolist()
+        for (container, key), value in zip(slots, values):
+            container[key] = value
+
+        for row, xf in self.live_rows:
+            self.coefs_end[row] = read_coefs(xf)
+        if self.log_coefs:
+            magnitude_start, angle_start = self.coefs_start_polar
+            magnitude_end, angle_end = polar_coefs(self.coefs_end)
+            # angles turn the short way round
+            angle_delta = (angle_end - angle_start + np.pi) % (2 * np.pi) - np.pi
+            magnitude = np.exp(magnitude_start + (magnitude_end - magnitude_start) * t)
+            angle = angle_start + angle_delta * t
+            coefs = np.empty_like(self.coefs_start)
+            coefs[:, 0:4:2] = magnitude * np.cos(angle)
+            coefs[:, 1:4:2] = magnitude * np.sin(angle)
+            coefs[:, 4:] = self.coefs_start[:, 4:] + (self.coefs_end[:, 4:] - self.coefs_start[:, 4:]) * t
+        else:
+            coefs = self.coefs_start + (self.coefs_end - self.coefs_start) * t
+        for attrs, row in zip(coef_slots, coefs.tolist()):
+            attrs.update(zip(COEFS, row))
+
+        if self.precomputed is not None:
+            flame.gradient.data[:] = self.precomputed.palettes[frame]
+        else:
+            flame.gradient.data[:] = self.palettes(np.array([t]))[0]
+        return flame
+
+    def palettes(self, t):
+        # (len(t), 256, 3) palettes at the given points of the transition
+        hsv = self.hsv_start + self.hsv_delta * t[:, np.newaxis, np.newaxis]
+        hsv[..., 0] %= 1.0
+        return hsv2rgb_array(hsv.reshape(-1, 3)).reshape(len(t), 256, 3)
+
+    def precompute(self, steps):
+        """Computes the flame attributes and palettes of `steps` frames spread evenly over t."""
+        t = np.linspace(0.0, 1.0, steps)
+        values = (self.start + self.delta * t[:, np.newaxis]).astype(np.float32)
+        palettes = np.empty((steps, 256, 3), dtype=np.uint8)
+        for i in range(0, steps, PRECOMPUTE_CHUNK):
+            palettes[i:i + PRECOMPUTE_CHUNK] = self.palettes(t[i:i + PRECOMPUTE_CHUNK])
+        return PrecomputedTransition(self, values, palettes)
+
+
+class PrecomputedTransition(object):
+    """Flame attributes and palettes of a transition, one row per frame.
+
+    Holds the keyframe vectors it was computed from, so a transition whose keyframes
+    were edited since (zoom, move, rotate keys) is not replayed from stale frames.
+    """
+
+    def __init__(self, interpolator, values, palettes):
+        self.keyframes = (interpolator.start, interpolator.delta,
+                          interpolator.hsv_start, interpolator.hsv_delta)
+        self.values = values
+        self.palettes = palettes
+        self.nbytes = values.nbytes + palettes.nbytes + sum(a.nbytes for a in self.keyframes)
+
+    def matches(self, interpolator):
+        keyframes = (interpolator.start, interpolator.delta,
+                     interpolator.hsv_start, interpolator.hsv_delta)
+        return all(a.shape == b.shape and np.array_equal(a, b) for a, b in zip(self.keyframes, keyframes))
+
+    def frame(self, t):
+        return int(round(min(max(t, 0.0), 1.0) * (len(self.values) - 1)))
+
+
+class TransitionCache(object):
+    """LRU cache of precomputed transitions between keyframe flames, capped in memory.
+
+    `precompute` fills it from a background thread, a transition between the same keyframe
+    objects then replays the cached frames instead of computing them. Affine coefficients
+    are not cached: they follow the animated target live (see FlameInterpolator).
+    """
+
+    def __init__(self, steps, max_bytes=CACHE_MAX_BYTES):
+        self.steps = steps
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, interpolator):
+        key = (interpolator.origin, interpolator.target)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # most recently used last
+            self.entries[key] = entry
+        return entry if entry.matches(interpolator) else None
+
+    def put(self, origin, target, entry, generation=None):
+        """Adds a transition, evicting the least recently used ones above the memory cap.
+
+        Returns False without adding it when `generation` is given and the cache was cleared since.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            old = self.entries.pop((origin, target), None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self.entries and self.nbytes + entry.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+            self.entries[(origin, target)] = entry
+            self.nbytes += entry.nbytes
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.nbytes = 0
+
+    def precompute(self, pairs):
+        """Clears the cache and precomputes the (origin, target) pairs in order, in the background.
+
+        Stops when the cache is full, so the first pairs should be the likeliest transitions.
+        """
+        self.clear()
+        worker = threading.Thread(target=self.precompute_pairs, args=(list(pairs), self.generation))
+        worker.daemon = True
+        worker.start()
+
+    def precompute_pairs(self, pairs, generation):
+        started = time.time()
+        for origin, target in pairs:
+            if generation != self.generation:
+                return  # the flames were reloaded meanwhile
+            try:
+                entry = FlameInterpolator(origin, target, buffers=0).precompute(self.steps)
+            except Exception as ex:
+                print('[!] error during transition precompute: ' + str(ex))
+                continue
+            if self.nbytes + entry.nbytes > self.max_bytes:
+                break
+            if not self.put(origin, target, entry, generation):
+                return
+            time.sleep(PRECOMPUTE_PAUSE_SECONDS)
+        print("[ ] PRECOMPUTED %d TRANSITIONS (%d MB) IN %.1f SECONDS"
+              % (len(self.entries), self.nbytes / (1024 * 1024), time.time() - started))
+
+
+def easing_sine(percent, minvalue = 0, maxvalue = 1):
+    return -(maxvalue - minvalue)/2 * (math.cos(math.pi*percent) - 1) + minvalue
+
+
+def easing_cubic(percent, minvalue = 0, maxvalue = 1):
+    percent *= 2.
+    if(percent < 1) : return ((maxvalue - minvalue) / 2.) * percent * percent * percent + minvalue
+    percent -= 2
+    return ((maxvalue - minvalue) / 2.) * (percent * percent * percent + 2) + minvalue
@@ -0,0 +1,532 @@
+""" Pre-rendered video loops of the meditation states, and their playback with eeg modulation.
+
+Offline, prerender renders at full quality, for every state flame, a seamless loop of the flame with
+its xforms animated, and the transitions between the flames of adjacent states. Clips are png sequences
+in a directory, described by a manifest:
+
+python loops.py playa.flame loops --size 1280x720 --quality 100
+
+Live, LoopPlayer plays them instead of rendering flames: it follows the meditation states like MMEngine,
+plays a transition clip or cross-fades between loops when the state changes, and modulates the hue,
+zoom and rotation of the frames with the eeg data (default_eeg.py --loops loops).
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+from fr0stlib import Flame, load_flames
+from frame_timing import clock, frame_timings
+from headless import frame_array, write_png
+from interpolation import FlameInterpolator, easing_cubic
+from palette_modulation import HUE_SHIFT_DEGREES
+from renderer import render_funcs
+
+MANIFEST = 'loops.json'
+STATES = 5
+CLIP_FPS = 30
+LOOP_SECONDS = 20
+TRANSITION_SECONDS = 10
+# xforms animated along a loop, as MMEngine.animate does live: peak rotation (degrees), move and scale
+ANIMATE_ROTATE = 10.
+ANIMATE_MOVE = 0.05
+ANIMATE_SCALE = 0.05
+RENDER_SETTINGS = {'estimator': 9.0,
+                   'filter_radius': 0.5,
+                   'spatial_oversample': 2,
+                   'progress_func': lambda *args: 0}
+
+CROSSFADE_SECONDS = 5  # between loops without a transition clip
+TRANSITION_FADE_SECONDS = 1  # from the loop into a transition clip
+MIN_STATE_SECONDS = 60  # a new eeg meditation state is followed once the current one lasted that long
+IDLE_STATE_SECONDS = 60  # without eeg data, the states cycle at that period
+# eeg modulation of the frames: hue shift from alpha, rotation from beta, zoom from delta
+ROTATE_DEGREES = 3.
+ZOOM_BASE = 1.1  # keeps the corners covered while rotating
+ZOOM_AMOUNT = 0.05
+MODULATION_PERIOD_FRAMES = 300  # frames of a rotation or zoom cycle, like MMEngine.sinelength
+VIEW_MOVE = 0.05  # part of the frame height the view is moved by a move key
+DECODE_AHEAD = 2  # clip frames decoded ahead of the one shown
+DECODE_THREADS = 2  # a frame takes about as long to decode and hue shift as a clip frame is shown
+DECODED_FRAMES = 8  # decoded frames kept, enough for the two clips of a cross-fade
+
+
+def state_flames(flames):
+    """ The flames of each state, like MMEngine: the first flame is not a state """
+    flames = flames[1:]
+    per_state = len(flames) // STATES
+    return dict((state, flames[(state - 1) * per_state:state * per_state]) for state in range(1, STATES + 1))
+
+
+def loop_flame(flame, phase):
+    """ The flame animated at phase (radians) of its loop, back to the flame itself at 2 pi """
+    flame = Flame(flame.to_string())
+    for form in flame.xform:
+        if form.animate:
+            form.rotate(ANIMATE_ROTATE * np.sin(phase))
+            form.move(ANIMATE_MOVE * np.sin(2. * phase))
+            form.scale(1. + ANIMATE_SCALE * (np.cos(phase) - 1.))
+    return flame
+
+
+def render_clip(directory, frames, flame_at, size, quality, backend):
+    """ Renders flame_at(index) for every frame to directory as a png sequence, skipped when it is
+    complete already """
+    if os.path.exists(os.path.join(directory, 'frame_%06d.png' % (frames - 1))):
+        print("[ ] %s ALREADY RENDERED" % directory)
+        return
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    render = render_funcs[backend]
+    started = time.time()
+    for index in xrange(frames):
+        output_buffer = render(flame_at(index), size, quality, **RENDER_SETTINGS)
+        pixels = frame_array(size, output_buffer).copy()
+        # opaque on the flame background, the clips are cross-faded rather than composited
+        pixels[..., 3] = 255
+        write_png(os.path.join(directory, 'frame_%06d.png' % index), pixels)
+    print("[ ] RENDERED %s, %d FRAMES IN %.1f SECONDS" % (directory, frames, time.time() - started))
+
+
+def prerender(flame_path, directory, size, quality, backend = 'flam3', fps = CLIP_FPS,
+              loop_seconds = LOOP_SECONDS, transition_seconds = TRANSITION_SECONDS, all_transitions = False):
+    """ Renders the loops of the state flames and the transitions between them, writes the manifest.
+
+    Transitions are rendered between the flames of adjacent states (1 to 5 wrap around), or between
+    the flames of all different states with all_transitions.
+    """
+    flames = load_flames(flame_path)
+    states = state_flames(flames)
+    manifest = {'size': list(size), 'fps': fps, 'states': {}, 'clips': {}, 'transitions': {}}
+
+    def add_clip(name, frames, loop):
+        manifest['clips'][name] = {'frames': frames, 'loop': loop}
+
+    loop_frames = int(loop_seconds * fps)
+    for state, state_list in sorted(states.items()):
+        manifest['states'][str(state)] = []
+        for flame in state_list:
+            name = 'loop_%02d' % flames.index(flame)
+            flame.size = size
+            render_clip(os.path.join(directory, name), loop_frames,
+                        lambda index: loop_flame(flame, index * 2. * np.pi / loop_frames), size, quality, backend)
+            add_clip(name, loop_frames, True)
+            manifest['states'][str(state)].append(name)
+
+    transition_frames = int(transition_seconds * fps)
+    for origin_state, origins in sorted(states.items()):
+        for target_state, targets in sorted(states.items()):
+            distance = abs(origin_state - target_state)
+            if distance == 0 or (not all_transitions and min(distance, STATES - distance) != 1):
+                continue
+            for origin in origins:
+                for target in targets:
+                    origin_index, target_index = flames.index(origin), flames.index(target)
+                    name = 'transition_%02d_%02d' % (origin_index, target_index)
+                    interpolator = FlameInterpolator(origin, target, buffers=1)
+                    render_clip(os.path.join(directory, name), transition_frames,
+                                lambda index: interpolator.interpolate(easing_cubic(index / (transition_frames - 1.))),
+                                size, quality, backend)
+                    add_clip(name, transition_frames, False)
+                    manifest['transitions']['loop_%02d>loop_%02d' % (origin_index, target_index)] = name
+
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print("[ ] WROTE %d CLIPS TO %s" % (len(manifest['clips']), directory))
+
+
+def read_png(path):
+    """ Reads an rgba png written by write_png into a (height, width, 4) uint8 array """
+    with open(path, 'rb') as f:
+        data = f.read()
+    position = 8
+    idat = []
+    while position < len(data):
+        length, tag = struct.unpack('>I4s', data[position:position + 8])
+        chunk = data[position + 8:position + 8 + length]
+        if tag == 'IHDR':
+            w, h = struct.unpack('>II', chunk[:8])
+        elif tag == 'IDAT':
+            idat.append(chunk)
+        position += length + 12
+    # a decompress object inflates without holding the interpreter lock, the playback thread runs meanwhile
+    scanlines = np.frombuffer(zlib.decompressobj().decompress(''.join(idat)), dtype=np.uint8).reshape(h, w * 4 + 1)
+    if scanlines[:, 0].any():
+        raise ValueError("%s has filtered scanlines, only pngs written by write_png are read" % path)
+    # contiguous, the pixels are sampled as one uint32 each
+    return np.ascontiguousarray(scanlines[:, 1:]).reshape(h, w, 4)
+
+
+class Clip(object):
+    """ A png sequence played at fps, looping or held on its last frame """
+    def __init__(self, directory, name, frames, loop, fps):
+        self.directory = os.path.join(directory, name)
+        self.name = name
+        self.frames = frames
+        self.loop = loop
+        self.fps = fps
+
+    def duration(self):
+        return self.frames / float(self.fps)
+
+    def index(self, seconds):
+        index = int(seconds * self.fps)
+        return index % self.frames if self.loop else min(index, self.frames - 1)
+
+    def following(self, index, count):
+        """ The indices of the count frames played after index """
+        if self.loop:
+            return [(index + i) % self.frames for i in range(1, count + 1)]
+        return range(index + 1, min(index + count + 1, self.frames))
+
+    def read(self, index):
+        return read_png(os.path.join(self.directory, 'frame_%06d.png' % index))
+
+
+def hue_rotation(degrees):
+    """ The matrix rotating rgb colors around the grey axis by degrees """
+    angle = np.radians(degrees)
+    cos, sin = np.cos(angle), np.sin(angle)
+    third, root = 1. / 3., np.sqrt(1. / 3.)
+    return (cos * np.eye(3) + (1. - cos) * third * np.ones((3, 3))
+            + sin * root * np.array([[0., -1., 1.], [1., 0., -1.], [-1., 1., 0.]])).astype(np.float32)
+
+
+def hue_tables(degrees):
+    """ The hue rotation as nine tables: tables[out, in][value] is the part of an input channel value in an
+    output channel """
+    return np.rint(hue_rotation(degrees)[:, :, np.newaxis] * np.arange(256, dtype=np.float32)).astype(np.int16)
+
+
+def shift_hue(pixels, degrees):
+    """ Rotates the hue of an rgba frame by degrees, in place.
+
+    Every output channel is the sum of three table lookups in int16, without a float copy of the frame.
+    """
+    tables = hue_tables(degrees)
+    channels = [pixels[..., c].astype(np.intp) for c in range(3)]
+    for c in range(3):
+        value = tables[c, 0].take(channels[0], mode='clip')
+        value += tables[c, 1].take(channels[1], mode='clip')
+        value += tables[c, 2].take(channels[2], mode='clip')
+        np.clip(value, 0, 255, out=value)
+        pixels[..., c] = value
+
+
+class FrameDecoder(object):
+    """ Decodes the frames of the clips ahead of their playback on worker threads, hue shifted.
+
+    Played faster than the clip frame rate, a frame is shown several times: it is decoded and hue shifted once.
+    A frame the workers didn't decode in time, like the first one of a clip, is decoded by the caller.
+    The hue shift of a frame is the one set when it was decoded, DECODE_AHEAD frames at most before it is shown.
+    """
+    def __init__(self):
+        self.shift = 0.
+        self.condition = threading.Condition()
+        self.wanted = collections.deque()  # (clip, index) to decode, in order
+        self.decoded = collections.OrderedDict()  # (clip name, index): frame, the oldest dropped first
+        self.running = True
+        for i in range(DECODE_THREADS):
+            thread = threading.Thread(target=self.run, name='FrameDecoder-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def decode(self, clip, index, shift):
+        pixels = clip.read(index)
+        if abs(shift) > 0.5:
+            shift_hue(pixels, shift)
+        return pixels
+
+    def store(self, key, pixels):
+        self.decoded[key] = pixels
+        while len(self.decoded) > DECODED_FRAMES:
+            self.decoded.popitem(last=False)
+
+    def frame(self, clip, index):
+        """ The decoded frame at index of the clip, the frames following it are queued to the workers """
+        with self.condition:
+            pixels = self.decoded.get((clip.name, index))
+            self.wanted = collections.deque(wanted for wanted in self.wanted if wanted[0] is not clip)
+            self.wanted.extend((clip, i) for i in clip.following(index, DECODE_AHEAD)
+                               if (clip.name, i) not in self.decoded)
+            self.condition.notify_all()
+        if pixels is None:
+            pixels = self.decode(clip, index, self.shift)
+            with self.condition:
+                self.store((clip.name, index), pixels)
+        return pixels
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.wanted:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                clip, index = self.wanted.popleft()
+                if (clip.name, index) in self.decoded:
+                    continue
+            t0 = clock()
+            pixels = self.decode(clip, index, self.shift)
+            t1 = clock()
+            with self.condition:
+                # the timings of a stage are written by one thread at a time
+                frame_timings.record('decode', t1 - t0, t1)
+                self.store((clip.name, index), pixels)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class LoopPlayer(object):
+    """ Plays pre-rendered loops like MMEngine renders flames, hands the frames to a display.
+
+    It stands in for the Renderer of RenderFrame or HeadlessFrame: the display calls release_buffer
+    once it copied a frame, and stop.
+    """
+    def __init__(self, eeg_source, directory, maxfps = 60):
+        print("[>] LOOPS FROM %s" % directory)
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.size = tuple(manifest['size'])
+        self.clips = dict((name, Clip(directory, name, clip['frames'], clip['loop'], manifest['fps']))
+                          for name, clip in manifest['clips'].iteritems())
+        self.states = dict((int(state), names) for state, names in manifest['states'].iteritems())
+        self.transitions = manifest['transitions']
+        self.eeg_source = eeg_source
+        self.maxfps = maxfps
+        self.frame_index = 0
+        # the view moved, rotated and zoomed with the keys and the mouse wheel, like the flame of MMEngine
+        self.view_center = (0., 0.)  # pixels
+        self.view_rotate = 0.  # degrees
+        self.view_zoom = 1.
+
+        self.decoder = FrameDecoder()
+
+        w, h = self.size
+        # pixel coordinates around the center, rotated and zoomed to sample the composited frame
+        ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+        self.grid_x = xs - w / 2.
+        self.grid_y = ys - h / 2.
+        # flat index of the pixel sampled for every output pixel, kept while the rotation and zoom don't change
+        self.source = np.empty(w * h, dtype=np.intp)
+        self.source_key = None
+        self.source_x = np.empty((h, w), dtype=np.float32)
+        self.source_y = np.empty((h, w), dtype=np.float32)
+        self.source_row = np.empty((h, w), dtype=np.intp)
+        # output buffers handed to the display, reused once released
+        self.lock = threading.Lock()
+        self.free_buffers = collections.deque()
+
+        self.loop = None
+        self.loop_started = None
+        self.transition = None  # (clip, started) of the transition clip played before the loop
+        self.fade_from = None  # (clip, started) of the clip faded out since a state change
+        self.fade_started = None
+        self.fade_seconds = CROSSFADE_SECONDS
+        self.set_meditation_state(1)
+        self.eeg_source.set_meditation_state_handler(self.set_meditation_state)
+
+    def set_meditation_state(self, newstate = 0, transtition = True, set_prev = False, set_next = False):
+        if(set_prev):
+            newstate = self.meditation_state - 1 if self.meditation_state > 1 else STATES
+        elif(set_next):
+            newstate = self.meditation_state + 1 if self.meditation_state < STATES else 1
+        self.meditation_state = newstate
+        now = clock()
+        self.state_started = now
+
+        target = self.clips[random.choice(self.states[newstate])]
+        print("[ ] ENTERING STATE %s, LOOP %s" % (newstate, target.name))
+        transition = None
+        if self.loop is not None and transtition:
+            # fade out of what is shown, the loop may be anywhere in its cycle
+            self.fade_from = self.showing(now)
+            self.fade_started = now
+            transition = self.transitions.get('%s>%s' % (self.loop.name, target.name))
+        if transition is not None:
+            # the transition clip starts on the keyframe of the loop and ends on the first frame of the target
+            self.transition = (self.clips[transition], now)
+            self.fade_seconds = TRANSITION_FADE_SECONDS
+            self.loop_started = now + self.clips[transition].duration()
+        else:
+            self.transition = None
+            self.fade_seconds = CROSSFADE_SECONDS
+            self.loop_started = now
+        self.loop = target
+
+    def showing(self, now):
+        """ The (clip, started) shown at now: the running transition, or the loop """
+        if self.transition is not None and now < self.loop_started:
+            return self.transition
+        return self.loop, self.loop_started
+
+    def compose(self, now):
+        """ The frame shown at now, cross-faded from the previous clip after a state change """
+        clip, started = self.showing(now)
+        pixels = self.decoder.frame(clip, clip.index(max(0., now - started)))
+        if self.fade_from is not None:
+            fade = (now - self.fade_started) / self.fade_seconds
+            if fade >= 1.:
+                self.fade_from = None
+            else:
+                clip, started = self.fade_from
+                weight = int(easing_cubic(fade) * 256)
+                faded = self.decoder.frame(clip, clip.index(now - started)).astype(np.uint16) * (256 - weight)
+                faded += pixels.astype(np.uint16) * weight
+                pixels = (faded >> 8).astype(np.uint8)
+        return pixels
+
+    def zoom(self, zoomamount = 1):
+        self.view_zoom *= zoomamount
+
+    def move(self, x = 0, y = 0):
+        # along the axes of the rotated view, up is towards the top of the frame
+        step = VIEW_MOVE * self.size[1] / self.view_zoom
+        angle = np.radians(self.view_rotate)
+        cx, cy = self.view_center
+        self.view_center = (cx + step * (x * np.cos(angle) - y * np.sin(angle)),
+                            cy - step * (x * np.sin(angle) + y * np.cos(angle)))
+
+    def rotate(self, deg_angle = 0):
+        self.view_rotate += deg_angle
+
+    def recenter(self):
+        self.view_center = 0., 0.
+        self.view_rotate = 0.
+
+    def sample_index(self, angle, zoom, center):
+        """ The flat index of the pixel sampled for every output pixel, rotated by angle and zoomed around
+        center """
+        key = (angle, zoom, center)
+        if self.source_key == key:
+            return self.source
+        w, h = self.size
+        cx, cy = center[0] + w / 2., center[1] + h / 2.
+        if angle == 0.:
+            # rows and columns are zoomed independently
+            xs = np.clip((self.grid_x[0] / zoom + cx).astype(np.intp), 0, w - 1)
+            ys = np.clip((self.grid_y[:, 0] / zoom + cy).astype(np.intp), 0, h - 1)
+            np.add((ys * w)[:, np.newaxis], xs, out=self.source.reshape(h, w))
+        else:
+            cos, sin = np.float32(np.cos(angle) / zoom), np.float32(np.sin(angle) / zoom)
+            x, y, row = self.source_x, self.source_y, self.source_row
+            np.multiply(self.grid_x, cos, out=x)
+            np.multiply(self.grid_y, sin, out=y)
+            x += y
+            x += cx
+            np.multiply(self.grid_y, cos, out=y)
+            y += cy
+            column = self.source.reshape(h, w)
+            np.copyto(column, x, casting='unsafe')
+            np.multiply(self.grid_x, sin, out=x)
+            y -= x
+            np.copyto(row, y, casting='unsafe')
+            np.clip(column, 0, w - 1, out=column)
+            np.clip(row, 0, h - 1, out=row)
+            row *= w
+            column += row
+        self.source_key = key
+        return self.source
+
+    def modulate(self, pixels, eegdata, output):
+        """ Rotation and zoom of the frame from the eeg data and the view, into the output buffer """
+        degrees, zoom, center = self.view_rotate, self.view_zoom, self.view_center
+        if eegdata is not None and not eegdata.is_empty():
+            cycle = np.sin(self.frame_index * 2. * np.pi / MODULATION_PERIOD_FRAMES)
+            degrees += ROTATE_DEGREES * np.clip(eegdata.beta, -1., 1.) * cycle
+            zoom *= ZOOM_BASE + ZOOM_AMOUNT * np.clip(eegdata.delta, -1., 1.) * cycle
+        elif degrees == 0. and zoom == 1. and center == (0., 0.):
+            output.reshape(pixels.shape)[:] = pixels
+            return
+        # an rgba pixel is one uint32, sampled at once
+        np.take(pixels.view(np.uint32).reshape(-1), self.sample_index(np.radians(degrees), zoom, center),
+                mode='clip', out=output.view(np.uint32))
+
+    def next_state(self, eegdata):
+        # like MMEngine: an eeg state is followed after a minute in the current one, states cycle when idle
+        in_state = clock() - self.state_started
+        if eegdata is None or eegdata.is_empty():
+            if in_state > IDLE_STATE_SECONDS:
+                self.set_meditation_state(set_next=True)
+        elif eegdata.meditation_state != self.meditation_state and in_state > MIN_STATE_SECONDS \
+                and eegdata.meditation_state in self.states:
+            self.set_meditation_state(eegdata.meditation_state)
+
+    def take_buffer(self):
+        with self.lock:
+            if self.free_buffers:
+                return self.free_buffers.popleft()
+        w, h = self.size
+        return np.empty(w * h * 4, dtype=np.uint8)
+
+    def release_buffer(self, output_buffer):
+        # called by the display once it copied a frame
+        with self.lock:
+            self.free_buffers.append(output_buffer)
+
+    # display is called with (size, output buffer) for every frame, like a render completing
+    def run(self, display, frames = None):
+        print("[>] PLAYING")
+        self.keepplaying = True
+        frames_run = 0
+        while self.keepplaying and (frames is None or frames_run < frames):
+            t0 = clock()
+            with frame_timings.stage('eeg_read'):
+                eegdata = self.eeg_source.read_data()
+            self.next_state(eegdata)
+            # the hue is shifted as the clip frames are decoded
+            if eegdata is not None and not eegdata.is_empty():
+                self.decoder.shift = HUE_SHIFT_DEGREES * np.clip(eegdata.alpha, -1., 1.)
+            with frame_timings.stage('compose'):
+                pixels = self.compose(t0)
+            output_buffer = self.take_buffer()
+            with frame_timings.stage('modulate'):
+                self.modulate(pixels, eegdata, output_buffer)
+            display(self.size, output_buffer)
+            self.frame_index += 1
+
+            t1 = clock()
+            frame_timings.record('frame', t1 - t0, t1)
+            delay = t0 + 1. / self.maxfps - t1
+            if delay > 0.:
+                time.sleep(delay)
+            frames_run += 1
+        self.stop()
+
+    def stop(self):
+        self.keepplaying = False
+        self.decoder.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-renders the loops and transitions of the meditation states")
+    parser.add_argument("flames", help="Flame file, the first flame is not a state, like playa.flame")
+    parser.add_argument("directory", help="Directory the clips and their manifest are written to")
+    parser.add_argument("--size",
+                        default="1280x720", help="Frame size, WIDTHxHEIGHT, the size of the display")
+    parser.add_argument("--quality",
+                        type=float, default=100, help="Render quality, points per pixel")
+    parser.add_argument("--backend",
+                        choices=sorted(render_funcs), default='flam3', help="Renderer")
+    parser.add_argument("--fps",
+                        type=int, default=CLIP_FPS, help="Frame rate of the clips")
+    parser.add_argument("--loop_seconds",
+                        type=float, default=LOOP_SECONDS, help="Length of a state loop")
+    parser.add_argument("--transition_seconds",
+                        type=float, default=TRANSITION_SECONDS, help="Length of a transition")
+    parser.add_argument("--all_transitions",
+                        action="store_true", help="Render the transitions between all states, not only adjacent ones")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split('x'))
+    prerender(args.flames, args.directory, (width, height), args.quality, args.backend, args.fps,
+              args.loop_seconds, args.transition_seconds, args.all_transitions)
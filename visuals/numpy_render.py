@@ -0,0 +1,512 @@
+""" Renders flames with the chaos game in NumPy, without libflam3 or flam4.
+
+Points are iterated together as arrays: every iteration picks an xform per point, applies its affine
+coefficients and variations to the points that picked it, and accumulates the colors of the points on
+screen in a histogram with bincount. The histogram is then tone mapped like flam3 does, with the log of
+the density, the flame's brightness, gamma and vibrancy.
+
+Computed like flam3, in flam3 coordinates: the y axis points down, coefficients are the screen coefs.
+The supported variations are in VARIATIONS, others are left out of the render with a warning.
+Density estimation is not done, the oversampled histogram is filtered with a box.
+
+parallel_numpy_render splits the points of a frame across processes, see SampleSplitRenderer.
+"""
+import ctypes
+import math
+import multiprocessing
+import numpy as np
+
+from fr0stlib import Flame
+from fr0stlib.xformarrays import XformArrays
+
+EPS = 1e-10
+BATCH_POINTS = 1 << 16  # points iterated together, as one array
+FUSE_ITERATIONS = 20  # iterations before the points are drawn, so they reach the attractor
+HISTOGRAM_CHUNK = 1 << 20  # points accumulated into the histogram at once
+BAD_VALUE = 1e10  # points escaping that far are restarted, like flam3 does with its bad values
+
+# the xform arrays of the last flame iterated, refreshed in place for the next frame:
+# frames are rendered one at a time per process
+last_arrays = None
+
+
+def pre_sumsq(x, y):
+    return x * x + y * y
+
+
+# variations: (x, y, xf) -> (x, y) before the variation weight is applied, as in flam3's variations.c
+def linear(x, y, xf):
+    return x, y
+
+def sinusoidal(x, y, xf):
+    return np.sin(x), np.sin(y)
+
+def spherical(x, y, xf):
+    r2 = 1. / (pre_sumsq(x, y) + EPS)
+    return x * r2, y * r2
+
+def swirl(x, y, xf):
+    r2 = pre_sumsq(x, y)
+    s, c = np.sin(r2), np.cos(r2)
+    return x * s - y * c, x * c + y * s
+
+def horseshoe(x, y, xf):
+    r = 1. / (np.sqrt(pre_sumsq(x, y)) + EPS)
+    return (x - y) * (x + y) * r, 2. * x * y * r
+
+def polar(x, y, xf):
+    return np.arctan2(x, y) / np.pi, np.sqrt(pre_sumsq(x, y)) - 1.
+
+def handkerchief(x, y, xf):
+    a = np.arctan2(x, y)
+    r = np.sqrt(pre_sumsq(x, y))
+    return r * np.sin(a + r), r * np.cos(a - r)
+
+def heart(x, y, xf):
+    r = np.sqrt(pre_sumsq(x, y))
+    a = r * np.arctan2(x, y)
+    return r * np.sin(a), -r * np.cos(a)
+
+def disc(x, y, xf):
+    a = np.arctan2(x, y) / np.pi
+    r = np.pi * np.sqrt(pre_sumsq(x, y))
+    return np.sin(r) * a, np.cos(r) * a
+
+def spiral(x, y, xf):
+    r = np.sqrt(pre_sumsq(x, y)) + EPS
+    r1 = 1. / r
+    return r1 * (y * r1 + np.sin(r)), r1 * (x * r1 - np.cos(r))
+
+def hyperbolic(x, y, xf):
+    r = np.sqrt(pre_sumsq(x, y)) + EPS
+    return x / r / r, y
+
+def diamond(x, y, xf):
+    r = np.sqrt(pre_sumsq(x, y)) + EPS
+    return x / r * np.cos(r), y / r * np.sin(r)
+
+def ex(x, y, xf):
+    a = np.arctan2(x, y)
+    r = np.sqrt(pre_sumsq(x, y))
+    n0 = np.sin(a + r)
+    n1 = np.cos(a - r)
+    m0 = n0 * n0 * n0 * r
+    m1 = n1 * n1 * n1 * r
+    return m0 + m1, m0 - m1
+
+def julia(x, y, xf):
+    a = 0.5 * np.arctan2(x, y) + np.pi * (np.random.random(len(x)) < 0.5)
+    r = np.sqrt(np.sqrt(pre_sumsq(x, y)))
+    return r * np.cos(a), r * np.sin(a)
+
+def bent(x, y, xf):
+    return np.where(x < 0, 2. * x, x), np.where(y < 0, y / 2., y)
+
+def waves(x, y, xf):
+    a, d, b, e, c, f = xf.screen_coefs
+    return x + b * np.sin(y / (c * c + EPS)), y + e * np.sin(x / (f * f + EPS))
+
+def fisheye(x, y, xf):
+    r = 2. / (np.sqrt(pre_sumsq(x, y)) + 1.)
+    return r * y, r * x
+
+def popcorn(x, y, xf):
+    a, d, b, e, c, f = xf.screen_coefs
+    return x + c * np.sin(np.tan(3. * y)), y + f * np.sin(np.tan(3. * x))
+
+def exponential(x, y, xf):
+    dx = np.exp(x - 1.)
+    dy = np.pi * y
+    return dx * np.cos(dy), dx * np.sin(dy)
+
+def power(x, y, xf):
+    r0 = np.sqrt(pre_sumsq(x, y)) + EPS
+    r = r0 ** (x / r0)
+    return r * y / r0, r * x / r0
+
+def cosine(x, y, xf):
+    a = np.pi * x
+    return np.cos(a) * np.cosh(y), -np.sin(a) * np.sinh(y)
+
+def rings(x, y, xf):
+    c = xf.screen_coefs[4]
+    dx = c * c + EPS
+    r0 = np.sqrt(pre_sumsq(x, y)) + EPS
+    r = np.fmod(r0 + dx, 2. * dx) - dx + r0 * (1. - dx)
+    return r * y / r0, r * x / r0
+
+def fan(x, y, xf):
+    c, f = xf.screen_coefs[4:]
+    dx = np.pi * (c * c + EPS)
+    a = np.arctan2(x, y)
+    a = np.where(np.fmod(a + f, dx) > dx / 2., a - dx / 2., a + dx / 2.)
+    r = np.sqrt(pre_sumsq(x, y))
+    return r * np.cos(a), r * np.sin(a)
+
+def eyefish(x, y, xf):
+    r = 2. / (np.sqrt(pre_sumsq(x, y)) + 1.)
+    return r * x, r * y
+
+def bubble(x, y, xf):
+    r = 1. / (0.25 * pre_sumsq(x, y) + 1.)
+    return r * x, r * y
+
+def cylinder(x, y, xf):
+    return np.sin(x), y
+
+def noise(x, y, xf):
+    r = np.random.random(len(x))
+    a = np.random.random(len(x)) * 2. * np.pi
+    return x * r * np.cos(a), y * r * np.sin(a)
+
+def julian(x, y, xf):
+    power = getattr(xf, 'julian_power', 1.)
+    dist = getattr(xf, 'julian_dist', 1.)
+    rnd = np.trunc(abs(power) * np.random.random(len(x)))
+    a = (np.arctan2(y, x) + 2. * np.pi * rnd) / power
+    r = pre_sumsq(x, y) ** (dist / power / 2.)
+    return r * np.cos(a), r * np.sin(a)
+
+def juliascope(x, y, xf):
+    power = getattr(xf, 'juliascope_power', 1.)
+    dist = getattr(xf, 'juliascope_dist', 1.)
+    rnd = np.trunc(abs(power) * np.random.random(len(x)))
+    atan = np.arctan2(y, x)
+    a = (2. * np.pi * rnd + np.where(rnd % 2 == 1, -atan, atan)) / power
+    r = pre_sumsq(x, y) ** (dist / power / 2.)
+    return r * np.cos(a), r * np.sin(a)
+
+def blur(x, y, xf):
+    r = np.random.random(len(x))
+    a = np.random.random(len(x)) * 2. * np.pi
+    return r * np.cos(a), r * np.sin(a)
+
+def gaussian_blur(x, y, xf):
+    a = np.random.random(len(x)) * 2. * np.pi
+    r = np.random.random((4, len(x))).sum(axis=0) - 2.
+    return r * np.cos(a), r * np.sin(a)
+
+def curl(x, y, xf):
+    c1 = getattr(xf, 'curl_c1', 0.)
+    c2 = getattr(xf, 'curl_c2', 0.)
+    re = 1. + c1 * x + c2 * (x * x - y * y)
+    im = c1 * y + 2. * c2 * x * y
+    r = 1. / (re * re + im * im + EPS)
+    return (x * re + y * im) * r, (y * re - x * im) * r
+
+def arch(x, y, xf):
+    a = np.random.random(len(x)) * xf.arch * np.pi
+    s, c = np.sin(a), np.cos(a)
+    return s, s * s / (c + EPS)
+
+def tangent(x, y, xf):
+    return np.sin(x) / (np.cos(y) + EPS), np.tan(y)
+
+def square(x, y, xf):
+    return np.random.random(len(x)) - 0.5, np.random.random(len(x)) - 0.5
+
+def cross(x, y, xf):
+    s = x * x - y * y
+    r = np.sqrt(1. / (s * s + EPS))
+    return x * r, y * r
+
+def exp(x, y, xf):
+    e = np.exp(x)
+    return e * np.cos(y), e * np.sin(y)
+
+def log(x, y, xf):
+    base = getattr(xf, 'log_base', math.e)
+    denom = 0.5 / math.log(base)
+    return denom * np.log(pre_sumsq(x, y) + EPS), np.arctan2(y, x)
+
+
+VARIATIONS = dict((f.__name__, f) for f in (
+    linear, sinusoidal, spherical, swirl, horseshoe, polar, handkerchief, heart, disc, spiral, hyperbolic,
+    diamond, ex, julia, bent, waves, fisheye, popcorn, exponential, power, cosine, rings, fan, eyefish,
+    bubble, cylinder, noise, julian, juliascope, blur, gaussian_blur, curl, arch, tangent, square, cross,
+    exp, log))
+
+unsupported_warned = set()
+
+
+class CompiledXform(object):
+    """ What the iteration needs of an xform, read once per frame from the xform arrays of the flame """
+    def __init__(self, arrays, index):
+        self.xf = arrays.xform(index)
+        self.coefs = arrays.screen_coefs(index)
+        self.post = arrays.post_screen_coefs(index)
+        self.variations = []
+        for name, weight in arrays.variations(index):
+            if name not in VARIATIONS:
+                if name not in unsupported_warned:
+                    unsupported_warned.add(name)
+                    print('[!] numpy renderer: variation %s is not supported, left out' % name)
+                continue
+            self.variations.append((VARIATIONS[name], weight))
+        self.color = arrays.attrs['color'][index]
+        self.color_speed = arrays.attrs['color_speed'][index]
+        self.opacity = arrays.attrs['opacity'][index]
+
+    def apply(self, x, y, color):
+        a, d, b, e, c, f = self.coefs
+        tx = a * x + b * y + c
+        ty = d * x + e * y + f
+        nx = np.zeros_like(tx)
+        ny = np.zeros_like(ty)
+        for variation, weight in self.variations:
+            vx, vy = variation(tx, ty, self.xf)
+            nx += weight * vx
+            ny += weight * vy
+        if self.post is not None:
+            a, d, b, e, c, f = self.post
+            nx, ny = a * nx + b * ny + c, d * nx + e * ny + f
+        return nx, ny, color * (1. - self.color_speed) + self.color * self.color_speed
+
+
+def xform_distributions(arrays):
+    """ Cumulative xform probabilities after each xform, (n xforms, n xforms), chaos included """
+    n = len(arrays.chaos)
+    weights = arrays.attrs['weight'][:n]
+    distributions = np.cumsum(weights * arrays.chaos, axis=1)
+    totals = distributions[:, -1:]
+    # an xform whose chaos forbids every other xform leads to any of them
+    return np.where(totals > 0, distributions / np.where(totals > 0, totals, 1.),
+                    np.cumsum(weights) / weights.sum())
+
+
+def camera(flame, size, oversample):
+    """ Maps flam3 coordinates to oversampled histogram coordinates: (matrix rows, offsets) """
+    w, h = size
+    # the scale is relative to the flame width, the size rendered may differ
+    ppu = flame.scale * flame.width / 100. * w / float(flame.width) * oversample
+    rot = -math.radians(flame.rotate)
+    cos, sin = math.cos(rot), math.sin(rot)
+    cx, cy = flame.center
+    return (ppu * cos, ppu * sin, -ppu * sin, ppu * cos), (w * oversample / 2., h * oversample / 2.), (cx, cy), ppu
+
+
+def palette_colors(flame):
+    # linear interpolation between the 256 palette entries, like flam3's linear palette mode
+    return flame.gradient.data.astype(np.float64) / 255.
+
+
+def iterate(flame, size, total_points, oversample, histogram):
+    """ Runs the chaos game for total_points, adding the summed rgb and opacity of the points drawn
+    to histogram, a (4, height * width) array at the oversampled size """
+    global last_arrays
+    if last_arrays is None:
+        last_arrays = XformArrays(flame)
+    else:
+        last_arrays.read(flame)
+    arrays = last_arrays
+    xforms = [CompiledXform(arrays, i) for i in range(len(flame.xform))]
+    final = CompiledXform(arrays, len(arrays) - 1) if arrays.has_final else None
+    distributions = xform_distributions(arrays)
+    # without chaos the next xform does not depend on the current one
+    chaos = not (distributions == distributions[0]).all()
+    palette = palette_colors(flame)
+    (m00, m01, m10, m11), (ox, oy), (cx, cy), ppu = camera(flame, size, oversample)
+    w, h = size[0] * oversample, size[1] * oversample
+
+    # fewer points when there are few to draw, so fusing stays a small part of the iterations
+    points = max(1, min(BATCH_POINTS, total_points // (4 * FUSE_ITERATIONS)))
+    iterations = int(math.ceil(total_points / float(points)))
+
+    pending = []
+    pending_count = 0
+
+    def flush():
+        indices = np.concatenate([i for i, _, _ in pending])
+        colors = np.concatenate([c for _, c, _ in pending])
+        opacities = np.concatenate([o for _, _, o in pending])
+        # the palette is sampled between entries
+        position = colors * 255.
+        low = np.clip(position.astype(np.int64), 0, 255)
+        high = np.minimum(low + 1, 255)
+        frac = (position - low)[:, None]
+        rgb = (palette[low] * (1. - frac) + palette[high] * frac) * opacities[:, None]
+        for channel in range(3):
+            histogram[channel] += np.bincount(indices, weights=rgb[:, channel], minlength=h * w)
+        histogram[3] += np.bincount(indices, weights=opacities, minlength=h * w)
+        del pending[:]
+
+    x = np.random.uniform(-1., 1., points)
+    y = np.random.uniform(-1., 1., points)
+    color = np.random.random(points)
+    current = np.random.randint(0, len(xforms), points)
+    for iteration in xrange(FUSE_ITERATIONS + iterations):
+        u = np.random.random(points)
+        # the next xform, drawn from the distribution after the current one
+        if chaos:
+            current = (u[:, None] > distributions[current]).sum(axis=1)
+        else:
+            current = np.searchsorted(distributions[0], u)
+        current = np.minimum(current, len(xforms) - 1)
+        opacity = np.empty(points)
+        for index, xform in enumerate(xforms):
+            picked = current == index
+            if not picked.any():
+                continue
+            x[picked], y[picked], color[picked] = xform.apply(x[picked], y[picked], color[picked])
+            opacity[picked] = xform.opacity
+
+        # restart the points that escaped
+        bad = ~(np.abs(x) < BAD_VALUE) | ~(np.abs(y) < BAD_VALUE)
+        if bad.any():
+            x[bad] = np.random.uniform(-1., 1., bad.sum())
+            y[bad] = np.random.uniform(-1., 1., bad.sum())
+            opacity[bad] = 0.
+
+        if iteration < FUSE_ITERATIONS:
+            continue
+
+        px, py, pcolor = x, y, color
+        if final is not None:
+            px, py, pcolor = final.apply(x, y, color)
+            opacity = opacity * final.opacity
+        # to histogram coordinates, rotated around the center
+        dx = px - cx
+        dy = py - cy
+        hx = m00 * dx + m01 * dy + ox
+        hy = m10 * dx + m11 * dy + oy
+        visible = (hx >= 0) & (hx < w) & (hy >= 0) & (hy < h) & (opacity > 0)
+        indices = hy[visible].astype(np.int64) * w + hx[visible].astype(np.int64)
+        pending.append((indices, np.clip(pcolor[visible], 0., 1.), opacity[visible]))
+        pending_count += len(indices)
+        if pending_count >= HISTOGRAM_CHUNK:
+            flush()
+            pending_count = 0
+    if pending:
+        flush()
+
+
+def tone_map(flame, histogram, size, quality, oversample, transparent):
+    """ flam3's log density tone mapping of the histogram, to rgba pixels in [0, 1] """
+    w, h = size
+    histogram = histogram.reshape(4, h * oversample, w * oversample)
+    ppu = camera(flame, size, 1)[3]
+    counts = histogram[3]
+    # log density: buckets are brightened by the log of how often they were hit
+    k1 = flame.brightness * 268. / 256.
+    area = w * h / (ppu * ppu)
+    k2 = oversample * oversample / (quality * area)
+    scale = np.where(counts > 0, k1 * np.log1p(counts * k2) / np.where(counts > 0, counts, 1.), 0.)
+    histogram = histogram * scale
+    # box filter down to the image size
+    histogram = histogram.reshape(4, h, oversample, w, oversample).mean(axis=(2, 4))
+
+    rgb = histogram[:3]
+    alpha = histogram[3]
+    gamma = 1. / flame.gamma
+    threshold = flame.gamma_threshold
+    # alpha to the power 1/gamma, linear below the threshold, like flam3's calc_alpha
+    alpha_gamma = np.where(alpha >= threshold, np.maximum(alpha, 0.) ** gamma,
+                           alpha / threshold * (threshold ** gamma if threshold > 0 else 0.))
+    ratio = np.where(alpha > 0, alpha_gamma / np.where(alpha > 0, alpha, 1.), 0.)
+    vibrancy = flame.vibrancy
+    rgb = vibrancy * rgb * ratio + (1. - vibrancy) * np.maximum(rgb, 0.) ** gamma
+    alpha_gamma = np.clip(alpha_gamma, 0., 1.)
+    if not transparent:
+        background = np.asarray(flame.background, dtype=np.float64).reshape(3, 1, 1)
+        rgb = rgb + (1. - alpha_gamma) * background
+        alpha_gamma = np.ones_like(alpha_gamma)
+    return np.clip(np.concatenate((rgb, alpha_gamma[None])), 0., 1.).transpose(1, 2, 0)
+
+
+def histogram_size(size, oversample):
+    return 4 * size[0] * oversample * size[1] * oversample
+
+
+def to_output_buffer(pixels, size, output_buffer):
+    w, h = size
+    if not isinstance(output_buffer, np.ndarray) or output_buffer.size != w * h * 4:
+        output_buffer = np.empty(w * h * 4, dtype=np.uint8)
+    output_buffer[:] = (pixels * 255. + 0.5).astype(np.uint8).ravel()
+    return output_buffer
+
+
+def numpy_render(flame, size, quality, transparent=1, output_buffer=None, spatial_oversample=1, **kwds):
+    """Renders rgba with the numpy chaos game, into output_buffer when it is an array of the right size."""
+    flame = flame if type(flame) is Flame else Flame(flame)
+    oversample = max(1, int(spatial_oversample))
+    histogram = np.zeros(histogram_size(size, oversample)).reshape(4, -1)
+    # quality is the number of points drawn per pixel
+    iterate(flame, size, int(quality * size[0] * size[1]), oversample, histogram)
+    pixels = tone_map(flame, histogram, size, quality, oversample, transparent)
+    return to_output_buffer(pixels, size, output_buffer)
+
+
+# set in each process of the pool by init_worker: the histograms shared with the dispatcher
+worker_histograms = None
+
+
+def init_worker(histograms, processes, slot_size):
+    global worker_histograms
+    worker_histograms = np.frombuffer(histograms, dtype=np.float64).reshape(processes, slot_size)
+
+
+def iterate_share(task):
+    """ Runs in a pool process: iterates its share of the points into its own shared histogram """
+    slot, flame_string, size, total_points, oversample, seed = task
+    np.random.seed(seed)
+    histogram = worker_histograms[slot, :histogram_size(size, oversample)].reshape(4, -1)
+    histogram[:] = 0.
+    iterate(Flame(flame_string), size, total_points, oversample, histogram)
+
+
+class SampleSplitRenderer(object):
+    """ Splits the points of a numpy render across a pool of processes.
+
+    Every process iterates its share of the points with its own seed into its own histogram, in
+    memory shared with the dispatcher, which sums them and tone maps the sum. The pool and the
+    shared memory are kept between renders and reallocated when a bigger frame comes.
+    """
+    def __init__(self, processes = None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+        self.histograms = None
+        self.slot_size = 0
+
+    def allocate(self, slot_size):
+        if self.pool is not None and slot_size <= self.slot_size:
+            return
+        self.close()
+        self.histograms = multiprocessing.RawArray(ctypes.c_double, self.processes * slot_size)
+        self.slot_size = slot_size
+        self.pool = multiprocessing.Pool(self.processes, init_worker, (self.histograms, self.processes, slot_size))
+
+    def render(self, flame, size, quality, transparent=1, output_buffer=None, spatial_oversample=1, **kwds):
+        flame = flame if type(flame) is Flame else Flame(flame)
+        oversample = max(1, int(spatial_oversample))
+        used_size = histogram_size(size, oversample)
+        self.allocate(used_size)
+
+        total_points = int(quality * size[0] * size[1])
+        shares = [total_points // self.processes + (slot < total_points % self.processes)
+                  for slot in range(self.processes)]
+        seeds = np.random.randint(0, 2 ** 31 - 1, self.processes)
+        flame_string = flame.to_string()
+        self.pool.map(iterate_share, [(slot, flame_string, size, shares[slot], oversample, seeds[slot])
+                                      for slot in range(self.processes)])
+
+        histograms = np.frombuffer(self.histograms, dtype=np.float64).reshape(self.processes, self.slot_size)
+        histogram = histograms[:, :used_size].sum(axis=0).reshape(4, -1)
+        pixels = tone_map(flame, histogram, size, quality, oversample, transparent)
+        return to_output_buffer(pixels, size, output_buffer)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.histograms = None
+
+
+# the pool is started on the first parallel render
+sample_split_renderer = None
+
+def parallel_numpy_render(flame, size, quality, **kwds):
+    """Renders like numpy_render, on all the cores."""
+    global sample_split_renderer
+    if sample_split_renderer is None:
+        sample_split_renderer = SampleSplitRenderer()
+    return sample_split_renderer.render(flame, size, quality, **kwds)
@@ -0,0 +1,135 @@
+""" EEG modulation of the flame palette, and the flame colour sent to the lights.
+
+PaletteModulator shifts the hue, saturation and brightness of the displayed flame's palette from the
+band powers, the palette counterpart of the geometric MMEngine.animate. The flame itself is never
+written: it may be a keyframe of a transition, read by the interpolator and its precompute thread.
+The flame shown is a shallow copy of it with a palette of its own. The flame's palette is converted to
+hls once, and every modulation is one vectorized conversion back to rgb. The modulation is rounded to
+steps: while the rounded values and the flame's palette don't change, the same palette is shown and
+flam4 keeps its colour array.
+
+ColorPublisher sends the colour of the flame to the lights. Publishing to rabbitMQ blocks, and retries
+while the broker is away, so colours are handed to a thread of their own and sent at most every
+PUBLISH_SECONDS, only when they changed.
+"""
+import collections
+import copy
+import logging
+import threading
+import numpy as np
+
+from fr0stlib import Palette, rgb2hls_array, hls2rgb_array
+
+# hue shift from alpha, also used by the pre-rendered loops, saturation from theta, brightness from gamma
+HUE_SHIFT_DEGREES = 30.
+SATURATION_PERCENT = 20.
+BRIGHTNESS_PERCENT = 10.
+HUE_STEP_DEGREES = 0.5  # the hue shift is rounded to that step, smaller changes don't rewrite the palette
+PERCENT_STEP = 0.5  # same for saturation and brightness
+PUBLISH_SECONDS = 1.  # colours sent to the lights at most that often
+
+# what RabbitController.publish_color reads from a colour
+LightColor = collections.namedtuple('LightColor', ('red', 'green', 'blue'))
+
+
+def rounded(value, step):
+    return round(value / step) * step
+
+
+def modulation(eegdata):
+    """ (hue shift in degrees, saturation and brightness change in percent) driven by eegdata """
+    if eegdata is None or eegdata.is_empty():
+        return (0., 0., 0.)
+    return (rounded(HUE_SHIFT_DEGREES * np.clip(eegdata.alpha, -1., 1.), HUE_STEP_DEGREES),
+            rounded(SATURATION_PERCENT * np.clip(eegdata.theta, -1., 1.), PERCENT_STEP),
+            rounded(BRIGHTNESS_PERCENT * np.clip(eegdata.gamma, -1., 1.), PERCENT_STEP))
+
+
+class PaletteModulator(object):
+    def __init__(self):
+        self.base = None  # palette of the flame modulated, as given
+        self.base_hls = None
+        self.gradient = None  # the modulated palette shown
+        self.current = None  # modulation of the shown palette
+        self.target = (0., 0., 0.)  # modulation from the last eeg data
+
+    def modulate(self, flame, eegdata):
+        """ Modulates the palette shown for flame with eegdata, returns the flame to show """
+        self.target = modulation(eegdata)
+        return self.shown(flame)
+
+    def shown(self, flame):
+        """ flame as shown with the last modulation: flame itself when it is not modulated, otherwise a
+        shallow copy of it with the modulated palette. flame is left untouched """
+        if self.target == (0., 0., 0.):
+            return flame
+        data = flame.gradient.data
+        # another palette, flame is another one or the transition moved on
+        if self.base is None or not np.array_equal(data, self.base):
+            self.base = data.copy()
+            self.base_hls = rgb2hls_array(self.base)
+            self.current = None
+        if self.target != self.current:
+            hue, saturation, brightness = self.target
+            # one conversion for the three changes, instead of Palette.hue, saturation and brightness
+            hls = self.base_hls.copy()
+            hls[:, 0] += hue / 360.
+            hls[:, 0] %= 1.
+            np.clip(hls[:, 1] + brightness / 100., 0., 1., out=hls[:, 1])
+            np.clip(hls[:, 2] + saturation / 100., 0., 1., out=hls[:, 2])
+            # a new palette, the render thread may still read the previous one
+            self.gradient = Palette()
+            self.gradient.data[:] = hls2rgb_array(hls)
+            self.current = self.target
+        shown = copy.copy(flame)
+        shown.gradient = self.gradient
+        return shown
+
+
+class ColorPublisher(object):
+    """ Publishes colours to the lights from a thread of its own, the engine never waits for rabbitMQ """
+    def __init__(self, rabbit, interval = PUBLISH_SECONDS):
+        self.rabbit = rabbit
+        self.interval = interval
+        self.next_time = 0.
+        self.pending = None  # latest colour handed over, not sent yet
+        self.sent = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def due(self, now):
+        """ Whether a colour is to be handed over at time now, checked first as computing it costs """
+        return now >= self.next_time
+
+    def update(self, color, now):
+        """ Hands the colour (r, g, b) over to the sender, returns right away """
+        self.next_time = now + self.interval
+        with self.condition:
+            self.pending = LightColor(*color)
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.send, name='color-publisher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def send(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                color, self.pending = self.pending, None
+            if color == self.sent:
+                continue
+            try:
+                self.rabbit.publish_color(color)
+                self.sent = color
+            except Exception as ex:
+                logging.warning("dropping light color, publish failed: " + repr(ex))
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
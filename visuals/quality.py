@@ -0,0 +1,112 @@
+""" Adapts the render quality to the measured render time, to hold the frame rate.
+
+Some flames render far slower than others at the same settings. The render worker reports how long
+every frame took, render and upscale included, and QualityController steps along QUALITY_LEVELS:
+down as soon as the frames of a window take longer than the frame budget, back up once they kept
+enough headroom for a while. Levels below full quality render at a fraction of the display size,
+the frames are then upscaled to it.
+
+Raising the quality and having to lower it right away again doubles the wait before the next raise,
+so a flame rendering just around the budget does not keep flickering between two levels.
+"""
+import collections
+import numpy as np
+
+# from the best to the cheapest: (quality, spatial oversample, render scale of the display size)
+QUALITY_LEVELS = ((10, 2, 1.0),
+                  (8, 2, 1.0),
+                  (6, 2, 1.0),
+                  (6, 1, 1.0),
+                  (5, 1, 0.85),
+                  (4, 1, 0.7),
+                  (3, 1, 0.6),
+                  (2, 1, 0.5))
+WINDOW_FRAMES = 15  # render times a decision is taken on, their median ignores single slow frames
+HEADROOM = 0.6  # quality is raised once frames render within that fraction of the budget
+UPGRADE_FRAMES = 60  # frames with headroom before the quality is raised
+MAX_UPGRADE_FRAMES = 60 * 30
+
+
+class QualityController(object):
+    def __init__(self, frame_budget, levels = QUALITY_LEVELS, level = 0):
+        self.frame_budget = frame_budget
+        self.levels = levels
+        self.level = level
+        self.render_times = collections.deque(maxlen=WINDOW_FRAMES)
+        self.upgrade_frames = UPGRADE_FRAMES
+        self.frames_with_headroom = 0
+        self.raised = False  # the last change raised the quality, and was not confirmed yet
+
+    def settings(self, settings):
+        """ The render settings at the current level, from the full quality ones """
+        quality, oversample, scale = self.levels[self.level]
+        return dict(settings, quality=quality, spatial_oversample=oversample)
+
+    def render_size(self, size):
+        """ The size frames displayed at size are rendered at """
+        scale = self.levels[self.level][2]
+        if scale == 1.0:
+            return size
+        w, h = size
+        return max(1, int(w * scale)), max(1, int(h * scale))
+
+    def record(self, seconds):
+        """ Takes the time a frame took, and changes the level when the window calls for it """
+        self.render_times.append(seconds)
+        if len(self.render_times) < WINDOW_FRAMES:
+            return
+        median = np.median(self.render_times)
+        if median > self.frame_budget:
+            self.frames_with_headroom = 0
+            if self.raised:
+                self.upgrade_frames = min(self.upgrade_frames * 2, MAX_UPGRADE_FRAMES)
+            if self.level < len(self.levels) - 1:
+                self.change(self.level + 1, median, 'over budget')
+            return
+        if self.raised:
+            # the raise held, the next one is not delayed any more
+            self.raised = False
+            self.upgrade_frames = UPGRADE_FRAMES
+        if median < self.frame_budget * HEADROOM and self.level > 0:
+            self.frames_with_headroom += 1
+            if self.frames_with_headroom >= self.upgrade_frames:
+                self.change(self.level - 1, median, 'headroom')
+        else:
+            self.frames_with_headroom = 0
+
+    def change(self, level, median, reason):
+        self.raised = level < self.level
+        self.level = level
+        self.render_times.clear()
+        self.frames_with_headroom = 0
+        quality, oversample, scale = self.levels[level]
+        print("[ ] QUALITY LEVEL %d (%s, %.1f ms for %.1f ms): quality %s, oversample %d, scale %.2f%s"
+              % (level, reason, median * 1000., self.frame_budget * 1000., quality, oversample, scale,
+                 ', next raise after %d frames' % self.upgrade_frames if level > 0 else ''))
+
+
+class Upscaler(object):
+    """ Nearest neighbour upscaling of rgba frames, the source pixel of every output pixel is kept per size """
+    def __init__(self):
+        self.indices = {}
+
+    def upscale(self, rendered, render_size, size, output_buffer = None):
+        """ The rgba buffer rendered at render_size upscaled to size, into output_buffer when it is an
+        array of the right size """
+        w, h = size
+        if not isinstance(output_buffer, np.ndarray) or output_buffer.size != w * h * 4:
+            output_buffer = np.empty(w * h * 4, dtype=np.uint8)
+        key = (render_size, size)
+        if key not in self.indices:
+            if len(self.indices) > len(QUALITY_LEVELS):
+                self.indices.clear()  # the display was resized
+            rw, rh = render_size
+            rows = (np.arange(h) * rh // h)[:, np.newaxis]
+            cols = np.arange(w) * rw // w
+            self.indices[key] = (rows, cols)
+        rows, cols = self.indices[key]
+        # a pixel as one uint32, a quarter of the indexing of separate channels
+        rw, rh = render_size
+        source = np.frombuffer(rendered, dtype=np.uint32, count=rw * rh).reshape(rh, rw)
+        output_buffer.view(np.uint32).reshape(h, w)[:] = source[rows, cols]
+        return output_buffer
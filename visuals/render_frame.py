@@ -0,0 +1,77 @@
+import wx
+
+from frame_timing import frame_timings
+
+class RenderPanel(wx.Panel):
+    def __init__(self, parent, renderer):
+        wx.Panel.__init__(self, parent)
+        self.parent = parent
+        self.renderer = renderer
+        self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_ERASE_BACKGROUND, self.OnEraseBackground)
+        self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
+        self.bmp = wx.EmptyBitmap(1, 1, 32)
+
+    def render(self, flame):
+        pw, ph = map(float, self.Size)
+        fw, fh = map(float, flame.size)
+        ratio = min(pw/fw, ph/fh)
+        size = int(fw * ratio), int(fh * ratio)
+        self.renderer.enqueue_render(flame, size, self.render_complete)
+
+    def render_complete(self, size, output_buffer):
+        # called from the render thread, the bitmap is made on the GUI thread
+        if output_buffer is not None:
+            wx.CallAfter(self.show_frame, size, output_buffer)
+
+    def show_frame(self, size, output_buffer):
+        w, h = size
+        try:
+            with frame_timings.stage('bitmap'):
+                self.bmp = wx.BitmapFromBufferRGBA(w, h, output_buffer)
+        finally:
+            # the bitmap holds a copy, the renderer can reuse the buffer
+            self.renderer.release_buffer(output_buffer)
+        self.Refresh()
+
+    def OnPaint(self, event):
+        fw,fh = self.bmp.GetSize()
+        pw,ph = self.Size
+        with frame_timings.stage('paint'):
+            dc = wx.BufferedDC(wx.PaintDC(self))
+            dc.DrawBitmap(self.bmp, (pw-fw)/2, (ph-fh)/2, True)
+
+    def OnEraseBackground(self, event):
+        pass # avoid flicker
+
+    def OnLeftDown(self, event):
+        self.parent.SetFocus()
+
+
+class RenderFrame(wx.Frame):
+    def __init__(self, parent, renderer):
+        print("[>] GUI START")
+        wx.Frame.__init__(self, parent)
+
+        self.image = RenderPanel(self, renderer)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.image, 1, wx.EXPAND)
+        self.SetSizer(sizer)
+        self.SetDoubleBuffered(True)
+
+        self.Show()
+        self.ShowFullScreen(True)
+        self.SetWindowStyle(self.GetWindowStyle() | wx.BORDER_NONE | wx.CLIP_CHILDREN)
+        self.SetFocus()
+
+
+    def stop(self):
+        self.image.renderer.stop()
+        self.Hide()
+        self.ShowFullScreen(False)
+        self.SetWindowStyle(self.GetWindowStyle() & ~wx.STAY_ON_TOP)
+        self.Close()
+
+
+    def render(self, flame):
+        self.image.render(flame)
@@ -1,112 +1,80 @@
-import math
-import time
 import threading
 import traceback
-import wx
 
-from fr0stlib.pyflam3 import _flam4
 from fr0stlib import Flame
+from fr0stlib.pyflam3 import Genome
+from frame_timing import clock, frame_timings
+from numpy_render import numpy_render, parallel_numpy_render
+from quality import QualityController, Upscaler
 
-class RenderPanel(wx.Panel):
-    def __init__(self, parent, renderer):
-        wx.Panel.__init__(self, parent)
-        self.parent = parent
-        self.renderer = renderer
-        self.Bind(wx.EVT_PAINT, self.OnPaint)
-        self.Bind(wx.EVT_ERASE_BACKGROUND, self.OnEraseBackground)
-        self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
-        self.bmp = wx.EmptyBitmap(1, 1, 32)
-        self.current_second = math.floor(time.clock())
-        self.renders_this_second = 0
-
-    def render(self, flame):
-        pw, ph = map(float, self.Size)
-        fw, fh = map(float, flame.size)
-        ratio = min(pw/fw, ph/fh)
-        size = int(fw * ratio), int(fh * ratio)
-        self.renderer.enqueue_render(flame, size, self.render_complete)
-
-    def render_complete(self, size, output_buffer):
-        this_second = math.floor(time.clock())
-        if self.current_second != this_second:
-            # rolled over into a new second, print FPS
-            #print("Renders/sec: %d" % self.renders_this_second)
-            self.current_second = this_second
-            self.renders_this_second = 0
-
-        w, h = size
-        self.bmp = wx.BitmapFromBufferRGBA(w, h, output_buffer)
-        self.Refresh()
-        self.renders_this_second += 1
-
-    def OnPaint(self, event):
-        fw,fh = self.bmp.GetSize()
-        pw,ph = self.Size
-        dc = wx.BufferedDC(wx.PaintDC(self))
-        dc.DrawBitmap(self.bmp, (pw-fw)/2, (ph-fh)/2, True)
-
-    def OnEraseBackground(self, event):
-        pass # avoid flicker
-
-    def OnLeftDown(self, event):
-        self.parent.SetFocus()
-
-
-class RenderFrame(wx.Frame):
-    def __init__(self, parent, renderer):
-        print("[>] GUI START")
-        wx.Frame.__init__(self, parent)
-
-        self.image = RenderPanel(self, renderer)
-        sizer = wx.BoxSizer(wx.VERTICAL)
-        sizer.Add(self.image, 1, wx.EXPAND)
-        self.SetSizer(sizer)
-        self.SetDoubleBuffered(True)
-
-        self.Show()
-        self.ShowFullScreen(True)
-        self.SetWindowStyle(self.GetWindowStyle() | wx.BORDER_NONE | wx.CLIP_CHILDREN)
-        self.SetFocus()
+FRAME_BUDGET_SECONDS = 1. / 60 # a frame completing later than this after being handed over is late
+REPORT_PERIOD_SECONDS = 10 # print render statistics every 10 seconds
 
 
-    def stop(self):
-        self.Hide()
-        self.ShowFullScreen(False)
-        self.SetWindowStyle(self.GetWindowStyle() & ~wx.STAY_ON_TOP)
-        self.Close()
-
-
-    def render(self, flame):
-        self.image.render(flame)
-
-
-def flam3_render(flame, size, quality, transparent=0, **kwds):
-    """Passes render requests on to flam3."""
-    frame = Genome.load(to_string(flame), **kwds)
+def flam3_render(flame, size, quality, transparent=1, output_buffer=None, **kwds):
+    """Passes render requests on to flam3, on the cpu. Renders rgba into its own buffer."""
+    with frame_timings.stage('convert'):
+        flame = flame if type(flame) is Flame else Flame(flame)
+        frame = Genome.load(flame.to_string(), **kwds)
     output_buffer, stats = frame.render(size, quality, transparent)
     return output_buffer
 
 
-def flam4_render(flame, size, quality, **kwds):
+# flam4 is loaded on first use, so the cpu renderer runs where there is no cuda
+_flam4 = None
+# keeps the flam4 buffers between frames, only used from the render worker thread
+flam4_loader = None
+
+def flam4_render(flame, size, quality, output_buffer=None, **kwds):
     """Passes requests on to flam4. Works on windows only for now."""
+    global _flam4, flam4_loader
+    if flam4_loader is None:
+        from fr0stlib.pyflam3 import _flam4
+        flam4_loader = _flam4.Flam4Loader()
     flame = flame if type(flame) is Flame else Flame(flame)
-    flam4Flame = _flam4.loadFlam4(flame)
-    output_buffer = _flam4.renderFlam4(flam4Flame, size, quality, **kwds)
+    with frame_timings.stage('convert'):
+        flam4Flame = flam4_loader.load(flame)
+    output_buffer = _flam4.renderFlam4(flam4Flame, size, quality, output_buffer=output_buffer, **kwds)
     return output_buffer
 
 
 render_funcs = {'flam3': flam3_render,
-                'flam4': flam4_render}
+                'flam4': flam4_render,
+                'numpy': numpy_render,
+                'numpy_parallel': parallel_numpy_render}
 
 class Renderer():
-    def __init__(self):
-        self.render_func = render_funcs['flam4']
+    """Renders flames on a worker thread, one frame behind the engine.
+
+    The engine hands frames over through a single slot guarded by a condition: the
+    worker renders the latest frame while the engine prepares the next one. A frame
+    replaced in the slot before the worker took it is counted as dropped, a frame
+    completed more than a frame budget after it was handed over as late.
+    Frames are rendered into two output buffers in turn: a buffer handed to the
+    display is reused only once the display released it. A frame that fails to
+    render is handed over as None, so a display waiting for it goes on.
+    With adaptive_quality, the settings and the size frames are rendered at follow
+    the render times to hold the frame budget, frames rendered smaller are upscaled.
+    """
+    def __init__(self, backend = 'flam4', frame_budget = FRAME_BUDGET_SECONDS, adaptive_quality = False):
+        self.render_func = render_funcs[backend]
         self.settings = {'estimator': 0.0,
                          'filter_radius': 0.25,
                          'quality': 10,
                          'spatial_oversample': 2,
                          'progress_func': self.progress}
-        self.queue = []
+        self.frame_budget = frame_budget
+        self.quality = QualityController(frame_budget) if adaptive_quality else None
+        self.upscaler = Upscaler()
+        self.condition = threading.Condition()
+        self.pending = None
+        self.output_buffers = [None, None]
+        # what the renderer draws into, the output buffer itself unless the frame is upscaled
+        self.render_buffers = [None, None]
+        self.held_buffers = set()
+        self.frames_rendered = 0
+        self.frames_dropped = 0
+        self.frames_late = 0
         self.keeprendering = True
         self.start_worker()
 
@@ -117,25 +85,92 @@ class Renderer():
 
     def worker(self):
         try:
+            next_buffer = 0
+            last_report = clock()
             while self.keeprendering:
-                if self.queue:
-                    (flame, size, complete_callback) = self.queue.pop()
-                    try:
-                        output_buffer = self.render_func(flame, size, **self.settings)
-                    except Exception:
-                        # Make sure rendering never crashes due to malformed flames.
-                        traceback.print_exc()
-                        next
-
-                    complete_callback(size, output_buffer)
-                else:
-                    time.sleep(0.005) # max 200 queue inspections/sec
-        except:
-            pass # happens when Mind Murmur is stopped
+                with self.condition:
+                    while self.pending is None and self.keeprendering:
+                        self.condition.wait()
+                    if not self.keeprendering:
+                        break
+                    (flame, size, complete_callback, enqueued_at) = self.pending
+                    self.pending = None
+                    # wait for the display to release the buffer rendered two frames ago
+                    while id(self.output_buffers[next_buffer]) in self.held_buffers and self.keeprendering:
+                        self.condition.wait()
+
+                settings, render_size = self.settings, size
+                if self.quality is not None:
+                    settings, render_size = self.quality.settings(settings), self.quality.render_size(size)
+                started = clock()
+                try:
+                    with frame_timings.stage('render'):
+                        output_buffer = self.render_func(flame, render_size, output_buffer=self.render_buffers[next_buffer],
+                                                         **settings)
+                    self.render_buffers[next_buffer] = output_buffer
+                    if render_size != size:
+                        with frame_timings.stage('upscale'):
+                            output_buffer = self.upscaler.upscale(output_buffer, render_size, size,
+                                                                  self.output_buffers[next_buffer])
+                except Exception:
+                    # Make sure rendering never crashes due to malformed flames.
+                    traceback.print_exc()
+                    self.complete(complete_callback, size, None)
+                    continue
+                if self.quality is not None:
+                    self.quality.record(clock() - started)
+
+                self.output_buffers[next_buffer] = output_buffer
+                next_buffer = 1 - next_buffer
+                with self.condition:
+                    self.held_buffers.add(id(output_buffer))
+                self.frames_rendered += 1
+                rendered_at = clock()
+                frame_timings.record('latency', rendered_at - enqueued_at, rendered_at)
+                if rendered_at - enqueued_at > self.frame_budget:
+                    self.frames_late += 1
+                self.complete(complete_callback, size, output_buffer)
+
+                if rendered_at - last_report >= REPORT_PERIOD_SECONDS:
+                    self.report()
+                    last_report = rendered_at
+        except Exception:
+            # happens when Mind Murmur is stopped, the daemon thread runs into the torn down interpreter
+            if self.keeprendering:
+                traceback.print_exc()
+
+    def complete(self, complete_callback, size, output_buffer):
+        """Hands a frame to the display. A display failing is reported, and its buffer released."""
+        try:
+            complete_callback(size, output_buffer)
+        except Exception:
+            traceback.print_exc()
+            if output_buffer is not None:
+                self.release_buffer(output_buffer)
 
     def enqueue_render(self, flame, size, complete_callback):
-        if not len(self.queue):
-            self.queue.append((flame, size, complete_callback))
+        with self.condition:
+            if self.pending is not None:
+                # the worker is still busy with the previous frame, the latest one wins
+                self.frames_dropped += 1
+            self.pending = (flame, size, complete_callback, clock())
+            self.condition.notify_all()
+
+    def release_buffer(self, output_buffer):
+        # called by the display once it copied a rendered buffer
+        with self.condition:
+            self.held_buffers.discard(id(output_buffer))
+            self.condition.notify_all()
+
+    def report(self):
+        print("[ ] RENDERED %d FRAMES, DROPPED %d, LATE %d%s" % (self.frames_rendered, self.frames_dropped, self.frames_late,
+              ', QUALITY LEVEL %d' % self.quality.level if self.quality is not None else ''))
+        self.frames_rendered = self.frames_dropped = self.frames_late = 0
+
+    def stop(self):
+        with self.condition:
+            self.keeprendering = False
+            self.condition.notify_all()
 
     def progress(self, py_object, progress, stage, eta):
-        pass
+        return 0 # a non-zero value stops the render
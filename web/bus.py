@@ -3,7 +3,7 @@ import logging
 import sys
 import threading
 
-from common.rabbit_controller import MeditationStateCommand, HeartRateCommand
+from common.rabbit_controller import MeditationStateCommand, HeartRateCommand, decode_command
 
 MAX_MESSAGES = 500  # Number of messages to keep for web UI
 
@@ -50,7 +50,7 @@ class Bus():
     def process_heart_rate_command(self, channel, method, properties, body):
         logging.info(("received heart rate command with body \"{body}\"").format(body=body))
 
-        command = HeartRateCommand.from_string(body)
+        command = decode_command(body, properties, HeartRateCommand)
 
         heart_rate = command.get_heart_rate()
         timestamp = command.get_timestamp()